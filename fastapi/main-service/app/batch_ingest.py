@@ -0,0 +1,231 @@
+"""
+多数のラウンドを、OpenAIのバッチAPIでまとめて取り込むコマンド
+
+    python batch_ingest.py rounds.json                           # POST /roundsと同じ形式のリスト
+    python batch_ingest.py rounds.json --api-url http://localhost:8080
+    python batch_ingest.py rounds.json --skip-ingest --output assembled.json
+
+1. 全ラウンドの全スピーチのargument unit分割のリクエストをJSONLに書き、バッチとして投げて完了まで待つ
+2. 結果からcreate_roundと同じ処理（build_round_speeches・relocate_pois）でargument unitを作り、
+   反論判定のリクエストを同様にバッチで投げる
+3. 各ラウンドをPOST /roundsで登録する
+
+バッチの結果はllm_cacheに、APIを直接呼んだときと同じキーで入れる。APIサーバーが同じキャッシュファイルを
+使っていれば、3.のcreate_roundはGPTを1回も呼ばない。LLM_CACHE_PATHが相対パスだと作業ディレクトリで
+別のファイルになるので、起動時に絶対パスを表示する（APIサーバーのLLM_CACHE_PATHをそれに合わせる）
+投げたバッチのidは--stateのファイルに保存するので、待っている途中で止めても、再実行すれば同じバッチを待つ
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Dict, List
+
+import httpx
+
+from cruds.gpt import (
+    client, cache_key, batch_request_body, segment_messages, rebuttal_messages, relocate_pois, rebuttal_speech_pairs,
+    segment2argument_units, speeches2rebuttals, ArgumentUnitMetaDataList, Rebuttals, try_num,
+)
+from cruds.round import build_round_speeches
+from llm_cache import llm_cache
+from routers.round import RoundCreate, get_video_metadata, video_metadata_fields
+
+DEFAULT_STATE = "batch_ingest.state.json"
+DEFAULT_WORK_DIR = "batch_ingest"
+BATCH_ENDPOINT = "/v1/chat/completions"
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def load_state(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(path: str, state: dict) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def cached(key: str) -> bool:
+    return llm_cache.get(key) is not None
+
+
+async def run_batch(name: str, requests: Dict[str, dict], args, state: dict) -> None:
+    """キャッシュに無いリクエストをバッチで投げ、結果をllm_cacheに入れる
+
+    requests: キャッシュのキー -> バッチAPIのbody。キーをcustom_idに使う
+    """
+    pending = {key: body for key, body in requests.items() if not cached(key)}
+    print(f"[{name}] {len(requests)} requests, {len(requests) - len(pending)} already cached")
+    if not pending:
+        return
+
+    lines = [
+        json.dumps({"custom_id": key, "method": "POST", "url": BATCH_ENDPOINT, "body": body}, ensure_ascii=False)
+        for key, body in sorted(pending.items())
+    ]
+    content = ("\n".join(lines) + "\n").encode()
+    digest = hashlib.sha256(content).hexdigest()
+    os.makedirs(args.work_dir, exist_ok=True)
+    input_path = os.path.join(args.work_dir, f"{name}.jsonl")
+    with open(input_path, "wb") as f:
+        f.write(content)
+
+    # 同じ内容のバッチを投げてあれば、それを待つ
+    batch_state = state.get(name)
+    if batch_state and batch_state["input_sha256"] == digest:
+        batch = await client.batches.retrieve(batch_state["batch_id"])
+        print(f"[{name}] resuming batch {batch.id} ({batch.status})")
+    else:
+        input_file = await client.files.create(file=(os.path.basename(input_path), content), purpose="batch")
+        batch = await client.batches.create(
+            input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window="24h",
+            metadata={"source": "batch_ingest", "phase": name},
+        )
+        state[name] = {"batch_id": batch.id, "input_sha256": digest}
+        save_state(args.state, state)
+        print(f"[{name}] submitted batch {batch.id} with {len(pending)} requests ({input_path})")
+
+    start = time.time()
+    while batch.status not in TERMINAL_STATUSES:
+        await asyncio.sleep(args.poll_interval)
+        batch = await client.batches.retrieve(batch.id)
+        counts = batch.request_counts
+        progress = f"{counts.completed}/{counts.total} done, {counts.failed} failed" if counts else ""
+        print(f"[{name}] {batch.status} {progress} ({time.time() - start:.0f}s)")
+    if batch.status != "completed" or batch.output_file_id is None:
+        raise SystemExit(f"[{name}] batch {batch.id} ended with status {batch.status}")
+
+    output = await client.files.content(batch.output_file_id)
+    stored, failed = 0, 0
+    for line in output.text.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            failed += 1
+            continue
+        contents = [choice["message"]["content"] for choice in response["body"]["choices"]]
+        # 拒否された応答はcompleteと同様にキャッシュしない（取り込み時にAPIを直接呼ぶ）
+        if all(content is not None for content in contents):
+            llm_cache.put(result["custom_id"], contents)
+            stored += 1
+        else:
+            failed += 1
+    print(f"[{name}] stored {stored} responses, {failed} failed (failed requests are sent directly on ingest)")
+
+
+def segment_requests(rounds: List[RoundCreate]) -> Dict[str, dict]:
+    requests = {}
+    for round_create in rounds:
+        for speech in round_create.speeches:
+            messages = segment_messages(speech)
+            requests[cache_key(messages, ArgumentUnitMetaDataList)] = batch_request_body(messages, ArgumentUnitMetaDataList)
+    return requests
+
+
+async def assemble_speeches(round_create: RoundCreate):
+    """create_roundと同じく、分割の結果からSpeech・Poiを作る（分割の結果はキャッシュから読む）"""
+    segment_results = [await segment2argument_units(speech) for speech in round_create.speeches]
+    return build_round_speeches(None, round_create.speeches, round_create.poi_segment_ids, segment_results)
+
+
+async def rebuttal_requests(rounds: List[RoundCreate]) -> Dict[str, dict]:
+    requests = {}
+    for round_create in rounds:
+        speeches, pois = await assemble_speeches(round_create)
+        new_speeches = relocate_pois([poi.argument_unit_id for poi in pois], speeches)
+        for src, tgt in rebuttal_speech_pairs(len(speeches)):
+            messages = rebuttal_messages(new_speeches[src], new_speeches[tgt])
+            requests[cache_key(messages, Rebuttals, n=try_num)] = batch_request_body(messages, Rebuttals, n=try_num)
+    return requests
+
+
+async def assemble_round(round_create: RoundCreate) -> dict:
+    """登録されるラウンドの内容。POST /batch-roundのbody（RoundBatchCreate）の形式
+
+    title・description・date_uploaded・channel_id・tagは、create_roundと同じく動画のmetaデータから作る
+    """
+    speeches, pois = await assemble_speeches(round_create)
+    pois = [poi.argument_unit_id for poi in pois]
+    rebuttals = await speeches2rebuttals(pois, speeches)
+    metadata = await get_video_metadata(round_create.video_id)
+    return {
+        "video_id": round_create.video_id,
+        "motion": round_create.motion,
+        **video_metadata_fields(metadata, round_create.tag),
+        "speeches": [
+            {"argument_units": [
+                {"sequence_id": au.sequence_id, "start": au.start, "end": au.end, "text": au.text}
+                for au in speech.argument_units
+            ]}
+            for speech in speeches
+        ],
+        "pois": pois,
+        "rebuttals": [{"src": rebuttal.src, "tgt": rebuttal.tgt, "votes": rebuttal.votes} for rebuttal in rebuttals],
+    }
+
+
+async def ingest(rounds: List[RoundCreate], args) -> None:
+    async with httpx.AsyncClient(base_url=args.api_url, timeout=None) as api:
+        for round_create in rounds:
+            response = await api.post("/rounds", content=round_create.model_dump_json(),
+                                      headers={"Content-Type": "application/json"})
+            if response.status_code != 200:
+                print(f"{round_create.video_id}: failed with {response.status_code} {response.text[:200]}")
+                continue
+            # RoundResponseにidは無いので、登録された内容の概要を出す
+            created = response.json()
+            print(f"{round_create.video_id}: created round \"{created['title']}\" "
+                  f"({len(created['speeches'])} speeches, {len(created['rebuttals'])} rebuttals)")
+
+
+async def run(args) -> None:
+    with open(args.rounds) as f:
+        rounds = [RoundCreate(**round_data) for round_data in json.load(f)]
+    invalid = [round_create.video_id for round_create in rounds if len(round_create.speeches) not in (6, 8)]
+    if invalid:
+        raise SystemExit(f"The number of speeches must be 6 or 8: {invalid}")
+    state = {} if args.restart else load_state(args.state)
+
+    await run_batch("segments", segment_requests(rounds), args, state)
+    await run_batch("rebuttals", await rebuttal_requests(rounds), args, state)
+
+    if args.output:
+        assembled = [await assemble_round(round_create) for round_create in rounds]
+        with open(args.output, "w") as f:
+            json.dump(assembled, f, ensure_ascii=False, indent=2)
+        print(f"Wrote {len(assembled)} assembled rounds to {args.output}")
+    if not args.skip_ingest:
+        await ingest(rounds, args)
+    if os.path.exists(args.state):
+        os.remove(args.state)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Ingest rounds through the OpenAI batch API")
+    parser.add_argument("rounds", help="POST /roundsのbodyのリスト（JSON）")
+    parser.add_argument("--api-url", default="http://localhost:8080", help="ラウンドを登録するAPIサーバー")
+    parser.add_argument("--skip-ingest", action="store_true", help="キャッシュに結果を入れるだけで、登録はしない")
+    parser.add_argument("--output", help="組み立てたラウンド（POST /batch-roundの形式）の保存先")
+    parser.add_argument("--poll-interval", type=float, default=60.0, help="バッチの状態を確認する間隔（秒）")
+    parser.add_argument("--work-dir", default=DEFAULT_WORK_DIR, help="バッチの入力JSONLの保存先")
+    parser.add_argument("--state", default=DEFAULT_STATE)
+    parser.add_argument("--restart", action="store_true", help="保存したバッチidを使わずに投げ直す")
+    args = parser.parse_args()
+    if llm_cache is None:
+        raise SystemExit("LLM_CACHE_PATH is empty; batch results are handed to the API through llm_cache")
+    print(f"LLM cache: {llm_cache.path} (set LLM_CACHE_PATH of the API server to this path)")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
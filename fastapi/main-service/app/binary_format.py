@@ -0,0 +1,80 @@
+"""
+Compact binary representation of RoundBatchResponse lists for the explore graph view
+
+Clients that send `Accept: application/x-msgpack` receive a MessagePack array with one map per round.
+Transcripts are omitted; the numeric graph structure is sent as little-endian packed arrays (bin):
+    speech_offsets  int32[S+1]  ADU index range of each speech
+    sequence_ids    int32[A]    -1 when the value is NULL
+    starts / ends   float32[A]  NaN when the value is NULL
+    pois            int32[P]
+    rebuttal_src    int32[R]
+    rebuttal_tgt    int32[R]
+    rebuttal_votes  int32[R]
+Round metadata (and id / features when present) are sent as plain MessagePack values.
+Items removed with fields= / exclude= are omitted.
+"""
+
+import sys
+from array import array
+from typing import Any, Dict, List
+
+import msgpack
+from fastapi import Request
+from http_cache import JSON_MEDIA_TYPE, header_weights
+
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+MSGPACK_ACCEPT_TYPES = (MSGPACK_MEDIA_TYPE, "application/msgpack", "application/vnd.msgpack")
+
+ARGUMENT_UNIT_ARRAYS = (("sequence_id", "sequence_ids", "i"), ("start", "starts", "f"), ("end", "ends", "f"))
+# 列はNULLを許すので、Noneは型ごとにこの値で送る
+MISSING_VALUES = {"i": -1, "f": float("nan")}
+METADATA_KEYS = ("id", "video_id", "title", "description", "motion", "date_uploaded", "channel_id", "tag", "features")
+
+
+def negotiate_media_type(request: Request) -> str:
+    """Acceptでmsgpackが明示され、その重みがJSON以上ならmsgpack。それ以外はJSON"""
+    header = request.headers.get("accept")
+    if not header:
+        return JSON_MEDIA_TYPE
+    weights = header_weights(header)
+    msgpack_weight = max(weights.get(media_type, 0.0) for media_type in MSGPACK_ACCEPT_TYPES)
+    json_weight = weights.get(JSON_MEDIA_TYPE, weights.get("application/*", weights.get("*/*", 0.0)))
+    if msgpack_weight > 0 and msgpack_weight >= json_weight:
+        return MSGPACK_MEDIA_TYPE
+    return JSON_MEDIA_TYPE
+
+
+def _packed(typecode: str, values) -> bytes:
+    missing = MISSING_VALUES.get(typecode)
+    packed = array(typecode, (missing if value is None else value for value in values))
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def pack_round(round_data: Dict[str, Any]) -> Dict[str, Any]:
+    """RoundBatchResponse形式のdictをpacked arrayの形にする。fields=で除かれた項目は含めない"""
+    packed_round = {key: round_data[key] for key in METADATA_KEYS if key in round_data}
+
+    if "speeches" in round_data:
+        speech_offsets = [0]
+        argument_units = []
+        for speech in round_data["speeches"]:
+            argument_units.extend(speech["argument_units"])
+            speech_offsets.append(len(argument_units))
+        packed_round["speech_offsets"] = _packed("i", speech_offsets)
+        for field, key, typecode in ARGUMENT_UNIT_ARRAYS:
+            if not argument_units or field in argument_units[0]:
+                packed_round[key] = _packed(typecode, [au[field] for au in argument_units])
+
+    if "pois" in round_data:
+        packed_round["pois"] = _packed("i", round_data["pois"])
+    if "rebuttals" in round_data:
+        packed_round["rebuttal_src"] = _packed("i", [rebuttal["src"] for rebuttal in round_data["rebuttals"]])
+        packed_round["rebuttal_tgt"] = _packed("i", [rebuttal["tgt"] for rebuttal in round_data["rebuttals"]])
+        packed_round["rebuttal_votes"] = _packed("i", [rebuttal.get("votes", 1) for rebuttal in round_data["rebuttals"]])
+    return packed_round
+
+
+def encode_rounds(rounds: List[Dict[str, Any]]) -> bytes:
+    return msgpack.packb([pack_round(round_data) for round_data in rounds], use_bin_type=True)
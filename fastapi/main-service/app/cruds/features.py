@@ -0,0 +1,115 @@
+import asyncio
+from typing import Dict, List
+from sqlalchemy import select
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+import models.round as round_db_model
+from features.macro_structural import calculate_features, FEATURE_ALGORITHM_VERSION
+from features.macro_structural_batch import calculate_features_batch
+from features.stats import CorpusFeatureStats
+from features.similarity import SimilarityIndex
+from cruds.round import FieldSelection, select_round_rows, load_round_batches, execute_in_chunks
+
+FEATURE_NAMES = ("distance", "interval", "order", "rally")
+
+# 特徴量の計算に必要な項目だけを読む
+FEATURE_INPUTS = FieldSelection(["pois", "rebuttals", "speeches.sequence_id"])
+# 全versionを返すエンドポイント用。CSVと突き合わせられるようタイトルも読む
+FEATURE_VARIANT_INPUTS = FieldSelection(["title", "pois", "rebuttals", "speeches.sequence_id"])
+
+
+def build_round_features(round, speeches, pois, rebuttals) -> round_db_model.RoundFeatures:
+    """作成中のRoundの特徴量の行を作る（commitは呼び出し側で行う）"""
+    round_data = {
+        "pois": [poi.argument_unit_id for poi in pois],
+        "rebuttals": [{"src": rebuttal.src, "tgt": rebuttal.tgt, "votes": rebuttal.votes} for rebuttal in rebuttals],
+        "speeches": [
+            {"argument_units": [{"sequence_id": au.sequence_id} for au in speech.argument_units]}
+            for speech in speeches
+        ],
+    }
+    return round_db_model.RoundFeatures(
+        round=round, algorithm_version=FEATURE_ALGORITHM_VERSION, **calculate_features(round_data)
+    )
+
+
+# /features/stats用の分布。最初のリクエストで全Roundから作り、以降は書き込みのたびに更新する
+feature_stats = CorpusFeatureStats()
+_feature_stats_lock = asyncio.Lock()
+# 特徴量が似ているRoundの索引。feature_statsが変わっていれば、次の検索のときに作り直す
+similarity_index = SimilarityIndex(feature_stats)
+
+
+def track_round_features(round, round_features: round_db_model.RoundFeatures) -> None:
+    """作成したRoundの特徴量を分布に加える（commitの後に呼ぶ）"""
+    feature_stats.set_round(
+        round.id, {name: getattr(round_features, name) for name in FEATURE_NAMES}, round.tag, round.channel_id
+    )
+
+
+async def get_feature_stats(db: AsyncSession) -> CorpusFeatureStats:
+    """分布が未構築なら全Roundの特徴量から作る
+
+    構築中に行われた作成・削除・タグ変更は、構築後にまとめて反映される
+    """
+    async with _feature_stats_lock:
+        if not feature_stats.loaded:
+            feature_stats.begin_load()
+            try:
+                result = await db.execute(select(
+                    round_db_model.Round.id, round_db_model.Round.tag, round_db_model.Round.channel_id,
+                ))
+                rounds = result.all()
+                features = await load_round_features(db, [round_id for round_id, _, _ in rounds])
+            except BaseException:
+                feature_stats.abort_load()
+                raise
+            feature_stats.finish_load([
+                (round_id, features[round_id], tag, channel_id)
+                for round_id, tag, channel_id in rounds if round_id in features
+            ])
+    return feature_stats
+
+
+async def load_round_features(db: AsyncSession, round_ids: List[int]) -> Dict[int, Dict[str, float]]:
+    """round_featuresから特徴量を読む
+
+    行が無いRound・algorithm_versionが古いRoundだけ、反論・POI・ADUを読んで計算し直して保存する
+    """
+    if not round_ids:
+        return {}
+    rows = await execute_in_chunks(
+        db,
+        select(
+            round_db_model.RoundFeatures.round_id,
+            round_db_model.RoundFeatures.algorithm_version,
+            *[getattr(round_db_model.RoundFeatures, name) for name in FEATURE_NAMES],
+        ),
+        round_db_model.RoundFeatures.round_id, round_ids,
+    )
+    features = {
+        round_id: dict(zip(FEATURE_NAMES, values))
+        for round_id, algorithm_version, *values in rows
+        if algorithm_version == FEATURE_ALGORITHM_VERSION
+    }
+
+    stale_ids = [round_id for round_id in round_ids if round_id not in features]
+    if stale_ids:
+        round_batches = await load_round_batches(
+            db,
+            select_round_rows(FEATURE_INPUTS).where(round_db_model.Round.id.in_(stale_ids)),
+            FEATURE_INPUTS,
+        )
+        # 古い行が多い（マイグレーション直後など）ときもまとめて計算できるよう、バッチ版を使う
+        values = []
+        batch_features = calculate_features_batch([round_data for _, round_data in round_batches])
+        for (round_id, _), round_features in zip(round_batches, batch_features):
+            features[round_id] = round_features
+            values.append({"round_id": round_id, "algorithm_version": FEATURE_ALGORITHM_VERSION, **round_features})
+        if values:
+            statement = insert(round_db_model.RoundFeatures)
+            await db.execute(statement.on_duplicate_key_update(
+                {name: statement.inserted[name] for name in FEATURE_NAMES + ("algorithm_version",)}
+            ), values)
+            await db.commit()
+    return features
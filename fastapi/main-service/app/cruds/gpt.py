@@ -1,12 +1,85 @@
+import os
+from collections import Counter
+from typing import Optional, Type
 from pydantic import BaseModel, Field
 from openai import AsyncOpenAI
 from dotenv import load_dotenv
 from log_config import logger
+from llm_cache import llm_cache, request_key
+from llm_limiter import estimate_tokens
+from llm_policy import call_with_policy
 
 import asyncio
 
 load_dotenv()
-client = AsyncOpenAI()
+client = AsyncOpenAI(max_retries=0)  # リトライはllm_policyで行う
+
+MODEL = "gpt-4o-2024-11-20"
+
+def cache_key(messages: list[dict], response_format: Optional[Type[BaseModel]] = None, **params) -> str:
+    """llm_cacheのキー。リクエスト全体から作る"""
+    request = {"model": MODEL, "messages": messages, **params}
+    if response_format is not None:
+        request["response_format"] = {"name": response_format.__name__, "schema": response_format.model_json_schema()}
+    return request_key(request)
+
+def strict_json_schema(schema):
+    """Structured Outputs（strict）用に、全てのobjectにadditionalProperties: falseをつける"""
+    if isinstance(schema, dict):
+        schema = {key: strict_json_schema(value) for key, value in schema.items()}
+        if schema.get("type") == "object":
+            schema["additionalProperties"] = False
+    elif isinstance(schema, list):
+        schema = [strict_json_schema(value) for value in schema]
+    return schema
+
+def batch_request_body(messages: list[dict], response_format: Optional[Type[BaseModel]] = None, **params) -> dict:
+    """completeと同じリクエストを、バッチAPIの1行のbodyとして作る
+
+    response_formatは、client.beta.chat.completions.parseが送るものと同じjson_schemaをmodel_json_schemaから作る
+    （モデルのフィールドは全て必須なので、requiredはそのままでよい）
+    """
+    body = {"model": MODEL, "messages": messages, **params}
+    if response_format is not None:
+        body["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {
+                "schema": strict_json_schema(response_format.model_json_schema()),
+                "name": response_format.__name__,
+                "strict": True,
+            },
+        }
+    return body
+
+async def complete(messages: list[dict], response_format: Optional[Type[BaseModel]] = None, **params) -> list:
+    """choiceごとの応答（response_formatがあればそのモデル、無ければ文字列）を返す
+
+    リクエスト全体をキーにllm_cacheを引き、同じリクエストならAPIを呼ばない
+    APIを呼ぶときは、llm_limiterで同時実行数・requests/min・tokens/minの上限まで待ち、
+    llm_policyのタイムアウト・リトライ・ヘッジをつける
+    """
+    key = cache_key(messages, response_format, **params)
+
+    contents = await asyncio.to_thread(llm_cache.get, key) if llm_cache else None
+    if contents is None:
+        if response_format is not None:
+            request = lambda: client.beta.chat.completions.parse(
+                model=MODEL, messages=messages, response_format=response_format, **params
+            )
+        else:
+            request = lambda: client.chat.completions.create(model=MODEL, messages=messages, **params)
+        kind = f"{response_format.__name__ if response_format is not None else 'text'} n={params.get('n', 1)}"
+        completion = await call_with_policy(
+            request, kind, estimate_tokens(messages, params.get("n", 1), params.get("max_tokens"))
+        )
+        contents = [choice.message.content for choice in completion.choices]
+        # 拒否された（contentが無い）応答はキャッシュしない
+        if llm_cache and all(content is not None for content in contents):
+            await asyncio.to_thread(llm_cache.put, key, contents)
+
+    if response_format is not None:
+        return [response_format.model_validate_json(content) for content in contents]
+    return contents
 
 class Segment(BaseModel):
     start: float
@@ -29,27 +102,29 @@ class ArgumentUnitMetaData(BaseModel):
 class ArgumentUnitMetaDataList(BaseModel):
     argument_units: list[ArgumentUnitMetaData] = Field(..., description="The list of argument units with metadata.")
 
-# segmentのリストから、各argument_unitの最後のsegmentのidを取得
-async def segment2argument_units(speech: list[Segment]) -> list[int]:
+def segment_messages(speech: list[Segment]) -> list[dict]:
     prompt_segments = ""
     for id, segment in enumerate(speech):
         prompt_segments += f"{id}:{segment.text}\n"
 
-    response = await client.beta.chat.completions.parse(
-        model="gpt-4o-2024-11-20",
-        messages=[
-            {"role": "user", "content": "Regroup the given segments into argumentative units of 1 to 5 segments each and return the list of the first segment's id in each unit. The scheme of output is just a list of indices. YOU MUST NOT RETURN ANYTHING OTHER THAN THE LIST."},
-            {"role": "user", "content": "NO ARGUMENT UNIT CAN HAVE MORE THAN 5 SEGMENTS."},
-            {"role": "user", "content": "Argumentative units are elementary argumentation factors, such as claims, cases, and rebuttals."},
-            {"role": "user", "content": f"Given segments: {prompt_segments}"},
-        ],
+    return [
+        {"role": "user", "content": "Regroup the given segments into argumentative units of 1 to 5 segments each and return the list of the first segment's id in each unit. The scheme of output is just a list of indices. YOU MUST NOT RETURN ANYTHING OTHER THAN THE LIST."},
+        {"role": "user", "content": "NO ARGUMENT UNIT CAN HAVE MORE THAN 5 SEGMENTS."},
+        {"role": "user", "content": "Argumentative units are elementary argumentation factors, such as claims, cases, and rebuttals."},
+        {"role": "user", "content": f"Given segments: {prompt_segments}"},
+    ]
+
+# segmentのリストから、各argument_unitの最後のsegmentのidを取得
+async def segment2argument_units(speech: list[Segment]) -> list[int]:
+    parsed = await complete(
+        messages=segment_messages(speech),
         # response_format=FirstSegmentIds,
         response_format=ArgumentUnitMetaDataList,
     )
 
-    first_seg_ids = [argument_unit.first_segment_id for argument_unit in response.choices[0].message.parsed.argument_units]
-    argument_topics = [argument_unit.argument_topic for argument_unit in response.choices[0].message.parsed.argument_units]
-    reasonings = [argument_unit.reasoning for argument_unit in response.choices[0].message.parsed.argument_units]
+    first_seg_ids = [argument_unit.first_segment_id for argument_unit in parsed[0].argument_units]
+    argument_topics = [argument_unit.argument_topic for argument_unit in parsed[0].argument_units]
+    reasonings = [argument_unit.reasoning for argument_unit in parsed[0].argument_units]
     
     logger.info("argument unit meta data---------------------------------")
     logger.info(f"firstSegIds: {first_seg_ids}")
@@ -104,7 +179,29 @@ class Rebuttal(BaseModel):
 class Rebuttals(BaseModel):
     rebuttals: list[Rebuttal]=Field(..., description="The list of rebuttals in the form of [source_id, target_id].")
 
-async def speeches2rebuttals(pois:list[int], speeches: list[list[Segment]]) -> list[Rebuttal]:
+class RebuttalVote(BaseModel):
+    src: int
+    tgt: int
+    votes: int = 1
+
+# try_num回のサンプルのうち、これ以上のサンプルが返した反論だけを保存する（1なら全て）
+rebuttal_min_votes = int(os.getenv("REBUTTAL_MIN_VOTES", "1"))
+
+def count_votes(rebuttals, threshold: int = 1) -> list[RebuttalVote]:
+    """同じ(src, tgt)の反論を1つにまとめて票数（votesがあればその合計）を数え、threshold票未満の反論を捨てる
+
+    最初に現れた順に並べて返す（migrate_db.compact_rebuttalsと同じ順。interval・orderは反論の順序で値が変わる）
+    """
+    votes = Counter()
+    for rebuttal in rebuttals:
+        votes[(rebuttal.src, rebuttal.tgt)] += getattr(rebuttal, "votes", 1)
+    return [
+        RebuttalVote(src=src, tgt=tgt, votes=count)
+        for (src, tgt), count in votes.items() if count >= threshold
+    ]
+
+def relocate_pois(pois:list[int], speeches: list[list[Segment]]) -> list[list[ArgumentUnit]]:
+    """反論判定用に、POIのargument unitを次のスピーチ（OW/MOのスピーチなら最後のスピーチ）に移す"""
     new_speeches = [[] for _ in range(len(speeches))] #poiを移動させたspeeches
     for i, speech in enumerate(speeches):
         for j, arg_unit in enumerate(speech.argument_units):
@@ -118,27 +215,54 @@ async def speeches2rebuttals(pois:list[int], speeches: list[list[Segment]]) -> l
                     logger.info(f"POI edited for reb: {j}th arg unit is relocated to the next speech i.e. {i+1}th speech: {arg_unit.text}")
                     new_speeches[i+1].append(arg_unit)
     logger.info("NEW_SPEECH"+str(new_speeches))
-
-    rebuttal_speech_pair_ids = []
-    if len(speeches)==6:
-        rebuttal_speech_pair_ids = [(1,0),(2,1),(3,0),(3,2),(4,0),(4,2),(5,1),(5,3),(5,4)]
-    elif len(speeches)==8:
-        rebuttal_speech_pair_ids = [(1,0),(2,1),(3,0),(3,2),(4,1),(4,3),(5,0),(5,2),(5,4),(6,0),(6,2),(6,4),(7,1),(7,3),(7,5),(7,6)]
-    
-    tasks = [
-        argument_units2rebuttals_repeated_combined(pois, new_speeches[pair[0]], new_speeches[pair[1]]) #切り替え
-        for pair in rebuttal_speech_pair_ids
-    ]
-
-    results = await asyncio.gather(*tasks)
+    return new_speeches
+
+def rebuttal_speech_pairs(num_speeches: int) -> list[tuple[int, int]]:
+    """反論を探す(反論元, 反論先)のスピーチの組"""
+    if num_speeches==6:
+        return [(1,0),(2,1),(3,0),(3,2),(4,0),(4,2),(5,1),(5,3),(5,4)]
+    elif num_speeches==8:
+        return [(1,0),(2,1),(3,0),(3,2),(4,1),(4,3),(5,0),(5,2),(5,4),(6,0),(6,2),(6,4),(7,1),(7,3),(7,5),(7,6)]
+    return []
+
+# 失敗したスピーチの組だけを判定し直す回数の上限（1回目を含む）。各呼び出しのリトライはllm_policyが別に行う
+REBUTTAL_PAIR_ATTEMPTS = int(os.getenv("REBUTTAL_PAIR_ATTEMPTS", "2"))
+
+async def speeches2rebuttals(pois:list[int], speeches: list[list[Segment]]) -> list[RebuttalVote]:
+    """全ての(反論元, 反論先)のスピーチの組の反論を判定し、(src, tgt)ごとの票数にまとめて返す
+
+    失敗した組があっても他の組は最後まで待ち、成功した組の結果は残したまま、失敗した組だけを
+    REBUTTAL_PAIR_ATTEMPTS回まで判定し直す（llm_cacheの有無によらない）。それでも失敗すれば最初の例外を投げる
+    """
+    new_speeches = relocate_pois(pois, speeches)
+    rebuttal_speech_pair_ids = rebuttal_speech_pairs(len(speeches))
+    completed = {}  # 成功した組 -> 反論のリスト
+
+    for attempt in range(1, REBUTTAL_PAIR_ATTEMPTS + 1):
+        pending_pairs = [pair for pair in rebuttal_speech_pair_ids if pair not in completed]
+        tasks = [
+            argument_units2rebuttals_repeated_combined(pois, new_speeches[pair[0]], new_speeches[pair[1]]) #切り替え
+            for pair in pending_pairs
+        ]
+
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for pair, result in zip(pending_pairs, results):
+            if not isinstance(result, BaseException):
+                completed[pair] = result
+        failed_pairs = [pair for pair, result in zip(pending_pairs, results) if isinstance(result, BaseException)]
+        if not failed_pairs:
+            break
+        logger.error(f"Rebuttal detection failed for speech pairs {failed_pairs} "
+                     f"({len(completed)}/{len(rebuttal_speech_pair_ids)} succeeded, attempt {attempt}/{REBUTTAL_PAIR_ATTEMPTS})")
+        if attempt == REBUTTAL_PAIR_ATTEMPTS:
+            raise next(result for result in results if isinstance(result, BaseException))
 
     rebuttals=[]
-    for result in results:
-        rebuttals += result
-    
-    sorted_rebuttals = sorted(rebuttals, key=lambda x: (x.src, x.tgt)) # srcの順でソート->srcが同じならtgtの順でソート
+    for pair in rebuttal_speech_pair_ids:
+        rebuttals += completed[pair]
 
-    return sorted_rebuttals
+    # サンプルごとの反論を(src, tgt)ごとの票数にまとめる
+    return count_votes(rebuttals, rebuttal_min_votes)
 
 
 # async def argument_units2rebuttals(src_speech: list[ArgumentUnit], tgt_speech: list[ArgumentUnit]) -> list[Rebuttal]:
@@ -209,7 +333,7 @@ async def speeches2rebuttals(pois:list[int], speeches: list[list[Segment]]) -> l
 #     return rebuttals
 
 # currently used いままでは実はsrc_speech:ArgumentUnitsだった。現在は正しい。
-async def argument_units2rebuttals_repeated_combined(pois:list[int], src_speech: list[ArgumentUnit], tgt_speech: list[ArgumentUnit]) -> list[Rebuttal]:
+def rebuttal_messages(src_speech: list[ArgumentUnit], tgt_speech: list[ArgumentUnit]) -> list[dict]:
     prompt_src = ""
     prompt_tgt = ""
 
@@ -217,31 +341,32 @@ async def argument_units2rebuttals_repeated_combined(pois:list[int], src_speech:
         prompt_src += f"{argument_unit.sequence_id}:{argument_unit.text}\n"
     for argument_unit in tgt_speech:
         prompt_tgt += f"{argument_unit.sequence_id}:{argument_unit.text}\n"
-    
-    completions = await client.beta.chat.completions.parse(
-        model="gpt-4o-2024-11-20",
-        messages=[
-            {"role": "user", "content": "Identify all rebuttals present from the following speech, and return them as a list of tuples in the form of [source_id, target_id]."},
-            {"role": "user", "content": "Each argument unit can rebut to at most one opponent's argument unit."},
-            {"role": "user", "content": "Note that rebuttals are direct response to the opponents, typically starting with rephrasing the opponents' arguments they are focusing on."},
-            {"role": "user", "content": f"Source speech: {prompt_src}"},
-            {"role": "user", "content": f"Target speech: {prompt_tgt}"},
-        ],
+
+    return [
+        {"role": "user", "content": "Identify all rebuttals present from the following speech, and return them as a list of tuples in the form of [source_id, target_id]."},
+        {"role": "user", "content": "Each argument unit can rebut to at most one opponent's argument unit."},
+        {"role": "user", "content": "Note that rebuttals are direct response to the opponents, typically starting with rephrasing the opponents' arguments they are focusing on."},
+        {"role": "user", "content": f"Source speech: {prompt_src}"},
+        {"role": "user", "content": f"Target speech: {prompt_tgt}"},
+    ]
+
+async def argument_units2rebuttals_repeated_combined(pois:list[int], src_speech: list[ArgumentUnit], tgt_speech: list[ArgumentUnit]) -> list[Rebuttal]:
+    choices = await complete(
+        messages=rebuttal_messages(src_speech, tgt_speech),
         n=try_num,
         response_format=Rebuttals,
     )
 
     rebuttals = []
-    for choice in completions.choices:
-        logger.info(choice.message.parsed.rebuttals)
-        for rebuttal in choice.message.parsed.rebuttals:
+    for choice in choices:
+        logger.info(choice.rebuttals)
+        for rebuttal in choice.rebuttals:
             rebuttals.append(rebuttal)
 
     return rebuttals
 
 async def digest2motion(digest: str) -> str:
-    response = await client.chat.completions.create(
-        model="gpt-4o-2024-11-20",
+    contents = await complete(
         messages=[
             {"role": "user", "content": "Given a transcript of a competitive debate round, tell me the motion of this round in the form of This house ..."},
             {"role": "user", "content": "DO NOT RETURN ANYTHING OTHER THAN THE MOTION."},
@@ -249,7 +374,7 @@ async def digest2motion(digest: str) -> str:
         ],
     )
 
-    motion_predicted = response.choices[0].message.content
+    motion_predicted = contents[0]
 
     # result = "<GPT prop> " + motion
 
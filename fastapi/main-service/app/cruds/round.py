@@ -0,0 +1,392 @@
+import hashlib
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import defer, selectinload
+import models.round as round_db_model
+from cruds.gpt import group_consecutive
+from log_config import logger
+
+
+def build_round_summary(round, speeches, pois, rebuttals) -> round_db_model.RoundSummary:
+    """作成中のRoundに対応する集計行を作る（commitは呼び出し側で行う）"""
+    return round_db_model.RoundSummary(
+        round=round,
+        poi_count=len(pois),
+        rebuttal_count=len(rebuttals),
+        speech_count=len(speeches),
+        total_argument_units=sum(len(speech.argument_units) for speech in speeches),
+    )
+
+
+def build_round_speeches(round, speech_creates, poi_segment_ids, segment_results):
+    """GPTが返した各argument unitの先頭segmentのidから、作成中のRoundのSpeech・ArgumentUnit・Poiを作る
+
+    POIのsegmentは必ずそれだけで1つのargument unitになるように区切り直す（commitは呼び出し側で行う）
+    """
+    speeches = []
+    fixed_pois = []
+
+    logger.info(f"segment_results: {segment_results}")
+    logger.info(f"poi_segment_ids: {poi_segment_ids}")
+
+    tmp_segment_id = 0
+    poi_local_ids = [[] for _ in range(len(speech_creates))]
+    for speech_id, speech in enumerate(speech_creates):
+        for local_segment_id, segment in enumerate(speech):
+            if tmp_segment_id in poi_segment_ids:
+                logger.info(f"`POI->{tmp_segment_id}th segment: {segment.text}")
+                poi_local_ids[speech_id].append(local_segment_id)
+            tmp_segment_id += 1
+    
+    logger.info(f"poi_local_ids: {poi_local_ids}")
+
+    sequence_id = 0
+    for idx, first_seg_ids in enumerate(segment_results):
+        logger.info(f"{idx}th speech-----------------")
+        speech_create = speech_creates[idx]
+        argument_units = []
+
+        fixed_arg_heads = first_seg_ids
+
+        poi_arg_units = group_consecutive(poi_local_ids[idx])
+        
+        poi_based_head_pairs = []
+        for poi_arg_unit in poi_arg_units:
+            first_poi_based_head = poi_arg_unit[0]
+            last_poi_based_head = poi_arg_unit[-1]+1
+            poi_based_head_pairs.append((first_poi_based_head, last_poi_based_head))
+            for arg_head in first_seg_ids:
+                if first_poi_based_head < arg_head < last_poi_based_head:
+                    fixed_arg_heads.remove(arg_head)
+        
+        for poi_based_heads in poi_based_head_pairs:
+            if poi_based_heads[0] not in fixed_arg_heads:
+                fixed_arg_heads.append(poi_based_heads[0])
+            if poi_based_heads[1] not in fixed_arg_heads:
+                fixed_arg_heads.append(poi_based_heads[1])
+        
+        fixed_arg_heads.sort()
+
+        logger.info(f"before         : {segment_results[idx]}")
+        logger.info(f"fixed_arg_heads: {fixed_arg_heads}")
+        logger.info(f"poi_based_head_pairs: {poi_based_head_pairs}")
+        
+        for i in range(len(fixed_arg_heads)):
+            first_seg_id = fixed_arg_heads[i]
+
+            if i == len(fixed_arg_heads) - 1:
+                last_seg_id = len(speech_create) - 1
+            elif fixed_arg_heads[i] == fixed_arg_heads[i+1]:
+                last_seg_id = fixed_arg_heads[i]
+            else:
+                last_seg_id = fixed_arg_heads[i+1] - 1
+
+            logger.info(f"len_speech_create: {len(speech_create)} first_seg_id: {first_seg_id}, last_seg_id: {last_seg_id}")
+            
+            segment_texts = [speech_create[j].text.strip() for j in range(first_seg_id, last_seg_id + 1)]
+            plain_text = ' '.join(segment_texts)
+
+            if first_seg_id < 0 or first_seg_id >= len(speech_create) or last_seg_id < 0 or last_seg_id >= len(speech_create):
+                logger.error(f"Index out of range: first_seg_id={first_seg_id}, last_seg_id={last_seg_id}, len_speech_create={len(speech_create)}")
+                continue
+            argument_units.append(
+                round_db_model.ArgumentUnit(
+                    sequence_id=sequence_id,
+                    start=speech_create[first_seg_id].start,
+                    end=speech_create[last_seg_id].end,
+                    text=plain_text,
+                )
+            )
+
+            # fixed_poisへの追加
+            if first_seg_id in [pair[0] for pair in poi_based_head_pairs]: # POIの先頭のsegmentの場合
+                fixed_pois.append(round_db_model.Poi(argument_unit_id=sequence_id, round=round))
+                logger.info(f"This is POI: {sequence_id}, text: {plain_text}")
+
+            sequence_id += 1
+        
+        # スピーチとArgument Unitsをデータベースに保存するためのリストに追加
+        speeches.append(
+            round_db_model.Speech(argument_units=argument_units, round=round)
+        )
+
+    return speeches, fixed_pois
+
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+# cursorもlimitも無い（ページングを使わない古いクライアントの）リクエストの上限
+# 今のコーパスは全件が1ページに収まる。超えた分はX-Next-Cursorで続きを読む。全件が要るときは*-streamを使う
+UNPAGED_MAX_SIZE = 2000
+
+
+def filter_rounds(query, tag=None, channel_id=None, motion=None, uploaded_since=None, uploaded_before=None):
+    """Roundに対する絞り込み条件をWHEREに追加する
+
+    date_uploadedはYouTubeのISO 8601文字列なので、文字列比較で期間を絞り込める
+    """
+    if tag:
+        query = query.where(round_db_model.Round.tag.contains(tag, autoescape=True))
+    if channel_id:
+        query = query.where(round_db_model.Round.channel_id == channel_id)
+    if motion:
+        query = query.where(round_db_model.Round.motion.contains(motion, autoescape=True))
+    if uploaded_since:
+        query = query.where(round_db_model.Round.date_uploaded >= uploaded_since)
+    if uploaded_before:
+        query = query.where(round_db_model.Round.date_uploaded < uploaded_before)
+    return query
+
+
+def page_size(cursor=None, limit=None, unpaged_max_size=UNPAGED_MAX_SIZE):
+    """1ページの件数。cursorもlimitも無ければunpaged_max_size（Noneなら無制限）"""
+    if cursor is None and limit is None:
+        return unpaged_max_size
+    return limit or DEFAULT_PAGE_SIZE
+
+
+def paginate_rounds(query, cursor=None, limit=None, unpaged_max_size=UNPAGED_MAX_SIZE):
+    """Round.idによるkeyset pagination"""
+    query = query.order_by(round_db_model.Round.id)
+    if cursor is not None:
+        query = query.where(round_db_model.Round.id > cursor)
+    size = page_size(cursor, limit, unpaged_max_size)
+    return query if size is None else query.limit(size)
+
+
+def next_cursor(round_ids, cursor=None, limit=None, unpaged_max_size=UNPAGED_MAX_SIZE):
+    """ページが埋まっていれば次ページのcursor（最後のRound.id）を返す"""
+    size = page_size(cursor, limit, unpaged_max_size)
+    if size is None or len(round_ids) < size:
+        return None
+    return round_ids[-1]
+
+
+def bump_round_version(db_round) -> None:
+    """Roundの内容を変更したときに呼ぶ。UPDATE文の中でインクリメントされる"""
+    db_round.version = round_db_model.Round.version + 1
+
+
+async def get_round_version(db: AsyncSession, round_id: int) -> Optional[int]:
+    result = await db.execute(
+        select(round_db_model.Round.version).where(round_db_model.Round.id == round_id)
+    )
+    return result.scalar_one_or_none()
+
+
+async def get_rounds_version(db: AsyncSession, query) -> str:
+    """select(Round.id, Round.version)に絞り込み・ページングを適用したqueryの、(id, version)の組をid順に並べたハッシュ
+
+    作成・削除・編集・絞り込みへの出入りのどれでも変わるので、一覧のETagに使える
+    （件数・最大id・versionの総和だと、出入りしたRoundのversionの差で打ち消し合うことがある）
+    """
+    rounds = query.subquery()
+    result = await db.execute(select(rounds.c.id, rounds.c.version).order_by(rounds.c.id))
+    return rounds_version_hash(result.all())
+
+
+def rounds_version_hash(rows) -> str:
+    """(id, version)の組の列のハッシュ"""
+    digest = hashlib.sha1()
+    for round_id, version in rows:
+        digest.update(f"{round_id}:{version},".encode())
+    return digest.hexdigest()
+
+
+# fields= / exclude= で指定できる項目。speechesの中のADUの項目は "speeches.start" のように指定する
+ROUND_FIELDS = ("video_id", "title", "description", "motion", "date_uploaded", "channel_id", "tag")
+RELATIONSHIP_FIELDS = ("pois", "rebuttals", "speeches")
+ARGUMENT_UNIT_FIELDS = ("sequence_id", "start", "end", "text")
+
+
+class FieldSelection:
+    """レスポンスに含める項目（sparse fieldset）
+
+    指定されなかったRoundの列・ADUの列はDBから読まず、関連テーブルはクエリ自体を発行しない
+    """
+
+    def __init__(self, fields: Optional[List[str]] = None, exclude: Optional[List[str]] = None):
+        if fields is None:
+            round_fields = set(ROUND_FIELDS)
+            relationships = set(RELATIONSHIP_FIELDS)
+            argument_unit_fields = set(ARGUMENT_UNIT_FIELDS)
+        else:
+            round_fields, relationships, argument_unit_fields = set(), set(), set()
+            for field in fields:
+                if field in ROUND_FIELDS:
+                    round_fields.add(field)
+                elif field == "speeches":
+                    relationships.add(field)
+                    argument_unit_fields.update(ARGUMENT_UNIT_FIELDS)
+                elif field in RELATIONSHIP_FIELDS:
+                    relationships.add(field)
+                else:
+                    relationships.add("speeches")
+                    argument_unit_fields.add(self._argument_unit_field(field))
+
+        for field in exclude or []:
+            if field in ROUND_FIELDS:
+                round_fields.discard(field)
+            elif field in RELATIONSHIP_FIELDS:
+                relationships.discard(field)
+            else:
+                argument_unit_fields.discard(self._argument_unit_field(field))
+        if not argument_unit_fields:
+            relationships.discard("speeches")
+        if "speeches" not in relationships:
+            argument_unit_fields = set()
+
+        # 定義順に並べておく（レスポンスのキー順とSELECTの列順になる）
+        self.round_fields = [field for field in ROUND_FIELDS if field in round_fields]
+        self.relationships = [field for field in RELATIONSHIP_FIELDS if field in relationships]
+        self.argument_unit_fields = [field for field in ARGUMENT_UNIT_FIELDS if field in argument_unit_fields]
+
+    @staticmethod
+    def _argument_unit_field(field: str) -> str:
+        prefix, _, name = field.partition(".")
+        if prefix != "speeches" or name not in ARGUMENT_UNIT_FIELDS:
+            raise ValueError(f"Unknown field: {field}")
+        return name
+
+    def includes(self, relationship: str) -> bool:
+        return relationship in self.relationships
+
+
+ALL_FIELDS = FieldSelection()
+
+
+def round_load_options(selection: FieldSelection = ALL_FIELDS) -> list:
+    """ORMでRoundを読むときのdefer・selectinloadのオプション
+
+    除外された列だけをdeferするので、指定が無ければ従来通りid・外部キーなども含めて全て読む
+    """
+    options = [
+        defer(getattr(round_db_model.Round, field))
+        for field in ROUND_FIELDS if field not in selection.round_fields
+    ]
+    if selection.includes("pois"):
+        options.append(selectinload(round_db_model.Round.pois))
+    if selection.includes("rebuttals"):
+        options.append(selectinload(round_db_model.Round.rebuttals))
+    if selection.includes("speeches"):
+        argument_units_loader = selectinload(round_db_model.Round.speeches).selectinload(
+            round_db_model.Speech.argument_units
+        )
+        deferred_argument_unit_fields = [
+            field for field in ARGUMENT_UNIT_FIELDS if field not in selection.argument_unit_fields
+        ]
+        if deferred_argument_unit_fields:
+            argument_units_loader = argument_units_loader.options(*[
+                defer(getattr(round_db_model.ArgumentUnit, field)) for field in deferred_argument_unit_fields
+            ])
+        options.append(argument_units_loader)
+    return options
+
+
+def round_batch_dict(db_round, selection: FieldSelection = ALL_FIELDS) -> Dict:
+    """ORMのRoundからRoundBatchResponse形式のdictを作る。読み込んでいない属性には触れない"""
+    round_data = {field: getattr(db_round, field) for field in selection.round_fields}
+    if selection.includes("pois"):
+        round_data["pois"] = [poi.argument_unit_id for poi in db_round.pois]
+    if selection.includes("rebuttals"):
+        round_data["rebuttals"] = [
+            {"src": rebuttal.src, "tgt": rebuttal.tgt, "votes": rebuttal.votes}
+            for rebuttal in db_round.rebuttals
+        ]
+    if selection.includes("speeches"):
+        round_data["speeches"] = [
+            {"argument_units": [
+                {field: getattr(au, field) for field in selection.argument_unit_fields}
+                for au in speech.argument_units
+            ]} for speech in db_round.speeches
+        ]
+    return round_data
+
+
+# 読み取り専用エンドポイント用。ORMのidentity mapやPydanticを通さず、タプルから直接dictを組み立てる
+
+# selectinloadと同じく、IN句に渡すidは500件ずつに分ける
+IN_CHUNK_SIZE = 500
+
+
+def select_round_rows(selection: FieldSelection = ALL_FIELDS):
+    """load_round_batchesに渡すselect。絞り込み・ページングはこれに適用する"""
+    return select(
+        round_db_model.Round.id,
+        *[getattr(round_db_model.Round, field) for field in selection.round_fields],
+    )
+
+
+async def execute_in_chunks(db: AsyncSession, query, column, ids: List[int]):
+    rows = []
+    for i in range(0, len(ids), IN_CHUNK_SIZE):
+        result = await db.execute(query.where(column.in_(ids[i:i + IN_CHUNK_SIZE])))
+        rows.extend(result.all())
+    return rows
+
+
+async def load_round_batches(db: AsyncSession, query, selection: FieldSelection = ALL_FIELDS) -> List[Tuple[int, Dict]]:
+    """(round_id, RoundBatchResponse形式のdict)のリストを返す
+
+    queryはselect_round_rows(selection)に絞り込みを適用したもの
+    Roundの行を読んだ後、POI・反論・スピーチ・ADUのうちselectionに含まれるものをそれぞれ1本のselectで読む
+    子の並びはselectinloadと同じく主キー順
+    """
+    round_rows = (await db.execute(query)).all()
+    if not round_rows:
+        return []
+
+    rounds = {}
+    for round_id, *values in round_rows:
+        round_data = dict(zip(selection.round_fields, values))
+        for relationship in selection.relationships:
+            round_data[relationship] = []
+        rounds[round_id] = round_data
+    round_ids = list(rounds)
+
+    if selection.includes("pois"):
+        poi_rows = await execute_in_chunks(
+            db,
+            select(round_db_model.Poi.round_id, round_db_model.Poi.argument_unit_id).order_by(round_db_model.Poi.id),
+            round_db_model.Poi.round_id, round_ids,
+        )
+        for round_id, argument_unit_id in poi_rows:
+            rounds[round_id]["pois"].append(argument_unit_id)
+
+    if selection.includes("rebuttals"):
+        rebuttal_rows = await execute_in_chunks(
+            db,
+            select(round_db_model.Rebuttal.round_id, round_db_model.Rebuttal.src, round_db_model.Rebuttal.tgt,
+                   round_db_model.Rebuttal.votes)
+            .order_by(round_db_model.Rebuttal.id),
+            round_db_model.Rebuttal.round_id, round_ids,
+        )
+        for round_id, src, tgt, votes in rebuttal_rows:
+            rounds[round_id]["rebuttals"].append({"src": src, "tgt": tgt, "votes": votes})
+
+    if selection.includes("speeches"):
+        speech_rows = await execute_in_chunks(
+            db,
+            select(round_db_model.Speech.id, round_db_model.Speech.round_id).order_by(round_db_model.Speech.id),
+            round_db_model.Speech.round_id, round_ids,
+        )
+        argument_units_by_speech = {}
+        for speech_id, round_id in speech_rows:
+            argument_units = []
+            argument_units_by_speech[speech_id] = argument_units
+            rounds[round_id]["speeches"].append({"argument_units": argument_units})
+
+        argument_unit_rows = await execute_in_chunks(
+            db,
+            select(
+                round_db_model.ArgumentUnit.speech_id,
+                *[getattr(round_db_model.ArgumentUnit, field) for field in selection.argument_unit_fields],
+            ).join(round_db_model.Speech, round_db_model.Speech.id == round_db_model.ArgumentUnit.speech_id)
+            .order_by(round_db_model.ArgumentUnit.id),
+            round_db_model.Speech.round_id, round_ids,
+        )
+        for speech_id, *values in argument_unit_rows:
+            argument_units_by_speech[speech_id].append(dict(zip(selection.argument_unit_fields, values)))
+
+    return list(rounds.items())
@@ -0,0 +1,96 @@
+import re
+from typing import Dict, List
+from sqlalchemy import select
+from sqlalchemy.dialects.mysql import match
+from sqlalchemy.ext.asyncio import AsyncSession
+import models.round as round_db_model
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+SNIPPET_WIDTH = 160
+
+_TERM_PATTERN = re.compile(r"\w+")
+
+
+def search_terms(q: str) -> List[str]:
+    """検索語を単語に分ける。BOOLEAN MODEの演算子（+ - * " など）はここで落ちる"""
+    return _TERM_PATTERN.findall(q)
+
+
+def make_snippet(text: str, terms: List[str], width: int = SNIPPET_WIDTH) -> str:
+    """最初に検索語が現れる位置の前後width文字程度を切り出す"""
+    lowered = text.lower()
+    positions = [lowered.find(term.lower()) for term in terms]
+    positions = [position for position in positions if position >= 0]
+    start = max(min(positions) - width // 4, 0) if positions else 0
+    end = min(start + width, len(text))
+    snippet = text[start:end].strip()
+    if start > 0:
+        snippet = "…" + snippet
+    if end < len(text):
+        snippet = snippet + "…"
+    return snippet
+
+
+async def search_rounds(db: AsyncSession, q: str, limit: int = DEFAULT_SEARCH_LIMIT) -> List[Dict]:
+    """タイトル・モーションの全文検索（ngramパーサ）。各語をフレーズとして扱うためBOOLEAN MODEで検索する"""
+    terms = search_terms(q)
+    if not terms:
+        return []
+    score = match(
+        round_db_model.Round.title, round_db_model.Round.motion, against=" ".join(terms)
+    ).in_boolean_mode()
+    query = select(
+        round_db_model.Round.id,
+        round_db_model.Round.video_id,
+        round_db_model.Round.title,
+        round_db_model.Round.motion,
+        score.label("score"),
+    ).where(score).order_by(score.desc(), round_db_model.Round.id).limit(limit)
+    result = await db.execute(query)
+    return [
+        {
+            "round_id": round_id,
+            "video_id": video_id,
+            "title": title,
+            "motion": motion,
+            "score": float(row_score),
+        }
+        for round_id, video_id, title, motion, row_score in result.all()
+    ]
+
+
+async def search_argument_units(db: AsyncSession, q: str, limit: int = DEFAULT_SEARCH_LIMIT) -> List[Dict]:
+    """ADUの本文の全文検索。動画のシークに使えるようstart・endとスニペットを返す"""
+    terms = search_terms(q)
+    if not terms:
+        return []
+    score = match(round_db_model.ArgumentUnit.text, against=q).in_natural_language_mode()
+    query = select(
+        round_db_model.Speech.round_id,
+        round_db_model.Round.video_id,
+        round_db_model.Round.title,
+        round_db_model.ArgumentUnit.sequence_id,
+        round_db_model.ArgumentUnit.start,
+        round_db_model.ArgumentUnit.end,
+        round_db_model.ArgumentUnit.text,
+        score.label("score"),
+    ).join(
+        round_db_model.Speech, round_db_model.Speech.id == round_db_model.ArgumentUnit.speech_id
+    ).join(
+        round_db_model.Round, round_db_model.Round.id == round_db_model.Speech.round_id
+    ).where(score).order_by(score.desc(), round_db_model.ArgumentUnit.id).limit(limit)
+    result = await db.execute(query)
+    return [
+        {
+            "round_id": round_id,
+            "video_id": video_id,
+            "title": title,
+            "sequence_id": sequence_id,
+            "start": start,
+            "end": end,
+            "snippet": make_snippet(text, terms),
+            "score": float(row_score),
+        }
+        for round_id, video_id, title, sequence_id, start, end, text, row_score in result.all()
+    ]
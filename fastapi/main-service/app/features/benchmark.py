@@ -0,0 +1,226 @@
+"""
+Macro-Structural Features Benchmark
+
+Times calc_distance, calc_interval, calc_order, calc_rally and calculate_features on seeded
+synthetic rounds over a grid of scales (speech count, ADUs per speech, rebuttal density,
+duplicate-sample rate, POI count), and writes a JSON report that can be diffed between commits.
+
+Run from the app directory:
+    python -m features.benchmark --output bench.json
+    python -m features.benchmark --quick --compare bench.json   # fails if a case got slower
+
+Each case also records a checksum of the feature values, so a change in the results shows up
+in the report next to the change in time.
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import platform
+import random
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from features.macro_structural import (
+    FEATURE_ALGORITHM_VERSION, RoundIndex, calc_distance, calc_interval, calc_order, calc_rally,
+    calculate_features, extract_attacks, group_attacks_by_source,
+)
+
+REPORT_FORMAT = 1
+DEFAULT_SEED = 0
+
+# 各軸の値。全組み合わせを1ケースずつ測る
+SCALES = {
+    "num_speeches": (6, 8),
+    "adus_per_speech": (5, 20, 80),
+    "rebuttal_density": (0.5, 2.0),
+    "repeat_rate": (0.0, 0.5),
+    "num_pois": (0, 5),
+}
+QUICK_SCALES = {
+    "num_speeches": (6, 8),
+    "adus_per_speech": (5, 20),
+    "rebuttal_density": (0.5, 2.0),
+    "repeat_rate": (0.0, 0.5),
+    "num_pois": (2,),
+}
+
+# --compareでこの倍率より遅くなったケースを回帰とみなす
+DEFAULT_REGRESSION_RATIO = 1.5
+
+
+def synthetic_round(rng: random.Random, num_speeches: int, adus_per_speech: int,
+                    rebuttal_density: float, repeat_rate: float, num_pois: int) -> Dict[str, Any]:
+    """
+    Synthetic round in RoundBatchResponse format (sequence_id only)
+
+    Args:
+        num_speeches: Number of speeches (6 or 8 in real rounds)
+        adus_per_speech: Mean number of ADUs per speech (each speech gets 50%-150% of it)
+        rebuttal_density: Distinct rebuttals per ADU
+        repeat_rate: Probability that a stored rebuttal repeats an earlier one, as the
+            10-sample GPT voting does
+        num_pois: Number of ADUs marked as POIs
+    """
+    speeches = []
+    sequence_id = 0
+    for _ in range(num_speeches):
+        num_adus = max(1, round(adus_per_speech * rng.uniform(0.5, 1.5)))
+        speeches.append({"argument_units": [{"sequence_id": sequence_id + i} for i in range(num_adus)]})
+        sequence_id += num_adus
+    num_adus = sequence_id
+
+    attacks = []
+    for _ in range(round(num_adus * rebuttal_density)):
+        if attacks and rng.random() < repeat_rate:
+            attacks.append(rng.choice(attacks))
+            continue
+        src = rng.randrange(1, num_adus)
+        # 実際の反論はほとんど前の発言へ向かう
+        tgt = rng.randrange(src) if rng.random() < 0.9 else rng.randrange(num_adus)
+        attacks.append((src, tgt))
+
+    return {
+        "speeches": speeches,
+        "pois": rng.sample(range(num_adus), k=min(num_adus, num_pois)),
+        "rebuttals": [{"src": src, "tgt": tgt} for src, tgt in attacks],
+    }
+
+
+def scale_cases(scales: Dict[str, tuple]) -> List[Dict[str, Any]]:
+    names = list(scales)
+    return [dict(zip(names, values)) for values in itertools.product(*(scales[name] for name in names))]
+
+
+def case_name(case: Dict[str, Any]) -> str:
+    return "speeches={num_speeches} adus={adus_per_speech} density={rebuttal_density} " \
+           "repeat={repeat_rate} pois={num_pois}".format(**case)
+
+
+def prepare(round_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Inputs of the calc_* functions, built the same way as calculate_features"""
+    attacks = extract_attacks(round_data)
+    index = RoundIndex(round_data)
+    att_src_by_speech = group_attacks_by_source(index, attacks)
+    return {
+        "round_data": round_data,
+        "attacks": attacks,
+        "index": index,
+        "att_src_by_speech": att_src_by_speech,
+        "len_att_src_by_speech": [len(atts) for atts in att_src_by_speech],
+    }
+
+
+FUNCTIONS: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+    "calc_distance": lambda p: calc_distance(p["round_data"], p["attacks"], p["len_att_src_by_speech"], index=p["index"]),
+    "calc_interval": lambda p: calc_interval(p["att_src_by_speech"], p["index"].len_adu_by_speech),
+    "calc_order": lambda p: calc_order(p["att_src_by_speech"], p["attacks"], p["index"].poi_adus),
+    "calc_rally": lambda p: calc_rally(p["attacks"], p["index"].num_speeches),
+    "calculate_features": lambda p: calculate_features(p["round_data"]),
+}
+
+
+def time_function(function: Callable, prepared: List[Dict[str, Any]], repeat: int) -> float:
+    """Best of repeat runs over all rounds, in microseconds per round"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for p in prepared:
+            function(p)
+        best = min(best, time.perf_counter() - start)
+    return best / len(prepared) * 1e6
+
+
+def features_checksum(prepared: List[Dict[str, Any]]) -> str:
+    values = [calculate_features(p["round_data"]) for p in prepared]
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def run_benchmark(scales: Dict[str, tuple], rounds_per_case: int, repeat: int,
+                  seed: int = DEFAULT_SEED, log: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    cases = []
+    for case in scale_cases(scales):
+        name = case_name(case)
+        # ケースごとに種を決めるので、軸の値を増減しても他のケースのラウンドは変わらない
+        rng = random.Random(f"{seed} {name}")
+        prepared = [prepare(synthetic_round(rng, **case)) for _ in range(rounds_per_case)]
+        timings = {function_name: time_function(function, prepared, repeat) for function_name, function in FUNCTIONS.items()}
+        cases.append({
+            "name": name,
+            "params": case,
+            "mean_adus": sum(sum(p["index"].len_adu_by_speech) for p in prepared) / len(prepared),
+            "mean_rebuttals": sum(len(p["attacks"]) for p in prepared) / len(prepared),
+            "us_per_round": {function_name: round(value, 3) for function_name, value in timings.items()},
+            "checksum": features_checksum(prepared),
+        })
+        if log:
+            log(f"{name}: " + ", ".join(f"{function_name} {value:.1f}us" for function_name, value in timings.items()))
+    return {
+        "format": REPORT_FORMAT,
+        "algorithm_version": FEATURE_ALGORITHM_VERSION,
+        "python": platform.python_version(),
+        "seed": seed,
+        "rounds_per_case": rounds_per_case,
+        "repeat": repeat,
+        "cases": cases,
+    }
+
+
+def compare_reports(baseline: Dict[str, Any], report: Dict[str, Any],
+                    ratio: float = DEFAULT_REGRESSION_RATIO) -> List[str]:
+    """Cases and functions that got slower than ratio times the baseline, or whose results changed"""
+    baseline_cases = {case["name"]: case for case in baseline["cases"]}
+    problems = []
+    for case in report["cases"]:
+        base = baseline_cases.get(case["name"])
+        if base is None:
+            continue
+        same_rounds = all(baseline.get(key) == report[key] for key in ("seed", "rounds_per_case"))
+        if same_rounds and base.get("checksum") != case["checksum"]:
+            problems.append(f"{case['name']}: feature values changed")
+        for function_name, value in case["us_per_round"].items():
+            base_value = base["us_per_round"].get(function_name)
+            if base_value and value > base_value * ratio:
+                problems.append(f"{case['name']}: {function_name} {base_value:.1f}us -> {value:.1f}us "
+                                f"(x{value / base_value:.2f})")
+    return problems
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the macro-structural feature functions")
+    parser.add_argument("--output", help="JSONレポートの保存先（省略時は標準出力）")
+    parser.add_argument("--quick", action="store_true", help="小さいケースだけを少ない回数で測る")
+    parser.add_argument("--rounds", type=int, help="1ケースあたりのラウンド数")
+    parser.add_argument("--repeat", type=int, help="測定の繰り返し回数（最小値を使う）")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--compare", help="比較するベースラインのレポート")
+    parser.add_argument("--ratio", type=float, default=DEFAULT_REGRESSION_RATIO, help="回帰とみなす倍率")
+    args = parser.parse_args()
+
+    scales = QUICK_SCALES if args.quick else SCALES
+    rounds_per_case = args.rounds or (10 if args.quick else 50)
+    repeat = args.repeat or (3 if args.quick else 5)
+    report = run_benchmark(scales, rounds_per_case, repeat, seed=args.seed,
+                           log=lambda line: print(line, file=sys.stderr))
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        problems = compare_reports(baseline, report, args.ratio)
+        for problem in problems:
+            print(f"REGRESSION {problem}", file=sys.stderr)
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,8 +8,63 @@ This module implements algorithms to calculate four macro-structural features of
 4. Order: Measures crossing patterns of rebuttals from same speech
 """
 
-from typing import Dict, Any, List, Tuple
-from itertools import combinations
+from typing import Dict, Any, List, Optional, Tuple
+from collections import Counter, defaultdict
+
+# 計算結果が変わる修正をしたら上げる。round_featuresに保存した古い値は読むときに計算し直される
+# 2: 重複した反論をvotesにまとめた（反論が最初に現れた順に並ぶ）ので、保存済みの値を計算し直す
+FEATURE_ALGORITHM_VERSION = 2
+
+
+class RoundIndex:
+    """Per-round lookup tables for ADU positions, built once and shared by all feature functions
+
+    Attributes:
+        num_speeches: Number of speeches
+        len_adu_by_speech: Number of ADUs in each speech
+        speech_of: sequence_id -> index of the first speech containing it (same as l_func)
+        speeches_of: sequence_id -> indices of every speech containing it
+        ordinal: sequence_id -> position of the ADU within its speech
+        poi_adus: Set of POI ADU IDs
+    """
+
+    def __init__(self, round_data: Dict[str, Any]):
+        self.num_speeches = len(round_data["speeches"])
+        self.len_adu_by_speech = []
+        self.speech_of = {}
+        self.speeches_of = {}
+        self.ordinal = {}
+        for speech_idx, speech in enumerate(round_data["speeches"]):
+            self.len_adu_by_speech.append(len(speech["argument_units"]))
+            for ordinal, au in enumerate(speech["argument_units"]):
+                adu_id = au["sequence_id"]
+                if adu_id not in self.speech_of:
+                    self.speech_of[adu_id] = speech_idx
+                    self.ordinal[adu_id] = ordinal
+                speeches = self.speeches_of.setdefault(adu_id, [])
+                if not speeches or speeches[-1] != speech_idx:
+                    speeches.append(speech_idx)
+        self.poi_adus = frozenset(round_data["pois"])
+
+    def speech_id(self, adu_id: int) -> int:
+        """Same as l_func(round_data, adu_id)["speech_id"]"""
+        try:
+            return self.speech_of[adu_id]
+        except KeyError:
+            raise ValueError(f"ADU ID {adu_id} not found in round data") from None
+
+    def is_poi(self, adu_id: int) -> bool:
+        return adu_id in self.poi_adus
+
+
+def extract_attacks(round_data: Dict[str, Any]) -> List[Tuple[int, int]]:
+    """
+    Attacks of a round as (src, tgt) tuples
+    
+    A rebuttal stored once with votes=k (k of the sampled GPT answers found it) counts k times,
+    exactly as the k duplicate rows stored before votes were aggregated
+    """
+    return [(reb["src"], reb["tgt"]) for reb in round_data["rebuttals"] for _ in range(reb.get("votes", 1))]
 
 
 def l_func(round_data: Dict[str, Any], adu_id: int) -> Dict[str, Any]:
@@ -22,7 +77,8 @@ def l_func(round_data: Dict[str, Any], adu_id: int) -> Dict[str, Any]:
 
 
 def calc_distance(round_data: Dict[str, Any], attacks: List[Tuple[int, int]], 
-                 len_att_src_by_speech: List[int], version: int = 1) -> float:
+                 len_att_src_by_speech: List[int], version: int = 1,
+                 index: Optional[RoundIndex] = None) -> float:
     """
     Calculate Distance feature (Far Rebuttal)
     
@@ -31,16 +87,19 @@ def calc_distance(round_data: Dict[str, Any], attacks: List[Tuple[int, int]],
         attacks: List of attack tuples (src, dst)
         len_att_src_by_speech: Number of attacks from each speech
         version: Algorithm version
+        index: Precomputed RoundIndex of round_data (built here if omitted)
         
     Returns:
         Distance score as float
     """
-    slen = len(round_data["speeches"])
+    if index is None:
+        index = RoundIndex(round_data)
+    slen = index.num_speeches
     fs_far = {"speech": {"len": [0] * slen}, "round": {"len": 0, "ratio": 0}}
     
     for src, dst in attacks:
-        src_speech_id = l_func(round_data, src)["speech_id"]
-        dst_speech_id = l_func(round_data, dst)["speech_id"]
+        src_speech_id = index.speech_id(src)
+        dst_speech_id = index.speech_id(dst)
         dist = src_speech_id - dst_speech_id
         
         if dist >= 3 or (src_speech_id != slen - 2 and dist >= 2):
@@ -64,103 +123,139 @@ def calc_distance(round_data: Dict[str, Any], attacks: List[Tuple[int, int]],
     return distance_value
 
 
-def calc_interval(att_src_by_speech: List[List[Tuple[int, int]]], 
-                 len_adu_by_speech: List[int], version: int = 1) -> float:
+def interval_groups(att_src_by_speech: List[List[Tuple[int, int]]],
+                    len_adu_by_speech: List[int]) -> List[Tuple[int, int, int]]:
     """
-    Calculate Interval feature
+    Targets attacked more than once from the same speech, shared by every interval version
     
-    Args:
-        att_src_by_speech: Attacks grouped by source speech
-        len_adu_by_speech: Number of ADUs in each speech
-        version: Normalization update
-            1: simple normalization
-            2: minimum interval considered
-        
     Returns:
-        Sum of normalized intervals
+        (sum of intervals, number of attacks, speech length) per target, in speech order and
+        then in order of the target's first attack
     """
-    att_dst_adu_src = []
-    tmp_att_dst_adu_src = {}
-    
-    for atts in att_src_by_speech:
+    groups = []
+    for j, atts in enumerate(att_src_by_speech):
+        att_dst_adu_src = {}
         for att in atts:
-            if att[1] in tmp_att_dst_adu_src:
-                tmp_att_dst_adu_src[att[1]].append(att)
-            else:
-                tmp_att_dst_adu_src[att[1]] = [att]
-                
-        tmp_att_dst_adu_src = {key: value for key, value in tmp_att_dst_adu_src.items() if len(value) > 1}
-        tmp_att_dst_adu_src = list(tmp_att_dst_adu_src.values())
-        att_dst_adu_src.append(tmp_att_dst_adu_src)
-        tmp_att_dst_adu_src = {}
+            att_dst_adu_src.setdefault(att[1], []).append(att)
+        for att in att_dst_adu_src.values():
+            if len(att) > 1:
+                tmp_x = att[-1][0] - att[0][0] - 1  # スピーチ内の間隔の総和
+                groups.append((tmp_x, len(att), len_adu_by_speech[j]))
+    return groups
+
 
+def interval_from_groups(groups: List[Tuple[int, int, int]], version: int = 1) -> float:
+    """Normalize and sum the output of interval_groups"""
     intervals_normalized = []
     
-    for j, atts in enumerate(att_dst_adu_src):
-        speech_len = len_adu_by_speech[j]
+    for tmp_x, att_len, speech_len in groups:
+        if version == 1:
+            # intervals_normalized2 (シンプルな正規化)
+            if speech_len > 2:
+                intervals_normalized.append(tmp_x / (speech_len - 2))
         
-        for att in atts:
-            tmp_x = att[-1][0] - att[0][0] - 1  # スピーチ内の間隔の総和
-            
-            if version == 1:
-                # intervals_normalized2 (シンプルな正規化)
-                if speech_len > 2:
-                    intervals_normalized.append(tmp_x / (speech_len - 2))
-            
-            elif version == 2:
-                # intervals_normalized (最小間隔を考慮した正規化)
-                tmp_min = len(att) - 2  # 最小可能間隔
-                tmp_max = speech_len - len(att)  # 最大可能間隔
-                if tmp_max != 0:
-                    intervals_normalized.append((tmp_x - tmp_min) / tmp_max)
-                else:
-                    intervals_normalized.append(0)
-            
+        elif version == 2:
+            # intervals_normalized (最小間隔を考慮した正規化)
+            tmp_min = att_len - 2  # 最小可能間隔
+            tmp_max = speech_len - att_len  # 最大可能間隔
+            if tmp_max != 0:
+                intervals_normalized.append((tmp_x - tmp_min) / tmp_max)
             else:
-                raise ValueError("Invalid version for interval calculation.")
+                intervals_normalized.append(0)
+        
+        else:
+            raise ValueError("Invalid version for interval calculation.")
     
     # 最終結果は総和（平均ではない）
     return sum(intervals_normalized)
 
 
-def calc_order(att_src_by_speech: List[List[Tuple[int, int]]], 
-              attacks: List[Tuple[int, int]], poi_adus: List[int],
-              version: int = 1) -> float:
+def calc_interval(att_src_by_speech: List[List[Tuple[int, int]]], 
+                 len_adu_by_speech: List[int], version: int = 1) -> float:
     """
-    Calculate Order feature
+    Calculate Interval feature
     
     Args:
         att_src_by_speech: Attacks grouped by source speech
-        attacks: List of all attack tuples
-        poi_adus: List of POI ADU IDs
-        version: Algorithm version
+        len_adu_by_speech: Number of ADUs in each speech
+        version: Normalization update
+            1: simple normalization
+            2: minimum interval considered
         
     Returns:
-        Order score (inverse of correspondence ratio)
+        Sum of normalized intervals
+    """
+    return interval_from_groups(interval_groups(att_src_by_speech, len_adu_by_speech), version)
+
+
+def count_inversions(values: List[int]) -> int:
+    """Number of pairs i < j with values[i] > values[j], counted with a Fenwick tree in O(k log k)"""
+    ranks = {value: rank for rank, value in enumerate(sorted(set(values)), 1)}
+    tree = [0] * (len(ranks) + 1)
+    inversions = 0
+    for seen, value in enumerate(values):
+        # 先に現れた値のうちvalue以下のものを数える
+        i = ranks[value]
+        not_greater = 0
+        while i > 0:
+            not_greater += tree[i]
+            i -= i & -i
+        inversions += seen - not_greater
+        i = ranks[value]
+        while i < len(tree):
+            tree[i] += 1
+            i += i & -i
+    return inversions
+
+
+def count_shared_pairs(counts: Counter) -> int:
+    """Number of pairs sharing the same key"""
+    return sum(n * (n - 1) // 2 for n in counts.values())
+
+
+def order_pair_counts(att_src_by_speech: List[List[Tuple[int, int]]],
+                      attacks: List[Tuple[int, int]], poi_adus: List[int]) -> Tuple[int, int, int, int]:
+    """
+    Pair counts shared by every order version
+    
+    Pairs of attacks from the same speech (POI attacks excluded) are counted without
+    enumerating them:
+        src_shared: pairs with the same source
+        dst_shared: pairs with the same target but different sources
+        crossed: pairs (earlier, later) with different sources whose targets are in reverse order,
+                 i.e. inversions of the target sequence minus inversions within each source
+    
+    Returns:
+        (number of non-POI attacks, src_shared, dst_shared, crossed)
     """
+    poi_adus = set(poi_adus)
+    
     # POI attacks
-    atts_from_POI = []
-    for att in attacks:
-        if att[0] in poi_adus:
-            atts_from_POI.append(att)
+    num_atts_from_POI = sum(1 for att in attacks if att[0] in poi_adus)
     
-    # スピーチごとに反論の組を列挙
     reb_src_shared = 0
     reb_dst_shared = 0
     reb_crossed = 0
     
-    for i, att_s in enumerate(att_src_by_speech):
-        for att_pair in combinations(att_s, 2):
-            if att_pair[0][0] in poi_adus or att_pair[1][0] in poi_adus:  # POI絡みの反論は除外
-                continue
-            elif att_pair[0][0] == att_pair[1][0]:
-                reb_src_shared += 1
-            elif att_pair[0][1] == att_pair[1][1]:
-                reb_dst_shared += 1
-            elif att_pair[0][1] > att_pair[1][1]:  # 完全に交差する条件
-                reb_crossed += 1
-    
-    reb_num = len(attacks) - len(atts_from_POI)
+    for att_s in att_src_by_speech:
+        atts = [att for att in att_s if att[0] not in poi_adus]  # POI絡みの反論は除外
+        dsts_by_src = defaultdict(list)
+        for src, dst in atts:
+            dsts_by_src[src].append(dst)
+        
+        reb_src_shared += count_shared_pairs(Counter(src for src, _ in atts))
+        reb_dst_shared += count_shared_pairs(Counter(dst for _, dst in atts)) - count_shared_pairs(Counter(atts))
+        # 完全に交差する条件（反論元が同じ組は除く）
+        reb_crossed += count_inversions([dst for _, dst in atts]) - sum(
+            count_inversions(dsts) for dsts in dsts_by_src.values()
+        )
+    
+    return len(attacks) - num_atts_from_POI, reb_src_shared, reb_dst_shared, reb_crossed
+
+
+def order_from_counts(counts: Tuple[int, int, int, int], version: int = 1) -> float:
+    """Order score from the output of order_pair_counts"""
+    reb_num, reb_src_shared, reb_dst_shared, reb_crossed = counts
     
     if reb_num == 0 or (reb_src_shared + reb_crossed) == 0:
         return -1.0
@@ -179,24 +274,38 @@ def calc_order(att_src_by_speech: List[List[Tuple[int, int]]],
     return order_value
 
 
-def filter_rally(arrays_list):
-    """Filter rally duplicates"""
-    if not arrays_list:
-        return []
+def calc_order(att_src_by_speech: List[List[Tuple[int, int]]], 
+              attacks: List[Tuple[int, int]], poi_adus: List[int],
+              version: int = 1) -> float:
+    """
+    Calculate Order feature
     
-    rev = list(reversed(arrays_list))
-    result = rev[0]  # 最長ターンは確定で採用
-    for i in range(1, len(arrays_list)):
-        for rally in rev[i]:
-            if not any(all(item in condition for item in rally) for condition in result):
-                result.append(rally)
-    return result
+    Args:
+        att_src_by_speech: Attacks grouped by source speech
+        attacks: List of all attack tuples
+        poi_adus: POI ADU IDs
+        version: Algorithm version
+        
+    Returns:
+        Order score (inverse of correspondence ratio)
+    """
+    return order_from_counts(order_pair_counts(att_src_by_speech, attacks, poi_adus), version)
 
 
 def calc_rally(attacks: List[Tuple[int, int]], num_speeches: int, version: int = 1) -> float:
     """
     Calculate Rally feature
     
+    A rally is a chain of attacks where each attack targets the source of the next one and
+    every attack but the last points backwards (tgt < src). The score counts, for each chain,
+    its length minus one over:
+        - every chain of the maximum length, once per combination of repeated attacks
+        - every distinct shorter chain that cannot be extended at either end
+    Chains are counted by dynamic programming over source ADUs in ascending order
+    (backward attacks always point to a smaller ADU, so the attack graph is a DAG)
+    instead of being enumerated, which gives the same value as the original enumeration
+    kept in macro_structural_reference.calc_rally.
+    
     Args:
         attacks: List of attack tuples (src, dst)
         num_speeches: Number of speeches
@@ -208,50 +317,53 @@ def calc_rally(attacks: List[Tuple[int, int]], num_speeches: int, version: int =
     if not attacks:
         return 0.0
     
-    att_rally_lists = []
-    att_2_list = []
-    
-    # Find 2-attack rallies
-    for att1 in reversed(attacks):
-        for att2 in [att_dst_candidate for att_dst_candidate in reversed(attacks) if att_dst_candidate[0] < att1[0]]:
-            if att1[1] == att2[0]:
-                att_2_list.append([att1, att2])
-    
-    att_rally_lists.append(att_2_list)
-    
-    # Extend to longer rallies
-    att_n_list = [0]
-    while len(att_n_list) > 0:
-        att_n_list = []
-        for rally in reversed(att_rally_lists[-1]):
-            for att_dst in [att_dst_candidate for att_dst_candidate in reversed(attacks) if att_dst_candidate[0] < rally[-1][0]]:
-                if rally[-1][1] == att_dst[0]:
-                    att_n_list.append(rally + [att_dst])
-        if len(att_n_list) > 0:
-            att_rally_lists.append(att_n_list)
-    
-    # Filter rallies to remove duplicates
-    att_rally_lists_filtered = filter_rally(att_rally_lists)
-    
-    if not att_rally_lists_filtered:
-        return 0.0
-    
-    # ノーラリー（単体の反論）も含めて全反論をカバー
-    att_noRally_list = [[att] for att in attacks if not any(att in att_list for att_list in att_rally_lists_filtered)]
-    raw_list = list(reversed(att_rally_lists_filtered + att_noRally_list))
+    # Adjacency index over distinct attacks, with how many times each attack was stored
+    out_edges = defaultdict(list)
+    backward_targets = set()
+    for (src, dst), multiplicity in Counter(attacks).items():
+        out_edges[src].append((dst, multiplicity))
+        if dst < src:
+            backward_targets.add(dst)
+    
+    # For each source ADU, chains starting there by length (index 0 = one attack):
+    #   weighted: all chains, counted once per combination of repeated attacks
+    #   maximal: distinct chains that cannot be extended at the end
+    weighted = {}
+    maximal = {}
+    for src in sorted(out_edges):
+        src_weighted = [0]
+        src_maximal = [0]
+        for dst, multiplicity in out_edges[src]:
+            src_weighted[0] += multiplicity
+            if dst < src and dst in out_edges:
+                # 後ろ向きの反論の先から続くラリーを1つずつ延ばす
+                dst_weighted = weighted[dst]
+                dst_maximal = maximal[dst]
+                if len(src_weighted) <= len(dst_weighted):
+                    src_weighted.extend([0] * (len(dst_weighted) + 1 - len(src_weighted)))
+                    src_maximal.extend([0] * (len(dst_maximal) + 1 - len(src_maximal)))
+                for length, count in enumerate(dst_weighted):
+                    src_weighted[length + 1] += multiplicity * count
+                for length, count in enumerate(dst_maximal):
+                    src_maximal[length + 1] += count
+            else:
+                src_maximal[0] += 1
+        weighted[src] = src_weighted
+        maximal[src] = src_maximal
     
-    if not raw_list:
+    max_rally_len = max(len(counts) for counts in weighted.values())
+    if max_rally_len < 2:
         return 0.0
-        
-    # 最大ラリー長を計算
-    max_rally_len = max(len(rally_content) for rally_content in raw_list) if raw_list else 1
-    rally_grouped_by_len = [[] for _ in range(max_rally_len)]
     
-    for rally_content in raw_list:
-        rally_grouped_by_len[len(rally_content) - 1].append(rally_content)
-    
-    rally_len_list_grouped = [len(sublist) for sublist in rally_grouped_by_len]
-    total_rally = sum(rally_len_list_grouped[i] * i for i in range(len(rally_len_list_grouped)))
+    total_rally = (max_rally_len - 1) * sum(
+        counts[max_rally_len - 1] for counts in weighted.values() if len(counts) == max_rally_len
+    )
+    # Shorter chains must also not be extendable at the front, i.e. start at an ADU no backward attack targets
+    for src, counts in maximal.items():
+        if src in backward_targets:
+            continue
+        for length in range(1, min(len(counts), max_rally_len - 1)):
+            total_rally += length * counts[length]
     
     num_rebuttals = len(attacks)
     
@@ -266,6 +378,19 @@ def calc_rally(attacks: List[Tuple[int, int]], num_speeches: int, version: int =
     return rally_value
 
 
+def group_attacks_by_source(index: RoundIndex, attacks: List[Tuple[int, int]]) -> List[List[Tuple[int, int]]]:
+    """
+    Group attacks by source speech
+    
+    An ADU listed in several speeches counts for each of them, as the original nested scan did
+    """
+    att_src_by_speech = [[] for _ in range(index.num_speeches)]
+    for src, dst in attacks:
+        for speech_idx in index.speeches_of.get(src, ()):
+            att_src_by_speech[speech_idx].append((src, dst))
+    return att_src_by_speech
+
+
 def calculate_features(round_data: Dict[str, Any]) -> Dict[str, float]:
     """
     Calculate all four macro-structural features for a debate round
@@ -277,7 +402,7 @@ def calculate_features(round_data: Dict[str, Any]) -> Dict[str, float]:
         Dictionary with feature scores
     """
     # Extract attacks (rebuttals) from round data
-    attacks = [(reb["src"], reb["tgt"]) for reb in round_data["rebuttals"]]
+    attacks = extract_attacks(round_data)
     
     if not attacks:
         return {
@@ -287,48 +412,29 @@ def calculate_features(round_data: Dict[str, Any]) -> Dict[str, float]:
             "rally": 0.0
         }
     
-    # Get POI ADU IDs
-    poi_adus = round_data["pois"]
-    
-    # Get number of speeches
-    num_speeches = len(round_data["speeches"])
-    
-    # Group attacks by source speech
-    att_src_by_speech = [[] for _ in range(num_speeches)]
-    len_att_src_by_speech = [0] * num_speeches
-    len_adu_by_speech = []
-    
-    # Calculate ADUs per speech and group attacks
-    for speech_idx, speech in enumerate(round_data["speeches"]):
-        len_adu_by_speech.append(len(speech["argument_units"]))
-        
-    for src, dst in attacks:
-        # Find source speech
-        for speech_idx, speech in enumerate(round_data["speeches"]):
-            for au in speech["argument_units"]:
-                if au["sequence_id"] == src:
-                    att_src_by_speech[speech_idx].append((src, dst))
-                    len_att_src_by_speech[speech_idx] += 1
-                    break
+    # Build the ADU index once; every feature below looks positions up in it
+    index = RoundIndex(round_data)
+    att_src_by_speech = group_attacks_by_source(index, attacks)
+    len_att_src_by_speech = [len(atts) for atts in att_src_by_speech]
     
     # Calculate features
     try:
-        distance = calc_distance(round_data, attacks, len_att_src_by_speech)
+        distance = calc_distance(round_data, attacks, len_att_src_by_speech, index=index)
     except Exception:
         distance = 0.0
         
     try:
-        interval = calc_interval(att_src_by_speech, len_adu_by_speech)
+        interval = calc_interval(att_src_by_speech, index.len_adu_by_speech)
     except Exception:
         interval = 0.0
         
     try:
-        order = calc_order(att_src_by_speech, attacks, poi_adus)
+        order = calc_order(att_src_by_speech, attacks, index.poi_adus)
     except Exception:
         order = -1.0
         
     try:
-        rally = calc_rally(attacks, num_speeches)
+        rally = calc_rally(attacks, index.num_speeches)
     except Exception:
         rally = 0.0
     
@@ -337,4 +443,64 @@ def calculate_features(round_data: Dict[str, Any]) -> Dict[str, float]:
         "interval": interval,
         "order": order,
         "rally": rally
-    }
\ No newline at end of file
+    }
+
+
+INTERVAL_VERSIONS = (1, 2)
+ORDER_VERSIONS = (1, 2, 3, 4)
+
+
+def calculate_feature_variants(round_data: Dict[str, Any]) -> Dict[str, float]:
+    """
+    Calculate every version of the features in one pass
+    
+    The grouping, the interval groups and the order pair counts are computed once and
+    normalized for each version, so this costs about the same as calculate_features.
+    
+    Args:
+        round_data: Round data in RoundBatchResponse format
+        
+    Returns:
+        Dictionary with "distance", "rally", "interval_v1", "interval_v2" and "order_v1" to "order_v4"
+        (the default versions equal calculate_features)
+    """
+    attacks = extract_attacks(round_data)
+    
+    if not attacks:
+        variants = {"distance": 0.0, "rally": 0.0}
+        variants.update({f"interval_v{version}": 0.0 for version in INTERVAL_VERSIONS})
+        variants.update({f"order_v{version}": -1.0 for version in ORDER_VERSIONS})
+        return variants
+    
+    index = RoundIndex(round_data)
+    att_src_by_speech = group_attacks_by_source(index, attacks)
+    len_att_src_by_speech = [len(atts) for atts in att_src_by_speech]
+    
+    variants = {}
+    try:
+        variants["distance"] = calc_distance(round_data, attacks, len_att_src_by_speech, index=index)
+    except Exception:
+        variants["distance"] = 0.0
+    
+    try:
+        groups = interval_groups(att_src_by_speech, index.len_adu_by_speech)
+        for version in INTERVAL_VERSIONS:
+            variants[f"interval_v{version}"] = interval_from_groups(groups, version)
+    except Exception:
+        for version in INTERVAL_VERSIONS:
+            variants[f"interval_v{version}"] = 0.0
+    
+    try:
+        counts = order_pair_counts(att_src_by_speech, attacks, index.poi_adus)
+        for version in ORDER_VERSIONS:
+            variants[f"order_v{version}"] = order_from_counts(counts, version)
+    except Exception:
+        for version in ORDER_VERSIONS:
+            variants[f"order_v{version}"] = -1.0
+    
+    try:
+        variants["rally"] = calc_rally(attacks, index.num_speeches)
+    except Exception:
+        variants["rally"] = 0.0
+    
+    return variants
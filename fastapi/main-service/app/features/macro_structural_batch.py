@@ -0,0 +1,354 @@
+"""
+Batch Macro-Structural Features Calculator
+
+Computes the features of many rounds at once. Rounds are flattened into CSR-style arrays
+(RoundArrays) and distance, interval and order are computed with NumPy segment operations
+(bincount, lexsort, repeat) over the whole batch instead of Python loops per round.
+Rally is computed per round with the DAG dynamic programming of macro_structural.calc_rally.
+
+Results are identical to calculate_features / calc_distance / calc_interval / calc_order,
+including the order in which interval terms are summed.
+"""
+
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from features.macro_structural import calc_rally, extract_attacks
+
+
+class RoundArrays:
+    """
+    Flat arrays describing many rounds
+
+    Attributes:
+        attack_offsets: (R+1,) attacks of round r are attack_offsets[r]:attack_offsets[r+1]
+        src, tgt: (A,) ADU sequence ids of each attack
+        src_speech, tgt_speech: (A,) first speech (within the round) containing the ADU, -1 if not found
+        src_is_poi: (A,) whether the source ADU is a POI
+        speech_offsets: (R+1,) speeches of round r are speech_offsets[r]:speech_offsets[r+1]
+        adu_counts: (S,) number of ADUs in each speech
+        group_attack, group_speech: (G,) attacks grouped by source speech, as attack index and
+            global speech index, ordered by speech and then by attack. An attack appears once for
+            every speech containing its source ADU (once per attack when sequence ids are unique).
+    """
+
+    def __init__(self, attack_offsets, src, tgt, src_speech, tgt_speech, src_is_poi, speech_offsets, adu_counts,
+                 group_attack: Optional[np.ndarray] = None, group_speech: Optional[np.ndarray] = None):
+        self.attack_offsets = np.asarray(attack_offsets, dtype=np.int64)
+        self.src = np.asarray(src, dtype=np.int64)
+        self.tgt = np.asarray(tgt, dtype=np.int64)
+        self.src_speech = np.asarray(src_speech, dtype=np.int64)
+        self.tgt_speech = np.asarray(tgt_speech, dtype=np.int64)
+        self.src_is_poi = np.asarray(src_is_poi, dtype=bool)
+        self.speech_offsets = np.asarray(speech_offsets, dtype=np.int64)
+        self.adu_counts = np.asarray(adu_counts, dtype=np.int64)
+
+        self.num_rounds = len(self.attack_offsets) - 1
+        self.num_attacks = np.diff(self.attack_offsets)
+        self.num_speeches = np.diff(self.speech_offsets)
+        self.attack_round = np.repeat(np.arange(self.num_rounds), self.num_attacks)
+        self.speech_round = np.repeat(np.arange(self.num_rounds), self.num_speeches)
+
+        if group_attack is None:
+            # Unique sequence ids: each attack belongs to the first speech containing its source
+            grouped = np.flatnonzero(self.src_speech >= 0)
+            global_speech = self.speech_offsets[self.attack_round[grouped]] + self.src_speech[grouped]
+            order = np.lexsort((grouped, global_speech))
+            group_attack, group_speech = grouped[order], global_speech[order]
+        self.group_attack = np.asarray(group_attack, dtype=np.int64)
+        self.group_speech = np.asarray(group_speech, dtype=np.int64)
+        self.group_round = self.speech_round[self.group_speech]
+
+    @classmethod
+    def from_rounds(cls, rounds: List[Dict[str, Any]]) -> "RoundArrays":
+        """Flatten rounds in RoundBatchResponse format (pois, rebuttals, speeches.sequence_id)
+
+        Only list comprehensions run per element; ADU lookups are done with sorted keys
+        (the vectorized equivalent of RoundIndex)
+        """
+        speech_offsets = np.cumsum([0] + [len(round_data["speeches"]) for round_data in rounds])
+        # votes=kの反論はk回の攻撃として数える（extract_attacksと同じ）
+        votes = np.array([reb.get("votes", 1) for round_data in rounds for reb in round_data["rebuttals"]], dtype=np.int64)
+        attack_offsets = np.cumsum([0] + [
+            sum(reb.get("votes", 1) for reb in round_data["rebuttals"]) for round_data in rounds
+        ])
+        adu_counts = np.array([
+            len(speech["argument_units"]) for round_data in rounds for speech in round_data["speeches"]
+        ], dtype=np.int64)
+        adu_seq = np.array([
+            au["sequence_id"]
+            for round_data in rounds for speech in round_data["speeches"] for au in speech["argument_units"]
+        ], dtype=np.int64)
+        src = np.repeat(np.array([reb["src"] for round_data in rounds for reb in round_data["rebuttals"]], dtype=np.int64), votes)
+        tgt = np.repeat(np.array([reb["tgt"] for round_data in rounds for reb in round_data["rebuttals"]], dtype=np.int64), votes)
+        poi_seq = np.array([poi for round_data in rounds for poi in round_data["pois"]], dtype=np.int64)
+        num_rounds = len(rounds)
+
+        speech_round = np.repeat(np.arange(num_rounds), np.diff(speech_offsets))
+        attack_round = np.repeat(np.arange(num_rounds), np.diff(attack_offsets))
+        poi_round = np.repeat(np.arange(num_rounds), [len(round_data["pois"]) for round_data in rounds])
+        adu_speech = np.repeat(np.arange(len(adu_counts)), adu_counts)
+
+        # (round, sequence_id) を1つの整数キーにする
+        values = np.concatenate([adu_seq, src, tgt, poi_seq])
+        low = values.min() if len(values) else 0
+        span = values.max() - low + 1 if len(values) else 1
+
+        def key(round_ids, sequence_ids):
+            return round_ids * span + (sequence_ids - low)
+
+        # 重複を除いた (キー, スピーチ) の組をキー・スピーチ順に並べる
+        adu_key = key(speech_round[adu_speech], adu_seq)
+        order = np.lexsort((adu_speech, adu_key))
+        adu_key, adu_speech = adu_key[order], adu_speech[order]
+        distinct = np.ones(len(adu_key), dtype=bool)
+        distinct[1:] = (adu_key[1:] != adu_key[:-1]) | (adu_speech[1:] != adu_speech[:-1])
+        pair_key, pair_speech = adu_key[distinct], adu_speech[distinct]
+        unique_key, first = np.unique(pair_key, return_index=True)
+        first_speech = pair_speech[first]
+
+        def speech_of(attack_key):
+            """sequence_idを含む最初のスピーチ（ラウンド内の番号）。無ければ-1"""
+            speech = np.full(len(attack_key), -1, dtype=np.int64)
+            pos = np.searchsorted(unique_key, attack_key)
+            found = pos < len(unique_key)
+            found[found] = unique_key[pos[found]] == attack_key[found]
+            speech[found] = first_speech[pos[found]] - speech_offsets[attack_round[found]]
+            return speech
+
+        src_key = key(attack_round, src)
+        src_speech = speech_of(src_key)
+        tgt_speech = speech_of(key(attack_round, tgt))
+        src_is_poi = np.isin(src_key, key(poi_round, poi_seq))
+
+        # 反論元のADUを含む全てのスピーチに反論を割り当て、スピーチ順・反論順に並べる
+        low_pos = np.searchsorted(pair_key, src_key, side="left")
+        counts = np.searchsorted(pair_key, src_key, side="right") - low_pos
+        group_attack = np.repeat(np.arange(len(src)), counts)
+        group_start = np.cumsum(counts) - counts
+        group_speech = pair_speech[
+            np.repeat(low_pos, counts) + np.arange(len(group_attack)) - np.repeat(group_start, counts)
+        ]
+        order = np.lexsort((group_attack, group_speech))
+
+        return cls(attack_offsets, src, tgt, src_speech, tgt_speech, src_is_poi, speech_offsets, adu_counts,
+                   group_attack[order], group_speech[order])
+
+
+def batch_distance(arrays: RoundArrays, version: int = 1) -> np.ndarray:
+    """Distance of every round (same as calc_distance, 0.0 where calc_distance fails)"""
+    if version != 1:
+        raise ValueError("Invalid version for distance calculation.")
+    rounds = arrays.num_rounds
+
+    missing = (arrays.src_speech < 0) | (arrays.tgt_speech < 0)
+    round_missing = np.bincount(arrays.attack_round[missing], minlength=rounds) > 0
+
+    slen = arrays.num_speeches[arrays.attack_round]
+    dist = arrays.src_speech - arrays.tgt_speech
+    far = ~missing & ((dist >= 3) | ((arrays.src_speech != slen - 2) & (dist >= 2)))
+    far_count = np.bincount(arrays.attack_round[far], minlength=rounds)
+
+    # 4番目以降のスピーチからの総反論数
+    local_speech = arrays.group_speech - arrays.speech_offsets[arrays.group_round]
+    from_4th = np.bincount(arrays.group_round[local_speech >= 3], minlength=rounds)
+
+    valid = ~round_missing & (from_4th > 0)
+    return np.divide(far_count, from_4th, out=np.zeros(rounds), where=valid)
+
+
+def batch_interval(arrays: RoundArrays, version: int = 1) -> np.ndarray:
+    """Interval of every round (same as calc_interval)"""
+    if version not in (1, 2):
+        raise ValueError("Invalid version for interval calculation.")
+    grouped = len(arrays.group_attack)
+    if grouped == 0:
+        return np.zeros(arrays.num_rounds)
+
+    # (speech, dst)ごとに、反論の並び順を保ったまま連続させる
+    position = np.arange(grouped)
+    dst = arrays.tgt[arrays.group_attack]
+    order = np.lexsort((position, dst, arrays.group_speech))
+    sorted_speech = arrays.group_speech[order]
+    sorted_dst = dst[order]
+    sorted_src = arrays.src[arrays.group_attack][order]
+
+    is_start = np.ones(grouped, dtype=bool)
+    is_start[1:] = (sorted_speech[1:] != sorted_speech[:-1]) | (sorted_dst[1:] != sorted_dst[:-1])
+    starts = np.flatnonzero(is_start)
+    ends = np.append(starts[1:], grouped) - 1
+
+    count = ends - starts + 1
+    speech = sorted_speech[starts]
+    speech_len = arrays.adu_counts[speech]
+    tmp_x = sorted_src[ends] - sorted_src[starts] - 1  # スピーチ内の間隔の総和
+
+    if version == 1:
+        # シンプルな正規化
+        valid = (count > 1) & (speech_len > 2)
+        value = np.divide(tmp_x, speech_len - 2, out=np.zeros(len(starts)), where=valid)
+    else:
+        # 最小間隔を考慮した正規化
+        valid = count > 1
+        tmp_min = count - 2
+        tmp_max = speech_len - count
+        value = np.divide(tmp_x - tmp_min, tmp_max, out=np.zeros(len(starts)), where=valid & (tmp_max != 0))
+
+    # calc_intervalと同じ順（スピーチ順、その中では反論先が最初に現れた順）に足す
+    selected = np.flatnonzero(valid)
+    selected = selected[np.argsort(position[order][starts][selected], kind="stable")]
+    return np.bincount(
+        arrays.speech_round[speech[selected]], weights=value[selected], minlength=arrays.num_rounds
+    )
+
+
+def batch_order(arrays: RoundArrays, version: int = 1) -> np.ndarray:
+    """Order of every round (same as calc_order)"""
+    if version not in (1, 2, 3, 4):
+        raise ValueError("Invalid version for order calculation.")
+    rounds = arrays.num_rounds
+
+    # POI絡みの反論を除いた、スピーチごとの反論の列
+    entries = arrays.group_attack[~arrays.src_is_poi[arrays.group_attack]]
+    entry_speech = arrays.group_speech[~arrays.src_is_poi[arrays.group_attack]]
+    entry_src = arrays.src[entries]
+    entry_dst = arrays.tgt[entries]
+
+    # 組を並べずに数える（order_pair_countsと同じ）
+    # 反論元が同じ組・反論先が同じ組: (speech, src) / (speech, dst) ごとの C(n, 2)
+    # 交差する組: スピーチ内の反論先の転倒数から、(speech, src) の部分列内の転倒数を引く
+    entry_round = arrays.speech_round[entry_speech]
+    src_pairs = _shared_pairs(entry_speech, entry_src)
+    dst_pairs = _shared_pairs(entry_speech, entry_dst) - _shared_pairs(entry_speech, entry_src, entry_dst)
+    reb_src_shared = np.bincount(entry_round, weights=src_pairs, minlength=rounds).astype(np.int64)
+    reb_dst_shared = np.bincount(entry_round, weights=dst_pairs, minlength=rounds).astype(np.int64)
+
+    # entriesはスピーチ順・反論順なので、スピーチごとの列は連続している
+    by_src = np.lexsort((np.arange(len(entries)), entry_src, entry_speech))
+    crossed = _segment_inversions(entry_dst, entry_speech)
+    crossed[by_src] -= _segment_inversions(entry_dst[by_src], _run_ids(entry_speech[by_src], entry_src[by_src]))
+    reb_crossed = np.bincount(entry_round, weights=crossed, minlength=rounds).astype(np.int64)
+
+    reb_num = arrays.num_attacks - np.bincount(arrays.attack_round[arrays.src_is_poi], minlength=rounds)
+
+    valid = (reb_num != 0) & (reb_src_shared + reb_crossed != 0)
+    result = np.full(rounds, -1.0)
+    if version == 1:
+        np.divide(reb_num, reb_src_shared + reb_crossed, out=result, where=valid)
+    elif version == 2:
+        np.divide(reb_num, reb_src_shared + reb_dst_shared + reb_crossed, out=result, where=valid)
+    elif version == 3:
+        np.divide(reb_num, reb_crossed, out=result, where=valid & (reb_crossed > 0))
+    else:
+        np.divide(reb_src_shared + reb_crossed, reb_num, out=result, where=valid)
+    return result
+
+
+def calculate_features_batch(rounds: List[Dict[str, Any]],
+                             timings: Optional[Dict[str, float]] = None) -> List[Dict[str, float]]:
+    """
+    Calculate all four macro-structural features for many rounds
+
+    Args:
+        rounds: Round data in RoundBatchResponse format
+        timings: If given, seconds spent on each step ("arrays" and each feature) are added to it
+
+    Returns:
+        Feature dictionaries in the same order as rounds (same values as calculate_features)
+    """
+    if not rounds:
+        return []
+    timer = _StepTimer(timings)
+    arrays = timer.run("arrays", RoundArrays.from_rounds, rounds)
+    distance = timer.run("distance", batch_distance, arrays)
+    interval = timer.run("interval", batch_interval, arrays)
+    order = timer.run("order", batch_order, arrays)
+    rally = timer.run("rally", _rally_per_round, rounds)
+
+    return [
+        {
+            "distance": float(distance[r]),
+            "interval": float(interval[r]),
+            "order": float(order[r]),
+            "rally": rally[r],
+        }
+        for r in range(len(rounds))
+    ]
+
+
+def _rally_per_round(rounds: List[Dict[str, Any]]) -> List[float]:
+    rally = []
+    for round_data in rounds:
+        attacks = extract_attacks(round_data)
+        try:
+            rally.append(calc_rally(attacks, len(round_data["speeches"])))
+        except Exception:
+            rally.append(0.0)
+    return rally
+
+
+def _run_ids(*keys: np.ndarray) -> np.ndarray:
+    """Run number of each element of arrays sorted by keys (a new run starts wherever any key changes)"""
+    changed = np.zeros(len(keys[0]), dtype=bool)
+    for key in keys:
+        changed[1:] |= key[1:] != key[:-1]
+    return np.cumsum(changed)
+
+
+def _shared_pairs(*keys: np.ndarray) -> np.ndarray:
+    """C(n, 2) of every group of elements with equal keys, put on the first element of the group (0 elsewhere)"""
+    pairs = np.zeros(len(keys[0]), dtype=np.int64)
+    if not len(pairs):
+        return pairs
+    order = np.lexsort(keys[::-1])
+    sizes = np.bincount(_run_ids(*[key[order] for key in keys]))
+    pairs[order[np.cumsum(sizes) - sizes]] = sizes * (sizes - 1) // 2
+    return pairs
+
+
+def _segment_inversions(values: np.ndarray, segment: np.ndarray) -> np.ndarray:
+    """
+    Inversions of values inside each segment, put on the later element of each inverted pair
+
+    segment must keep each segment contiguous. Bottom-up merge counting: at width w, every element
+    in the right half of a block of 2w counts the elements of the left half greater than it, with
+    one sort and searchsorted per level over all segments at once (O(n log^2 n), no pairs built).
+    """
+    n = len(values)
+    inversions = np.zeros(n, dtype=np.int64)
+    if n < 2:
+        return inversions
+    _, rank = np.unique(values, return_inverse=True)
+    rank = rank.astype(np.int64)
+    num_ranks = int(rank.max()) + 1
+    seg_start = np.flatnonzero(np.r_[True, segment[1:] != segment[:-1]])
+    seg_len = np.diff(np.append(seg_start, n))
+    position = np.arange(n)
+    local = position - np.repeat(seg_start, seg_len)
+
+    width = 1
+    while width < seg_len.max():
+        offset = local % (2 * width)
+        block = (position - offset) * num_ranks  # ブロックの先頭の位置をブロックの番号にする
+        left = offset < width
+        left_keys = np.sort(block[left] + rank[left])
+        right = np.flatnonzero(~left)
+        inversions[right] += np.searchsorted(left_keys, block[right] + num_ranks - 1, side="right") - \
+            np.searchsorted(left_keys, block[right] + rank[right], side="right")
+        width *= 2
+    return inversions
+
+
+class _StepTimer:
+    def __init__(self, timings: Optional[Dict[str, float]]):
+        self.timings = timings
+
+    def run(self, step: str, func, *args):
+        if self.timings is None:
+            return func(*args)
+        start = time.perf_counter()
+        result = func(*args)
+        self.timings[step] = self.timings.get(step, 0.0) + time.perf_counter() - start
+        return result
@@ -0,0 +1,130 @@
+"""
+Structural Similarity Index
+
+Nearest-neighbour search over the macro-structural feature vectors of all rounds:
+- KDTree: static k-d tree over a point matrix, exact k-nearest-neighbour queries
+- SimilarityIndex: KDTree over the z-score normalized (distance, interval, order, rally) vectors
+  of the rounds in a CorpusFeatureStats, rebuilt lazily when the stats change
+"""
+
+import heapq
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from features.stats import FEATURE_NAMES, CorpusFeatureStats
+
+LEAF_SIZE = 16
+
+
+class KDTree:
+    """
+    k-d tree over the rows of points (N, D)
+
+    Nodes are stored in flat lists. Internal nodes split on the dimension with the largest spread
+    at its median; leaves hold at most leaf_size points as a range of self.index.
+    """
+
+    def __init__(self, points: np.ndarray, leaf_size: int = LEAF_SIZE):
+        self.points = np.asarray(points, dtype=np.float64)
+        self.leaf_size = leaf_size
+        self.index = np.arange(len(self.points))
+        self.start: List[int] = []
+        self.end: List[int] = []
+        self.split_dim: List[int] = []
+        self.split_value: List[float] = []
+        self.left: List[int] = []
+        self.right: List[int] = []
+        if len(self.points):
+            self._build(0, len(self.points))
+
+    def _build(self, start: int, end: int) -> int:
+        node = len(self.start)
+        self.start.append(start)
+        self.end.append(end)
+        self.split_dim.append(-1)
+        self.split_value.append(0.0)
+        self.left.append(-1)
+        self.right.append(-1)
+        if end - start <= self.leaf_size:
+            return node
+
+        rows = self.index[start:end]
+        values = self.points[rows]
+        dim = int(np.argmax(values.max(axis=0) - values.min(axis=0)))
+        mid = (start + end) // 2
+        # 左にはsplit_value以下、右にはsplit_value以上の点が入る
+        self.index[start:end] = rows[np.argpartition(values[:, dim], mid - start)]
+        self.split_dim[node] = dim
+        self.split_value[node] = float(self.points[self.index[mid], dim])
+        self.left[node] = self._build(start, mid)
+        self.right[node] = self._build(mid, end)
+        return node
+
+    def query(self, point: np.ndarray, k: int) -> List[Tuple[int, float]]:
+        """The k rows nearest to point as (row, euclidean distance), nearest first"""
+        if k <= 0 or not len(self.points):
+            return []
+        point = np.asarray(point, dtype=np.float64)
+        heap: List[Tuple[float, int]] = []  # (-距離の2乗, row) の最大ヒープ
+
+        def visit(node: int) -> None:
+            if self.split_dim[node] < 0:
+                rows = self.index[self.start[node]:self.end[node]]
+                distances = ((self.points[rows] - point) ** 2).sum(axis=1)
+                for row, distance in zip(rows.tolist(), distances.tolist()):
+                    if len(heap) < k:
+                        heapq.heappush(heap, (-distance, row))
+                    elif distance < -heap[0][0]:
+                        heapq.heapreplace(heap, (-distance, row))
+                return
+            diff = point[self.split_dim[node]] - self.split_value[node]
+            near, far = (self.left[node], self.right[node]) if diff < 0 else (self.right[node], self.left[node])
+            visit(near)
+            if len(heap) < k or diff * diff < -heap[0][0]:
+                visit(far)
+
+        visit(0)
+        return [(row, float(np.sqrt(-negative))) for negative, row in sorted(heap, reverse=True)]
+
+
+class SimilarityIndex:
+    """
+    Rounds nearest to a given round by rebuttal structure
+
+    Each feature is normalized to zero mean and unit variance over the corpus, so that no feature
+    dominates the distance because of its scale.
+    """
+
+    def __init__(self, stats: CorpusFeatureStats):
+        self.stats = stats
+        self._version: Optional[int] = None
+        self._round_ids: List[int] = []
+        self._rows = {}
+        self._tree = KDTree(np.empty((0, len(FEATURE_NAMES))))
+
+    def _ensure_built(self) -> None:
+        if self._version == self.stats.version:
+            return
+        round_features = self.stats.round_features()
+        self._round_ids = sorted(round_features)
+        self._rows = {round_id: row for row, round_id in enumerate(self._round_ids)}
+        vectors = np.array(
+            [[round_features[round_id][name] for name in FEATURE_NAMES] for round_id in self._round_ids],
+            dtype=np.float64,
+        ).reshape(-1, len(FEATURE_NAMES))
+        if len(vectors):
+            scale = vectors.std(axis=0)
+            scale[scale == 0] = 1.0
+            vectors = (vectors - vectors.mean(axis=0)) / scale
+        self._tree = KDTree(vectors)
+        self._version = self.stats.version
+
+    def similar(self, round_id: int, k: int) -> Optional[List[Tuple[int, float]]]:
+        """The k rounds nearest to round_id (itself excluded) as (round_id, distance), or None if it is not indexed"""
+        self._ensure_built()
+        row = self._rows.get(round_id)
+        if row is None:
+            return None
+        neighbours = self._tree.query(self._tree.points[row], k + 1)
+        return [(self._round_ids[other], distance) for other, distance in neighbours if other != row][:k]
@@ -0,0 +1,239 @@
+"""
+Corpus Feature Statistics
+
+Mergeable sketches of the macro-structural feature distributions, maintained incrementally
+as rounds are added, deleted or re-tagged:
+- RunningMoments: count / mean / variance (Welford updates, reversible for deletions, Chan merge)
+- SparseHistogram: fixed-width bins stored sparsely (exact counts, so deletions are exact),
+  also used for approximate quantiles
+Sketches are kept per tag and per channel; the overall distribution is the merge of the tag sketches.
+The per-round features are kept as well, for indexes built on top of them (features.similarity).
+"""
+
+import math
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+FEATURE_NAMES = ("distance", "interval", "order", "rally")
+
+# 各特徴量のヒストグラムのビン幅（典型的な値の範囲に合わせる）
+BIN_WIDTHS = {
+    "distance": 0.02,
+    "interval": 0.1,
+    "order": 0.1,
+    "rally": 0.005,
+}
+
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+
+class RunningMoments:
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x: float) -> None:
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+
+    def remove(self, x: float) -> None:
+        if self.count <= 1:
+            self.__init__()
+            return
+        old_mean = self.mean
+        self.count -= 1
+        self.mean = (old_mean * (self.count + 1) - x) / self.count
+        self.m2 = max(self.m2 - (x - old_mean) * (x - self.mean), 0.0)
+
+    def merge(self, other: "RunningMoments") -> None:
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+
+    @property
+    def variance(self) -> Optional[float]:
+        """Population variance"""
+        return self.m2 / self.count if self.count else None
+
+
+class SparseHistogram:
+    def __init__(self, width: float):
+        self.width = width
+        self.bins = Counter()
+
+    def _bin(self, x: float) -> int:
+        return math.floor(x / self.width)
+
+    def add(self, x: float) -> None:
+        self.bins[self._bin(x)] += 1
+
+    def remove(self, x: float) -> None:
+        b = self._bin(x)
+        self.bins[b] -= 1
+        if self.bins[b] <= 0:
+            del self.bins[b]
+
+    def merge(self, other: "SparseHistogram") -> None:
+        self.bins.update(other.bins)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Quantile interpolated linearly inside the bin that contains it"""
+        total = sum(self.bins.values())
+        if total == 0:
+            return None
+        target = q * total
+        seen = 0
+        for b in sorted(self.bins):
+            count = self.bins[b]
+            if seen + count >= target:
+                return (b + (target - seen) / count) * self.width
+            seen += count
+        return (max(self.bins) + 1) * self.width
+
+    def to_list(self) -> List[Dict]:
+        return [
+            {"start": round(b * self.width, 10), "end": round((b + 1) * self.width, 10), "count": self.bins[b]}
+            for b in sorted(self.bins)
+        ]
+
+
+class FeatureSketch:
+    """Moments and histogram of each feature for one group of rounds"""
+
+    def __init__(self):
+        self.moments = {name: RunningMoments() for name in FEATURE_NAMES}
+        self.histograms = {name: SparseHistogram(BIN_WIDTHS[name]) for name in FEATURE_NAMES}
+
+    @property
+    def count(self) -> int:
+        return self.moments[FEATURE_NAMES[0]].count
+
+    def add(self, features: Dict[str, float]) -> None:
+        for name in FEATURE_NAMES:
+            self.moments[name].add(features[name])
+            self.histograms[name].add(features[name])
+
+    def remove(self, features: Dict[str, float]) -> None:
+        for name in FEATURE_NAMES:
+            self.moments[name].remove(features[name])
+            self.histograms[name].remove(features[name])
+
+    def merge(self, other: "FeatureSketch") -> None:
+        for name in FEATURE_NAMES:
+            self.moments[name].merge(other.moments[name])
+            self.histograms[name].merge(other.histograms[name])
+
+    def summary(self) -> Dict:
+        return {
+            "count": self.count,
+            "features": {
+                name: {
+                    "mean": self.moments[name].mean if self.count else None,
+                    "variance": self.moments[name].variance,
+                    "quantiles": {str(q): self.histograms[name].quantile(q) for q in QUANTILES},
+                    "histogram": self.histograms[name].to_list(),
+                }
+                for name in FEATURE_NAMES
+            },
+        }
+
+
+GROUP_BY = ("tag", "channel_id")
+
+
+class CorpusFeatureStats:
+    """
+    Feature sketches of all rounds, grouped by tag and by channel_id
+
+    Built once from the database (load), then kept up to date with set_round / remove_round.
+    Changes made while a load is in progress are queued and applied after it.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.loading = False
+        # 変更のたびに進む。これを見て、上に作った索引を作り直す
+        self.version = 0
+        self._rounds: Dict[int, Tuple[Dict[str, float], Dict[str, Optional[str]]]] = {}
+        self._groups: Dict[str, Dict[Optional[str], FeatureSketch]] = {key: {} for key in GROUP_BY}
+        self._pending = []
+
+    def begin_load(self) -> None:
+        self.loading = True
+        self._pending = []
+
+    def finish_load(self, rows: List[Tuple[int, Dict[str, float], Optional[str], Optional[str]]]) -> None:
+        """rows: (round_id, features, tag, channel_id)"""
+        self.loaded = True
+        self.loading = False
+        for round_id, features, tag, channel_id in rows:
+            self._set(round_id, features, {"tag": tag, "channel_id": channel_id})
+        for change in self._pending:
+            change()
+        self._pending = []
+
+    def abort_load(self) -> None:
+        self.loading = False
+        self._pending = []
+
+    def set_round(self, round_id: int, features: Dict[str, float],
+                  tag: Optional[str], channel_id: Optional[str]) -> None:
+        """Add a round, or replace its features and groups"""
+        self._apply(lambda: self._set(round_id, features, {"tag": tag, "channel_id": channel_id}))
+
+    def set_tag(self, round_id: int, tag: Optional[str]) -> None:
+        def change():
+            if round_id in self._rounds:
+                features, groups = self._rounds[round_id]
+                self._set(round_id, features, {**groups, "tag": tag})
+        self._apply(change)
+
+    def remove_round(self, round_id: int) -> None:
+        self._apply(lambda: self._remove(round_id))
+
+    def round_features(self) -> Dict[int, Dict[str, float]]:
+        return {round_id: features for round_id, (features, _) in self._rounds.items()}
+
+    def summary(self, group_by: Optional[str] = None) -> Dict:
+        overall = FeatureSketch()
+        for sketch in self._groups["tag"].values():
+            overall.merge(sketch)
+        result = {"overall": overall.summary()}
+        if group_by is not None:
+            result[group_by] = {
+                key if key is not None else "": sketch.summary()
+                for key, sketch in sorted(self._groups[group_by].items(), key=lambda item: item[0] or "")
+            }
+        return result
+
+    def _apply(self, change) -> None:
+        # 未構築なら何もしない（構築時にDBから読まれる）。構築中なら構築後に適用する
+        if self.loading:
+            self._pending.append(change)
+        elif self.loaded:
+            change()
+
+    def _set(self, round_id: int, features: Dict[str, float], groups: Dict[str, Optional[str]]) -> None:
+        self._remove(round_id)
+        self._rounds[round_id] = (features, groups)
+        self.version += 1
+        for key in GROUP_BY:
+            self._groups[key].setdefault(groups[key], FeatureSketch()).add(features)
+
+    def _remove(self, round_id: int) -> None:
+        if round_id not in self._rounds:
+            return
+        features, groups = self._rounds.pop(round_id)
+        self.version += 1
+        for key in GROUP_BY:
+            sketch = self._groups[key][groups[key]]
+            sketch.remove(features)
+            if sketch.count == 0:
+                del self._groups[key][groups[key]]
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Equivalence tests between the optimized feature implementations and the originals
+
+Compares features.macro_structural against features.macro_structural_reference, and
+features.macro_structural_batch against features.macro_structural, on
+1. the rounds in mysql/batch/debate_sotsuron.sql (skipped when the dump is not available)
+2. randomly generated rounds, including many repeated rebuttals
+
+Also checks that incrementally updated features.stats sketches match a full rebuild, and that
+the features.similarity k-d tree returns the same neighbours as a brute-force search.
+
+Run from the app directory:
+    python -m pytest features/test_equivalence.py
+"""
+
+import os
+import random
+import re
+from collections import Counter, defaultdict
+from pathlib import Path
+
+import pytest
+
+from features import benchmark, macro_structural, macro_structural_batch, macro_structural_reference, similarity, stats
+
+DUMP_PATH = Path(os.getenv(
+    "DEBATE_DUMP_PATH",
+    Path(__file__).resolve().parents[4] / "mysql" / "batch" / "debate_sotsuron.sql",
+))
+
+ROW_PATTERNS = {
+    "argument_units": re.compile(r"^\((\d+), (\d+), .*, (\d+)\)[,;]$"),
+    "speeches": re.compile(r"^\((\d+), (\d+)\)[,;]$"),
+    "pois": re.compile(r"^\((\d+), (\d+), (\d+)\)[,;]$"),
+    "rebuttals": re.compile(r"^\((\d+), (\d+), (\d+), (\d+)\)[,;]$"),
+}
+
+
+def load_dump_rounds(path=DUMP_PATH):
+    """Rebuild rounds in RoundBatchResponse format (sequence_id only) from the SQL dump"""
+    rows = defaultdict(list)
+    table = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.startswith("INSERT INTO"):
+                table = line.split("`")[1]
+                continue
+            pattern = ROW_PATTERNS.get(table)
+            match = pattern.match(line) if pattern else None
+            if match:
+                rows[table].append(tuple(int(value) for value in match.groups()))
+            elif not line.startswith("("):
+                table = None
+
+    rounds = defaultdict(lambda: {"speeches": [], "pois": [], "rebuttals": []})
+    speeches = {}
+    for speech_id, round_id in sorted(rows["speeches"]):
+        speech = {"argument_units": []}
+        speeches[speech_id] = speech
+        rounds[round_id]["speeches"].append(speech)
+    for _, sequence_id, speech_id in sorted(rows["argument_units"]):
+        speeches[speech_id]["argument_units"].append({"sequence_id": sequence_id})
+    for _, argument_unit_id, round_id in sorted(rows["pois"]):
+        rounds[round_id]["pois"].append(argument_unit_id)
+    for _, src, tgt, round_id in sorted(rows["rebuttals"]):
+        rounds[round_id]["rebuttals"].append({"src": src, "tgt": tgt})
+    return dict(rounds)
+
+
+def random_attacks(rng, num_adus, num_attacks, repeat_rate):
+    """Random attacks; with repeat_rate, earlier attacks are stored again as the 10-sample GPT voting does"""
+    attacks = []
+    for _ in range(num_attacks):
+        if attacks and rng.random() < repeat_rate:
+            attacks.append(rng.choice(attacks))
+        else:
+            attacks.append((rng.randrange(num_adus), rng.randrange(num_adus)))
+    return attacks
+
+
+def random_round(rng):
+    """Random round in RoundBatchResponse format, with occasional duplicated or missing sequence ids"""
+    speeches = []
+    sequence_id = 0
+    for _ in range(rng.choice([0, 1, 6, 8])):
+        argument_units = []
+        for _ in range(rng.randint(0, 7)):
+            duplicated = rng.random() < 0.05
+            argument_units.append({"sequence_id": rng.randint(0, sequence_id) if duplicated else sequence_id})
+            sequence_id += 1
+        speeches.append({"argument_units": argument_units})
+    num_adus = sequence_id + 2  # 存在しないADUへの反論も混ぜる
+    attacks = random_attacks(rng, num_adus, rng.randint(0, 25), repeat_rate=0.4)
+    return {
+        "speeches": speeches,
+        "pois": rng.sample(range(num_adus), k=min(num_adus, rng.randint(0, 3))),
+        "rebuttals": [{"src": src, "tgt": tgt} for src, tgt in attacks],
+    }
+
+
+def grouped_attacks(round_data):
+    """calculate_featuresと同じ、反論元のスピーチごとの反論のリスト"""
+    index = macro_structural.RoundIndex(round_data)
+    att_src_by_speech = [[] for _ in range(index.num_speeches)]
+    for reb in round_data["rebuttals"]:
+        for speech_idx in index.speeches_of.get(reb["src"], ()):
+            att_src_by_speech[speech_idx].append((reb["src"], reb["tgt"]))
+    return index, att_src_by_speech
+
+
+def dump_rounds():
+    if not DUMP_PATH.exists():
+        pytest.skip(f"{DUMP_PATH} not found")
+    return load_dump_rounds()
+
+
+def test_dump_is_parsed():
+    rounds = dump_rounds()
+    assert rounds
+    assert any(round_data["rebuttals"] for round_data in rounds.values())
+
+
+def test_rally_matches_reference_on_dump():
+    for round_id, round_data in dump_rounds().items():
+        attacks = [(reb["src"], reb["tgt"]) for reb in round_data["rebuttals"]]
+        num_speeches = len(round_data["speeches"])
+        assert macro_structural.calc_rally(attacks, num_speeches) == \
+            macro_structural_reference.calc_rally(attacks, num_speeches), round_id
+
+
+@pytest.mark.parametrize("repeat_rate", [0.0, 0.3, 0.7])
+def test_rally_matches_reference_on_random_rounds(repeat_rate):
+    rng = random.Random(0)
+    for _ in range(500):
+        attacks = random_attacks(rng, rng.randint(1, 12), rng.randint(0, 14), repeat_rate)
+        num_speeches = rng.choice([0, 6, 8])
+        assert macro_structural.calc_rally(attacks, num_speeches) == \
+            macro_structural_reference.calc_rally(attacks, num_speeches), attacks
+
+
+@pytest.mark.parametrize("version", [1, 2, 3, 4])
+def test_order_matches_reference(version):
+    rng = random.Random(version)
+    rounds = [random_round(rng) for _ in range(500)]
+    if DUMP_PATH.exists():
+        rounds += list(load_dump_rounds().values())
+    for round_data in rounds:
+        index, att_src_by_speech = grouped_attacks(round_data)
+        attacks = [(reb["src"], reb["tgt"]) for reb in round_data["rebuttals"]]
+        assert macro_structural.calc_order(att_src_by_speech, attacks, index.poi_adus, version) == \
+            macro_structural_reference.calc_order(att_src_by_speech, attacks, list(index.poi_adus), version)
+
+
+def test_batch_features_match_scalar_on_dump():
+    rounds = list(dump_rounds().values())
+    expected = [macro_structural.calculate_features(round_data) for round_data in rounds]
+    assert macro_structural_batch.calculate_features_batch(rounds) == expected
+
+
+def test_batch_features_match_scalar_on_random_rounds():
+    rng = random.Random(0)
+    rounds = [random_round(rng) for _ in range(1000)]
+    expected = [macro_structural.calculate_features(round_data) for round_data in rounds]
+    assert macro_structural_batch.calculate_features_batch(rounds) == expected
+
+
+def test_compacted_rebuttals_count_votes():
+    # migrate_db.compact_rebuttalsと同じく、同じ反論を最初に現れた位置の1行にまとめる
+    rng = random.Random(0)
+    rounds = [random_round(rng) for _ in range(1000)]
+    compacted, regrouped = [], []
+    for round_data in rounds:
+        votes = Counter((reb["src"], reb["tgt"]) for reb in round_data["rebuttals"])
+        compacted.append({**round_data, "rebuttals": [
+            {"src": src, "tgt": tgt, "votes": count} for (src, tgt), count in votes.items()
+        ]})
+        # votes=kの反論は、最初に現れた位置に並んだk個の反論と同じに数えられる
+        regrouped.append({**round_data, "rebuttals": [
+            {"src": src, "tgt": tgt} for (src, tgt), count in votes.items() for _ in range(count)
+        ]})
+    expected = [macro_structural.calculate_features(round_data) for round_data in regrouped]
+    assert [macro_structural.calculate_features(round_data) for round_data in compacted] == expected
+    assert macro_structural_batch.calculate_features_batch(compacted) == expected
+
+
+@pytest.mark.parametrize("case", benchmark.scale_cases(benchmark.QUICK_SCALES), ids=benchmark.case_name)
+def test_batch_features_match_scalar_on_benchmark_rounds(case):
+    rng = random.Random(benchmark.case_name(case))
+    rounds = [benchmark.synthetic_round(rng, **case) for _ in range(5)]
+    expected = [macro_structural.calculate_features(round_data) for round_data in rounds]
+    assert macro_structural_batch.calculate_features_batch(rounds) == expected
+
+
+@pytest.mark.parametrize("version", [1, 2])
+def test_batch_interval_versions_match_scalar(version):
+    rng = random.Random(version)
+    rounds = [random_round(rng) for _ in range(300)]
+    arrays = macro_structural_batch.RoundArrays.from_rounds(rounds)
+    actual = macro_structural_batch.batch_interval(arrays, version)
+    for r, round_data in enumerate(rounds):
+        index, att_src_by_speech = grouped_attacks(round_data)
+        assert actual[r] == macro_structural.calc_interval(att_src_by_speech, index.len_adu_by_speech, version)
+
+
+@pytest.mark.parametrize("version", [1, 2, 3, 4])
+def test_batch_order_versions_match_scalar(version):
+    rng = random.Random(version)
+    rounds = [random_round(rng) for _ in range(300)]
+    arrays = macro_structural_batch.RoundArrays.from_rounds(rounds)
+    actual = macro_structural_batch.batch_order(arrays, version)
+    for r, round_data in enumerate(rounds):
+        index, att_src_by_speech = grouped_attacks(round_data)
+        attacks = [(reb["src"], reb["tgt"]) for reb in round_data["rebuttals"]]
+        assert actual[r] == macro_structural.calc_order(att_src_by_speech, attacks, index.poi_adus, version)
+
+
+def test_feature_variants_match_each_version():
+    rng = random.Random(0)
+    for round_data in [random_round(rng) for _ in range(500)]:
+        variants = macro_structural.calculate_feature_variants(round_data)
+        features = macro_structural.calculate_features(round_data)
+        assert variants["distance"] == features["distance"]
+        assert variants["rally"] == features["rally"]
+        assert variants["interval_v1"] == features["interval"]
+        assert variants["order_v1"] == features["order"]
+        if not round_data["rebuttals"]:
+            continue
+        index, att_src_by_speech = grouped_attacks(round_data)
+        attacks = [(reb["src"], reb["tgt"]) for reb in round_data["rebuttals"]]
+        for version in macro_structural.INTERVAL_VERSIONS:
+            assert variants[f"interval_v{version}"] == \
+                macro_structural_reference.calc_interval(att_src_by_speech, index.len_adu_by_speech, version)
+        for version in macro_structural.ORDER_VERSIONS:
+            assert variants[f"order_v{version}"] == \
+                macro_structural_reference.calc_order(att_src_by_speech, attacks, list(index.poi_adus), version)
+
+
+def test_incremental_stats_match_full_build():
+    rng = random.Random(18)
+    rounds = {
+        round_id: ({name: rng.random() for name in stats.FEATURE_NAMES}, rng.choice(["a", "b", None]), rng.choice(["x", "y"]))
+        for round_id in range(200)
+    }
+    incremental = stats.CorpusFeatureStats()
+    incremental.begin_load()
+    incremental.finish_load([(round_id, *values) for round_id, values in rounds.items() if round_id < 100])
+    for round_id in range(100, 200):
+        incremental.set_round(round_id, *rounds[round_id])
+    for round_id in range(0, 200, 3):
+        incremental.remove_round(round_id)
+        del rounds[round_id]
+    for round_id in range(1, 200, 7):
+        if round_id in rounds:
+            incremental.set_tag(round_id, "c")
+            features, _, channel_id = rounds[round_id]
+            rounds[round_id] = (features, "c", channel_id)
+
+    full = stats.CorpusFeatureStats()
+    full.begin_load()
+    full.finish_load([(round_id, *values) for round_id, values in rounds.items()])
+    for group_by in (None, "tag", "channel_id"):
+        expected = full.summary(group_by)
+        actual = incremental.summary(group_by)
+        assert actual.keys() == expected.keys()
+        assert actual["overall"]["count"] == len(rounds)
+        for name in stats.FEATURE_NAMES:
+            summary, expected_summary = actual["overall"]["features"][name], expected["overall"]["features"][name]
+            values = [features[name] for features, _, _ in rounds.values()]
+            mean = sum(values) / len(values)
+            assert summary["mean"] == pytest.approx(mean)
+            assert summary["variance"] == pytest.approx(sum((x - mean) ** 2 for x in values) / len(values))
+            assert summary["histogram"] == expected_summary["histogram"]
+            assert summary["quantiles"] == pytest.approx(expected_summary["quantiles"])
+        if group_by is not None:
+            assert actual[group_by].keys() == expected[group_by].keys()
+            for key in expected[group_by]:
+                assert actual[group_by][key]["count"] == expected[group_by][key]["count"]
+
+
+@pytest.mark.parametrize("num_points", [1, 15, 300])
+def test_kd_tree_matches_brute_force(num_points):
+    rng = random.Random(num_points)
+    # 同じ値が多い特徴量もあるので、重複する座標も混ぜる
+    points = [[rng.choice([0.0, 0.5, rng.random()]) for _ in stats.FEATURE_NAMES] for _ in range(num_points)]
+    tree = similarity.KDTree(points, leaf_size=4)
+    for _ in range(20):
+        point = [rng.random() for _ in stats.FEATURE_NAMES]
+        for k in (1, 5, num_points + 3):
+            expected = sorted(sum((a - b) ** 2 for a, b in zip(other, point)) ** 0.5 for other in points)[:k]
+            assert [distance for _, distance in tree.query(point, k)] == pytest.approx(expected)
@@ -0,0 +1,272 @@
+import gzip
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+from fastapi import Request, Response
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+try:
+    import brotli
+except ImportError:  # brotliが無ければgzipだけを使う
+    brotli = None
+
+JSON_MEDIA_TYPE = "application/json"
+
+
+def request_key(request: Request, media_type: str = JSON_MEDIA_TYPE) -> str:
+    """表現形式・パス・ソート済みクエリパラメータ。キャッシュのキーとETagの元になる"""
+    query = "&".join(f"{key}={value}" for key, value in sorted(request.query_params.multi_items()))
+    return f"{media_type} {request.url.path}?{query}"
+
+
+def make_etag(request: Request, *versions, media_type: str = JSON_MEDIA_TYPE) -> str:
+    """表現形式・パス・クエリパラメータ・データのversionから強いETagを作る"""
+    key = "|".join([request_key(request, media_type)] + [str(version) for version in versions])
+    return '"' + hashlib.sha1(key.encode()).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Matchは弱い比較（W/を無視）で判定する"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in header.split(","))
+
+
+def not_modified(etag: str, headers=None) -> Response:
+    """304。200のレスポンスと同じVary（headersのVaryとAccept-Encoding）を付ける"""
+    vary_headers = {"vary": headers["vary"]} if headers is not None and "vary" in headers else {}
+    add_vary(vary_headers, "Accept-Encoding")
+    return Response(status_code=304, headers={"ETag": etag, **vary_headers})
+
+
+# これより小さいレスポンスは圧縮しない
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 6
+
+
+def supported_encodings() -> Tuple[str, ...]:
+    """サーバーが使える圧縮形式。同じ重みならこの順に優先する"""
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def header_weights(header: str) -> Dict[str, float]:
+    """Accept・Accept-Encodingのような値を{小文字の値: q}にする。qが無ければ1、読めなければ0"""
+    weights = {}
+    for part in header.split(","):
+        value, _, params = part.strip().partition(";")
+        value = value.strip().lower()
+        weight = 1.0
+        for param in params.split(";"):
+            name, _, q = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    weight = float(q)
+                except ValueError:
+                    weight = 0.0
+        if value:
+            weights[value] = weight
+    return weights
+
+
+def negotiate_encoding(request: Request, size: int) -> Optional[str]:
+    """Accept-Encodingから圧縮形式を選ぶ。size がCOMPRESSION_MIN_BYTES未満か、使える形式が無ければNone"""
+    if size < COMPRESSION_MIN_BYTES:
+        return None
+    header = request.headers.get("accept-encoding")
+    if not header:
+        return None
+    weights = header_weights(header)
+    best, best_weight = None, 0.0
+    for coding in supported_encodings():
+        weight = weights.get(coding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = coding, weight
+    return best
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def encoding_headers(headers: dict, encoding: Optional[str]) -> dict:
+    """圧縮した場合はContent-Encodingを付け、ETagを弱いETagにする（nginxのgzipと同じ扱い）"""
+    if encoding is None:
+        return headers
+    headers = dict(headers)
+    headers["content-encoding"] = encoding
+    etag = headers.get("etag")
+    if etag and not etag.startswith("W/"):
+        headers["etag"] = "W/" + etag
+    return headers
+
+
+class CacheEntry:
+    def __init__(self, body: bytes, headers: dict, round_ids: Optional[frozenset]):
+        self.body = body
+        self.headers = headers
+        # Noneは全ラウンドに依存する一覧系のレスポンス
+        self.round_ids = round_ids
+        # 圧縮形式ごとの圧縮済みbody。要求されたときに一度だけ圧縮する
+        self.variants: Dict[str, bytes] = {}
+        self.size = len(body)
+
+    def add_variant(self, encoding: str, body: bytes) -> int:
+        """圧縮済みbodyを追加し、増えたバイト数を返す"""
+        if encoding in self.variants:
+            return 0
+        self.variants[encoding] = body
+        self.size += len(body)
+        return len(body)
+
+
+class ResponseCache:
+    """シリアライズ済みレスポンスのLRUキャッシュ。合計バイト数がmax_bytesを超えると古いものから捨てる
+
+    書き込み系のエンドポイントがinvalidate_roundを呼ぶ。invalidateのたびにgenerationが進むので、
+    DBを読んでいる間にinvalidateされたレスポンスはputされない
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.generation = 0
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.compression_hits = 0
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: str, entry: CacheEntry, generation: int) -> None:
+        if generation != self.generation or entry.size > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = entry
+        self.total_bytes += entry.size
+        self._evict()
+
+    def encoded_body(self, key: str, entry: CacheEntry, encoding: Optional[str]) -> bytes:
+        """entryのencodingで圧縮したbody。初回だけ圧縮し、以降はキャッシュ内の圧縮済みbodyを返す"""
+        if encoding is None:
+            return entry.body
+        body = entry.variants.get(encoding)
+        if body is not None:
+            self.compression_hits += 1
+            return body
+        body = compress(entry.body, encoding)
+        added = entry.add_variant(encoding, body)
+        if self._entries.get(key) is entry:
+            self.total_bytes += added
+            self._evict()
+        return body
+
+    def _evict(self) -> None:
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= evicted.size
+            self.evictions += 1
+
+    def invalidate_round(self, round_id: int) -> None:
+        """round_idを含むレスポンスと、全ての一覧系レスポンスを捨てる"""
+        self.generation += 1
+        stale_keys = [
+            key for key, entry in self._entries.items()
+            if entry.round_ids is None or round_id in entry.round_ids
+        ]
+        for key in stale_keys:
+            self._remove(key)
+        self.invalidations += len(stale_keys)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "compression_hits": self.compression_hits,
+        }
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry.size
+
+
+response_cache = ResponseCache(int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))))
+
+CACHED_HEADERS = ("etag", "x-next-cursor", "vary")
+
+
+def cached_response(request: Request, media_type: str = JSON_MEDIA_TYPE) -> Optional[Response]:
+    """キャッシュにあればDBに触れずにレスポンス（If-None-Matchが一致すれば304）を返す"""
+    key = request_key(request, media_type)
+    entry = response_cache.get(key)
+    if entry is None:
+        return None
+    etag = entry.headers.get("etag")
+    if etag and etag_matches(request, etag):
+        return not_modified(etag, entry.headers)
+    encoding = negotiate_encoding(request, len(entry.body))
+    body = response_cache.encoded_body(key, entry, encoding)
+    return Response(content=body, media_type=media_type, headers=encoding_headers(entry.headers, encoding))
+
+
+def add_vary(headers: dict, field: str) -> None:
+    vary = [value.strip() for value in headers.get("vary", "").split(",") if value.strip()]
+    if field.lower() not in (value.lower() for value in vary):
+        vary.append(field)
+    headers["vary"] = ", ".join(vary)
+
+
+def store_body(request: Request, response: Response, body: bytes, generation: int,
+               round_ids: Optional[Iterable[int]] = None, media_type: str = JSON_MEDIA_TYPE) -> Response:
+    """シリアライズ済みのbodyをキャッシュに入れてから返す
+
+    Accept-Encodingに応じて圧縮し、圧縮済みのbodyも同じエントリに入れておく
+    """
+    headers = {key: value for key, value in response.headers.items() if key in CACHED_HEADERS}
+    add_vary(headers, "Accept-Encoding")
+    entry = CacheEntry(body, headers, frozenset(round_ids) if round_ids is not None else None)
+    encoding = negotiate_encoding(request, len(body))
+    if encoding is not None:
+        entry.add_variant(encoding, compress(body, encoding))
+    response_cache.put(request_key(request, media_type), entry, generation)
+    return Response(
+        content=entry.variants.get(encoding, body), media_type=media_type,
+        headers=encoding_headers(headers, encoding),
+    )
+
+
+def encode_json(content) -> bytes:
+    """dict・list・数値・文字列だけからなるcontent用の高速なエンコード"""
+    return orjson.dumps(content)
+
+
+def store_response(request: Request, response: Response, content, generation: int,
+                   round_ids: Optional[Iterable[int]] = None) -> Response:
+    """contentをJSONResponseと同じ形式でシリアライズし、キャッシュに入れてから返す"""
+    body = json.dumps(
+        jsonable_encoder(content), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+    return store_body(request, response, body, generation, round_ids=round_ids)
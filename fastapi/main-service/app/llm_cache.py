@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+
+def request_key(request: dict) -> str:
+    """リクエスト全体（model・messages・n・response_formatのスキーマ・サンプリングのパラメータ）のハッシュ
+
+    一部だけをキーにすると、別のリクエストに古い応答を返してしまう（segment2argument_units_unstructuredの件）
+    """
+    canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class LLMCache:
+    """OpenAIの応答（choiceごとのcontent）をリクエストのハッシュで引くSQLiteのキャッシュ
+
+    合計バイト数がmax_bytesを超えると、最後に使われたのが古いものから捨てる
+    同じラウンドを取り込み直したときは、APIを呼ばずに前回の応答を返す
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = os.path.abspath(path)  # 相対パスは起動時の作業ディレクトリで決まる
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY,"
+                " contents TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " accessed_at REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+            self._connection = connection
+        return self._connection
+
+    def get(self, key: str) -> Optional[List[str]]:
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT contents FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            connection.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key: str, contents: List[str]) -> None:
+        value = json.dumps(contents, ensure_ascii=False)
+        size = len(value.encode())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, contents, size, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._evict(connection)
+            connection.commit()
+
+    def _evict(self, connection: sqlite3.Connection) -> None:
+        total_bytes = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+        for key, size in connection.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall():
+            connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total_bytes -= size
+            self.evictions += 1
+            if total_bytes <= self.max_bytes:
+                break
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, total_bytes = self._connect().execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {
+            "path": self.path,
+            "entries": entries,
+            "bytes": total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# LLM_CACHE_PATHを空にするとキャッシュしない
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache/responses.sqlite3")
+llm_cache = LLMCache(LLM_CACHE_PATH, int(os.getenv("LLM_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))) if LLM_CACHE_PATH else None
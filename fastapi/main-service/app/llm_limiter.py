@@ -0,0 +1,164 @@
+import asyncio
+import contextvars
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, List, Optional
+
+# 呼び出しをどのラウンドのものとして数えるか。create_roundなどの先頭でset_llm_groupする
+# asyncio.gatherで作られるタスクにも引き継がれる
+llm_group: contextvars.ContextVar[str] = contextvars.ContextVar("llm_group", default="")
+
+# 1回の応答（choice 1つ）の出力トークン数の見積もり
+DEFAULT_COMPLETION_TOKENS = int(os.getenv("LLM_COMPLETION_TOKENS_ESTIMATE", "400"))
+
+
+def set_llm_group(group: str) -> None:
+    llm_group.set(group)
+
+
+def estimate_tokens(messages: List[dict], n: int = 1, max_tokens: Optional[int] = None) -> int:
+    """プロンプトのトークン数（UTF-8で4バイトを1トークンとする）と、n個の応答の出力トークン数の見積もり"""
+    prompt_tokens = sum(len(str(message.get("content", "")).encode()) // 4 + 4 for message in messages)
+    return prompt_tokens + n * (max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+
+class TokenBucket:
+    """1分あたりper_minute個まで。使いすぎた分（見積もりより多かった分）は負の残高として次に回す"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """amount個を使えるようになるまでの秒数"""
+        self._refill()
+        return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= amount
+
+
+class Permit:
+    def __init__(self, tokens: int):
+        self.estimated_tokens = tokens
+        # 実際に使ったトークン数（completion.usage）。分かれば呼び出し側が入れる
+        self.used_tokens: Optional[int] = None
+
+
+class Waiter:
+    def __init__(self, future: asyncio.Future, tokens: int):
+        self.future = future
+        self.tokens = tokens
+        self.enqueued_at = time.monotonic()
+
+
+class LLMRateLimiter:
+    """OpenAIへの呼び出しの同時実行数・requests/min・tokens/minの上限
+
+    待っている呼び出しはグループ（ラウンド）ごとのキューに入り、グループを順番に回して1つずつ通す
+    1つのラウンドの大量の呼び出しが、後から来たラウンドの呼び出しを待たせ続けることはない
+    """
+
+    def __init__(self, max_concurrency: int, requests_per_minute: int, tokens_per_minute: int):
+        self.max_concurrency = max_concurrency
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.in_flight = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._queues: "OrderedDict[str, Deque[Waiter]]" = OrderedDict()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @asynccontextmanager
+    async def limit(self, tokens: int, group: Optional[str] = None):
+        """上限の範囲に入るまで待ってから、呼び出しの間permitを渡す"""
+        group = llm_group.get() if group is None else group
+        waiter = Waiter(asyncio.get_running_loop().create_future(), tokens)
+        self._queues.setdefault(group, deque()).append(waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release(Permit(tokens))  # 通された直後にキャンセルされた
+            raise
+        wait = time.monotonic() - waiter.enqueued_at
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+        permit = Permit(tokens)
+        try:
+            yield permit
+        finally:
+            self._release(permit)
+
+    def _release(self, permit: Permit) -> None:
+        self.in_flight -= 1
+        self.completed += 1
+        if permit.used_tokens is not None:
+            self.tokens.consume(permit.used_tokens - permit.estimated_tokens)
+        self._dispatch()
+
+    def _next_waiter(self) -> Optional[Waiter]:
+        """先頭のグループの先頭の呼び出し。キャンセルされたものは捨てる"""
+        while self._queues:
+            group, queue = next(iter(self._queues.items()))
+            while queue and queue[0].future.done():
+                queue.popleft()
+            if queue:
+                return queue[0]
+            del self._queues[group]
+        return None
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self.in_flight < self.max_concurrency:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(waiter.tokens))
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            self.requests.consume(1)
+            self.tokens.consume(waiter.tokens)
+            self.in_flight += 1
+            waiter.future.set_result(None)
+            # 通したグループを末尾に回す
+            group, queue = self._queues.popitem(last=False)
+            queue.popleft()
+            if queue:
+                self._queues[group] = queue
+
+    def stats(self) -> Dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "requests_per_minute": self.requests.capacity,
+            "tokens_per_minute": self.tokens.capacity,
+            "in_flight": self.in_flight,
+            "waiting": sum(len(queue) for queue in self._queues.values()),
+            "waiting_groups": len(self._queues),
+            "completed": self.completed,
+            "mean_wait": self.total_wait / self.completed if self.completed else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+llm_limiter = LLMRateLimiter(
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "16")),
+    requests_per_minute=int(os.getenv("LLM_REQUESTS_PER_MINUTE", "500")),
+    tokens_per_minute=int(os.getenv("LLM_TOKENS_PER_MINUTE", "30000")),
+)
@@ -0,0 +1,126 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+import openai
+
+from llm_limiter import llm_limiter
+from log_config import logger
+
+# 1回の呼び出しの上限秒数（limiterで待つ時間は含まない）
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "4"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1.0"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "30.0"))
+# 1にすると、p95より遅い呼び出しに同じリクエストをもう1つ送り、先に返った方を使う（トークンは2回分かかる）
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+# p95を出すのに必要な計測数
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+
+class LatencyTracker:
+    """リクエストの種類（response_formatとn）ごとの直近の応答時間"""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.window = window
+        self._latencies: Dict[str, Deque[float]] = {}
+
+    def record(self, kind: str, seconds: float) -> None:
+        self._latencies.setdefault(kind, deque(maxlen=self.window)).append(seconds)
+
+    def quantile(self, kind: str, q: float) -> Optional[float]:
+        latencies = self._latencies.get(kind)
+        if not latencies or len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+latency_tracker = LatencyTracker()
+
+
+def is_retryable(error: BaseException) -> bool:
+    """時間をおけば成功しうるエラー（タイムアウト・接続エラー・429・5xx）"""
+    if isinstance(error, (asyncio.TimeoutError, openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def retry_delay(attempt: int, error: BaseException) -> float:
+    """指数バックオフ（full jitter）。Retry-Afterがあればそれより短くしない"""
+    delay = random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return max(delay, float(retry_after)) if retry_after else delay
+    except ValueError:
+        return delay
+
+
+async def attempt_call(request: Callable[[], Awaitable[Any]], kind: str, tokens: int,
+                       started: Optional[asyncio.Event] = None) -> Any:
+    """limiterで待ってから1回呼ぶ。startedは呼び出しを始めたときにsetされる"""
+    async with llm_limiter.limit(tokens) as permit:
+        if started is not None:
+            started.set()
+        start = time.monotonic()
+        completion = await asyncio.wait_for(request(), LLM_TIMEOUT)
+        latency_tracker.record(kind, time.monotonic() - start)
+        usage = getattr(completion, "usage", None)
+        if usage is not None:
+            permit.used_tokens = usage.total_tokens
+        return completion
+
+
+async def hedged_call(request: Callable[[], Awaitable[Any]], kind: str, tokens: int) -> Any:
+    """呼び出しがp95を超えたら同じリクエストをもう1つ送り、先に成功した方を返す"""
+    started = asyncio.Event()
+    first = asyncio.ensure_future(attempt_call(request, kind, tokens, started))
+    hedge_after = latency_tracker.quantile(kind, 0.95) if LLM_HEDGE else None
+    if hedge_after is None:
+        return await first
+
+    tasks = {first}
+    # limiterで待っている間は数えない
+    waiter = asyncio.ensure_future(started.wait())
+    try:
+        await asyncio.wait({first, waiter}, return_when=asyncio.FIRST_COMPLETED)
+        if not first.done():
+            done, _ = await asyncio.wait({first}, timeout=hedge_after)
+            if not done:
+                logger.info(f"LLM call ({kind}) exceeded p95 {hedge_after:.1f}s, sending a hedged request")
+                tasks.add(asyncio.ensure_future(attempt_call(request, kind, tokens)))
+
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        waiter.cancel()
+        for task in tasks:
+            task.cancel()
+
+
+async def call_with_policy(request: Callable[[], Awaitable[Any]], kind: str, tokens: int) -> Any:
+    """タイムアウト・リトライ（ジッター付き指数バックオフ）・ヘッジをつけてrequestを呼ぶ
+
+    request: 呼ぶたびに新しいAPI呼び出しのコルーチンを返す関数
+    """
+    for attempt in range(LLM_MAX_ATTEMPTS):
+        try:
+            return await hedged_call(request, kind, tokens)
+        except Exception as error:
+            if not is_retryable(error) or attempt == LLM_MAX_ATTEMPTS - 1:
+                raise
+            delay = retry_delay(attempt, error)
+            logger.warning(f"LLM call ({kind}) failed with {type(error).__name__}, "
+                           f"retrying in {delay:.1f}s ({attempt + 1}/{LLM_MAX_ATTEMPTS})")
+            await asyncio.sleep(delay)
@@ -1,5 +1,5 @@
 import time
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func, select, inspect, text, update, delete
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import sessionmaker
 from models.round import Base
@@ -42,9 +42,110 @@ def restart_database():
     # Base.metadata.drop_all(bind=engine)
     Base.metadata.create_all(bind=engine)
 
+# create_allは既存テーブルに列を追加しないので、モデルにあってDBに無い列をALTER TABLEで足す
+def add_missing_columns():
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                ddl = f"ALTER TABLE `{table.name}` ADD COLUMN `{column.name}` {column.type.compile(dialect=engine.dialect)}"
+                if column.server_default is not None:
+                    ddl += f" NOT NULL DEFAULT {column.server_default.arg}"
+                conn.execute(text(ddl))
+                print(f"Added column {table.name}.{column.name}")
+
+# 同様に、既存テーブルに無いインデックス（全文検索用など）を作る
+def add_missing_indexes():
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+                index.create(bind=conn)
+                print(f"Created index {index.name} on {table.name}")
+
+def count_by_round(session, column, round_column, round_id):
+    return session.execute(select(func.count(column)).where(round_column == round_id)).scalar_one()
+
+# round_summaries導入前に登録されたRoundの集計値を埋める
+def backfill_round_summaries():
+    session = Session()
+    try:
+        round_ids = session.execute(
+            select(round_db_model.Round.id)
+            .outerjoin(round_db_model.RoundSummary, round_db_model.RoundSummary.round_id == round_db_model.Round.id)
+            .where(round_db_model.RoundSummary.round_id.is_(None))
+        ).scalars().all()
+        for round_id in round_ids:
+            session.add(round_db_model.RoundSummary(
+                round_id=round_id,
+                poi_count=count_by_round(session, round_db_model.Poi.id, round_db_model.Poi.round_id, round_id),
+                rebuttal_count=count_by_round(session, round_db_model.Rebuttal.id, round_db_model.Rebuttal.round_id, round_id),
+                speech_count=count_by_round(session, round_db_model.Speech.id, round_db_model.Speech.round_id, round_id),
+                total_argument_units=session.execute(
+                    select(func.count(round_db_model.ArgumentUnit.id))
+                    .join(round_db_model.Speech, round_db_model.Speech.id == round_db_model.ArgumentUnit.speech_id)
+                    .where(round_db_model.Speech.round_id == round_id)
+                ).scalar_one(),
+            ))
+        session.commit()
+        print(f"Backfilled round summaries: {len(round_ids)} rounds")
+    finally:
+        session.close()
+
+# votes導入前は、GPTのサンプルが返した反論をサンプルの数だけ別の行に保存していた
+# 同じRoundの同じ(src, tgt)を最小のidの行にまとめ、votesに行数（votesの合計）を入れる。何度実行してもよい
+# 残る反論は最初に現れた順に並ぶ（cruds.gpt.count_votesと同じ順）。重複が隣り合っていなかったRoundでは
+# interval・orderの値が変わりうるので、macro_structural.FEATURE_ALGORITHM_VERSIONを上げてある
+def compact_rebuttals():
+    session = Session()
+    try:
+        Rebuttal = round_db_model.Rebuttal
+        groups = session.execute(
+            select(Rebuttal.round_id, Rebuttal.src, Rebuttal.tgt, func.min(Rebuttal.id), func.sum(Rebuttal.votes))
+            .group_by(Rebuttal.round_id, Rebuttal.src, Rebuttal.tgt)
+            .having(func.count(Rebuttal.id) > 1)
+        ).all()
+        round_ids = set()
+        for round_id, src, tgt, keep_id, votes in groups:
+            session.execute(update(Rebuttal).where(Rebuttal.id == keep_id).values(votes=votes))
+            session.execute(
+                delete(Rebuttal)
+                .where(Rebuttal.round_id == round_id, Rebuttal.src == src, Rebuttal.tgt == tgt, Rebuttal.id != keep_id)
+            )
+            round_ids.add(round_id)
+        for round_id in round_ids:
+            session.execute(
+                update(round_db_model.RoundSummary)
+                .where(round_db_model.RoundSummary.round_id == round_id)
+                .values(rebuttal_count=count_by_round(session, Rebuttal.id, Rebuttal.round_id, round_id))
+            )
+            # レスポンスのキャッシュ（ETag）を無効にする
+            session.execute(
+                update(round_db_model.Round)
+                .where(round_db_model.Round.id == round_id)
+                .values(version=round_db_model.Round.version + 1)
+            )
+        session.commit()
+        print(f"Compacted rebuttals: {len(groups)} duplicated rebuttals in {len(round_ids)} rounds")
+    finally:
+        session.close()
+
 if __name__ == "__main__":
     if wait_for_db_connection():
         restart_database()
-        pass
+        add_missing_columns()
+        add_missing_indexes()
+        backfill_round_summaries()
+        compact_rebuttals()
     else:
         print("Exiting due to database connection failure.")
\ No newline at end of file
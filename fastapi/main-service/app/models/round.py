@@ -1,10 +1,14 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Float, Text, JSON
+from sqlalchemy import Column, Integer, String, ForeignKey, Float, Text, JSON, Index
 from sqlalchemy.orm import relationship
 
 from db import Base
 
 class Round(Base):
     __tablename__ = "rounds"
+    # タイトル・モーションは日本語が多いのでngramパーサを使う
+    __table_args__ = (
+        Index("ft_rounds_title_motion", "title", "motion", mysql_prefix="FULLTEXT", mysql_with_parser="ngram"),
+    )
     id = Column(Integer, primary_key=True, index=True)
 
     video_id = Column(String(1024))
@@ -14,10 +18,14 @@ class Round(Base):
     date_uploaded = Column(String(1024))
     channel_id = Column(String(1024))
     tag = Column(String(1024))
+    # 変更のたびにインクリメントする。ETagの生成に使う
+    version = Column(Integer, nullable=False, default=1, server_default="1")
 
     pois = relationship("Poi", back_populates="round", cascade="all, delete-orphan")
     rebuttals = relationship("Rebuttal", back_populates="round", cascade="all, delete-orphan")
     speeches = relationship("Speech", back_populates="round", cascade="all, delete-orphan")
+    summary = relationship("RoundSummary", back_populates="round", uselist=False, cascade="all, delete-orphan")
+    features = relationship("RoundFeatures", back_populates="round", uselist=False, cascade="all, delete-orphan")
 
 class Speech(Base):
     __tablename__ = "speeches"
@@ -34,6 +42,9 @@ class Speech(Base):
 
 class ArgumentUnit(Base):
     __tablename__ = "argument_units"
+    __table_args__ = (
+        Index("ft_argument_units_text", "text", mysql_prefix="FULLTEXT"),
+    )
     id = Column(Integer, primary_key=True, index=True)
 
     sequence_id = Column(Integer)
@@ -61,10 +72,37 @@ class Rebuttal(Base):
 
     src = Column(Integer)
     tgt = Column(Integer)
+    # GPTのサンプル（try_num回）のうち、この反論を返した数。同じ反論は1行にまとめて保存する
+    votes = Column(Integer, nullable=False, default=1, server_default="1")
 
     round_id = Column(Integer, ForeignKey("rounds.id"))
     round = relationship("Round", back_populates="rebuttals")
 
+# /rounds-summary用の集計値。Roundの作成・削除と同じトランザクションで更新する
+class RoundSummary(Base):
+    __tablename__ = "round_summaries"
+    round_id = Column(Integer, ForeignKey("rounds.id"), primary_key=True)
+
+    poi_count = Column(Integer, nullable=False, default=0)
+    rebuttal_count = Column(Integer, nullable=False, default=0)
+    speech_count = Column(Integer, nullable=False, default=0)
+    total_argument_units = Column(Integer, nullable=False, default=0)
+
+    round = relationship("Round", back_populates="summary")
+
+# マクロ構造特徴量。作成時に計算し、algorithm_versionが古い行は読むときに計算し直す
+class RoundFeatures(Base):
+    __tablename__ = "round_features"
+    round_id = Column(Integer, ForeignKey("rounds.id"), primary_key=True)
+
+    distance = Column(Float, nullable=False)
+    interval = Column(Float, nullable=False)
+    order = Column(Float, nullable=False)
+    rally = Column(Float, nullable=False)
+    algorithm_version = Column(Integer, nullable=False)
+
+    round = relationship("Round", back_populates="features")
+
 class OperationLog(Base):
     __tablename__ = "operation_logs"
     id = Column(Integer, primary_key=True, index=True)
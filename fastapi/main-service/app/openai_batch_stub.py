@@ -0,0 +1,187 @@
+"""
+batch_ingest.pyをオフラインで試すための、OpenAI APIのスタブサーバー
+
+    uvicorn openai_batch_stub:app --port 8090
+    OPENAI_BASE_URL=http://localhost:8090/v1 OPENAI_API_KEY=stub python batch_ingest.py rounds.json --skip-ingest
+
+ファイルのアップロード・バッチの作成と取得・結果ファイルのダウンロードと、chat completionsだけを実装する
+応答はプロンプトから決まる固定の内容（3 segmentごとのargument unit、反論元ごとに1つの反論先）
+バッチは作成後、1回目の取得ではin_progress、2回目以降はcompletedになる
+"""
+import email
+import email.policy
+import itertools
+import json
+import re
+import time
+from typing import Dict, List
+
+from fastapi import FastAPI, HTTPException, Request, Response
+
+app = FastAPI()
+
+files: Dict[str, dict] = {}
+file_contents: Dict[str, bytes] = {}
+batches: Dict[str, dict] = {}
+batch_polls: Dict[str, int] = {}
+ids = itertools.count(1)
+
+SEGMENTS_PER_UNIT = 3
+LINE_ID = re.compile(r"^(\d+):", re.MULTILINE)
+
+
+def section_ids(messages: List[dict], prefix: str) -> List[int]:
+    """prefixで始まるメッセージに並んだ「id:本文」のid"""
+    for message in messages:
+        content = message.get("content", "")
+        if content.startswith(prefix):
+            return [int(match) for match in LINE_ID.findall(content[len(prefix):])]
+    return []
+
+
+def fake_content(body: dict, index: int) -> str:
+    response_format = body.get("response_format") or {}
+    name = response_format.get("json_schema", {}).get("name")
+    messages = body["messages"]
+    if name == "ArgumentUnitMetaDataList":
+        num_segments = len(section_ids(messages, "Given segments: "))
+        return json.dumps({"argument_units": [
+            {"first_segment_id": first, "argument_topic": "stub", "reasoning": "stub"}
+            for first in range(0, max(num_segments, 1), SEGMENTS_PER_UNIT)
+        ]})
+    if name == "Rebuttals":
+        src_ids = section_ids(messages, "Source speech: ")
+        tgt_ids = section_ids(messages, "Target speech: ")
+        # サンプルごとに少しずつ違う反論を返す
+        rebuttals = [
+            {"src": src, "tgt": tgt_ids[src % len(tgt_ids)]}
+            for src in src_ids if tgt_ids and (src + index) % 4 != 0
+        ]
+        return json.dumps({"rebuttals": rebuttals})
+    return "This house would stub the motion."
+
+
+def fake_completion(body: dict) -> dict:
+    choices = [
+        {
+            "index": index,
+            "message": {"role": "assistant", "content": fake_content(body, index), "refusal": None},
+            "finish_reason": "stop",
+            "logprobs": None,
+        }
+        for index in range(body.get("n", 1))
+    ]
+    prompt_tokens = sum(len(str(message.get("content", ""))) // 4 for message in body["messages"])
+    completion_tokens = sum(len(choice["message"]["content"]) // 4 for choice in choices)
+    return {
+        "id": f"chatcmpl-stub-{next(ids)}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body["model"],
+        "choices": choices,
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def create_file(content: bytes, filename: str, purpose: str) -> dict:
+    file_id = f"file-stub-{next(ids)}"
+    files[file_id] = {
+        "id": file_id,
+        "object": "file",
+        "bytes": len(content),
+        "created_at": int(time.time()),
+        "filename": filename,
+        "purpose": purpose,
+        "status": "processed",
+    }
+    file_contents[file_id] = content
+    return files[file_id]
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    return fake_completion(await request.json())
+
+
+@app.post("/v1/files")
+async def upload_file(request: Request):
+    # python-multipartに依存しないよう、multipartはemailパッケージで読む
+    raw = b"Content-Type: " + request.headers["content-type"].encode() + b"\r\n\r\n" + await request.body()
+    message = email.message_from_bytes(raw, policy=email.policy.HTTP)
+    fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+    if "file" not in fields:
+        raise HTTPException(status_code=400, detail="file is required")
+    purpose = fields["purpose"].get_content().strip() if "purpose" in fields else "batch"
+    return create_file(fields["file"].get_payload(decode=True), fields["file"].get_filename() or "upload.jsonl", purpose)
+
+
+@app.get("/v1/files/{file_id}")
+async def get_file(file_id: str):
+    if file_id not in files:
+        raise HTTPException(status_code=404, detail="file not found")
+    return files[file_id]
+
+
+@app.get("/v1/files/{file_id}/content")
+async def get_file_content(file_id: str):
+    if file_id not in file_contents:
+        raise HTTPException(status_code=404, detail="file not found")
+    return Response(content=file_contents[file_id], media_type="application/octet-stream")
+
+
+@app.post("/v1/batches")
+async def create_batch(request: Request):
+    params = await request.json()
+    if params["input_file_id"] not in file_contents:
+        raise HTTPException(status_code=400, detail="input file not found")
+
+    output_lines = []
+    for line in file_contents[params["input_file_id"]].decode().splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        output_lines.append(json.dumps({
+            "id": f"batch_req_stub_{next(ids)}",
+            "custom_id": item["custom_id"],
+            "response": {"status_code": 200, "request_id": f"req_stub_{next(ids)}", "body": fake_completion(item["body"])},
+            "error": None,
+        }))
+    output_file = create_file(("\n".join(output_lines) + "\n").encode(), "batch_output.jsonl", "batch_output")
+
+    batch_id = f"batch_stub_{next(ids)}"
+    batches[batch_id] = {
+        "id": batch_id,
+        "object": "batch",
+        "endpoint": params["endpoint"],
+        "input_file_id": params["input_file_id"],
+        "completion_window": params["completion_window"],
+        "status": "validating",
+        "output_file_id": None,
+        "error_file_id": None,
+        "created_at": int(time.time()),
+        "metadata": params.get("metadata"),
+        "request_counts": {"total": len(output_lines), "completed": 0, "failed": 0},
+    }
+    batch_polls[batch_id] = 0
+    batches[batch_id]["_output_file_id"] = output_file["id"]
+    return {key: value for key, value in batches[batch_id].items() if not key.startswith("_")}
+
+
+@app.get("/v1/batches/{batch_id}")
+async def get_batch(batch_id: str):
+    if batch_id not in batches:
+        raise HTTPException(status_code=404, detail="batch not found")
+    batch = batches[batch_id]
+    batch_polls[batch_id] += 1
+    if batch_polls[batch_id] == 1:
+        batch["status"] = "in_progress"
+    else:
+        batch["status"] = "completed"
+        batch["output_file_id"] = batch["_output_file_id"]
+        batch["completed_at"] = int(time.time())
+        batch["request_counts"]["completed"] = batch["request_counts"]["total"]
+    return {key: value for key, value in batch.items() if not key.startswith("_")}
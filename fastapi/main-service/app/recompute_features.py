@@ -0,0 +1,196 @@
+"""
+round_featuresを一括で計算し直すコマンド
+
+macro_structural.pyのFEATURE_ALGORITHM_VERSIONを上げたときに使う（APIは古い行を読むときに計算し直すが、
+全件をまとめて更新しておけば初回アクセスが遅くならない）
+
+    python recompute_features.py                 # 行が無い・versionが古いRoundだけ
+    python recompute_features.py --all           # 全Round
+    python recompute_features.py --workers 4 --chunk-size 500
+
+Roundをid順にchunk-size件ずつ読み、ProcessPoolExecutorで計算し、chunkごとにまとめて書き込む
+書き込んだ最後のRound.idをチェックポイントファイルに保存するので、中断しても続きから再開できる
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+from sqlalchemy import or_, select
+from sqlalchemy.dialects.mysql import insert
+
+import models.round as round_db_model
+from cruds.features import FEATURE_NAMES, FEATURE_INPUTS
+from cruds.round import select_round_rows, load_round_batches
+from db import async_engine, async_session
+from features.macro_structural import FEATURE_ALGORITHM_VERSION
+from features.macro_structural_batch import calculate_features_batch
+from migrate_db import engine, Session, wait_for_db_connection
+
+DEFAULT_CHECKPOINT = "recompute_features.checkpoint.json"
+
+
+def load_checkpoint(path: str, recompute_all: bool) -> int:
+    """続きから始めるRound.id。versionや対象が違うチェックポイントは使わない"""
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("algorithm_version") != FEATURE_ALGORITHM_VERSION or checkpoint.get("all") != recompute_all:
+        print(f"Ignoring checkpoint for another run: {checkpoint}")
+        return 0
+    print(f"Resuming after round {checkpoint['last_round_id']} ({checkpoint['processed']} rounds done)")
+    return checkpoint["last_round_id"]
+
+
+def save_checkpoint(path: str, last_round_id: int, processed: int, recompute_all: bool) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({
+            "algorithm_version": FEATURE_ALGORITHM_VERSION,
+            "all": recompute_all,
+            "last_round_id": last_round_id,
+            "processed": processed,
+        }, f)
+    os.replace(tmp_path, path)  # 書き込み途中で止まっても壊れたファイルを残さない
+
+
+def select_round_ids(session, after: int, limit: int, recompute_all: bool) -> List[int]:
+    query = select(round_db_model.Round.id).where(round_db_model.Round.id > after)
+    if not recompute_all:
+        query = query.outerjoin(
+            round_db_model.RoundFeatures, round_db_model.RoundFeatures.round_id == round_db_model.Round.id
+        ).where(or_(
+            round_db_model.RoundFeatures.round_id.is_(None),
+            round_db_model.RoundFeatures.algorithm_version != FEATURE_ALGORITHM_VERSION,
+        ))
+    return session.execute(query.order_by(round_db_model.Round.id).limit(limit)).scalars().all()
+
+
+class FeatureInputLoader:
+    """APIのload_round_featuresと同じload_round_batchesで特徴量の入力を読む、同期的なラッパー
+
+    非同期エンジンの接続は作られたイベントループでしか使えないので、1つのループで全chunkを読む
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+
+    def load(self, round_ids: List[int]) -> List[Tuple[int, Dict]]:
+        """round_idsの順に、(round_id, RoundBatchResponse形式（POI・反論・ADUのsequence_idだけ）のdict)を返す
+
+        select_round_idsの後に削除されたRoundは含めない
+        """
+        return self.loop.run_until_complete(self._load(round_ids))
+
+    async def _load(self, round_ids: List[int]) -> List[Tuple[int, Dict]]:
+        async with async_session() as db:
+            round_batches = await load_round_batches(
+                db,
+                select_round_rows(FEATURE_INPUTS).where(round_db_model.Round.id.in_(round_ids)),
+                FEATURE_INPUTS,
+            )
+        rounds = dict(round_batches)
+        return [(round_id, rounds[round_id]) for round_id in round_ids if round_id in rounds]
+
+    def close(self) -> None:
+        self.loop.run_until_complete(async_engine.dispose())
+        self.loop.close()
+
+
+def compute_features(rounds: List[Dict]) -> Tuple[List[Dict[str, float]], Dict[str, float]]:
+    """ワーカープロセスで実行する。特徴量と、特徴量ごとの計算時間を返す"""
+    timings = {}
+    return calculate_features_batch(rounds, timings), timings
+
+
+def write_features(session, round_ids: List[int], features: List[Dict[str, float]]) -> None:
+    if not round_ids:
+        return
+    statement = insert(round_db_model.RoundFeatures)
+    session.execute(
+        statement.on_duplicate_key_update(
+            {name: statement.inserted[name] for name in FEATURE_NAMES + ("algorithm_version",)}
+        ),
+        [
+            {"round_id": round_id, "algorithm_version": FEATURE_ALGORITHM_VERSION, **round_features}
+            for round_id, round_features in zip(round_ids, features)
+        ],
+    )
+    session.commit()
+
+
+def split(items: List, parts: int) -> List[List]:
+    size = -(-len(items) // parts)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute macro-structural features into round_features")
+    parser.add_argument("--all", action="store_true", help="versionが最新の行も計算し直す")
+    parser.add_argument("--chunk-size", type=int, default=200, help="1回に読み書きするRoundの数")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+    parser.add_argument("--restart", action="store_true", help="チェックポイントを無視して最初から")
+    args = parser.parse_args()
+
+    if not wait_for_db_connection():
+        print("Exiting due to database connection failure.")
+        return
+    # migrate_db・dbのengineはSQLを全て出力するので止める
+    engine.echo = False
+    async_engine.echo = False
+
+    last_round_id = 0 if args.restart else load_checkpoint(args.checkpoint, args.all)
+    processed = 0
+    timings = {}
+    start = time.perf_counter()
+    session = Session()
+    loader = FeatureInputLoader()
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            pending = None
+            while True:
+                # 前のchunkを計算している間に次のchunkを読む
+                round_ids = select_round_ids(session, last_round_id, args.chunk_size, args.all)
+                if round_ids:
+                    loaded = loader.load(round_ids)
+                    loaded_ids = [round_id for round_id, _ in loaded]
+                    rounds = [round_data for _, round_data in loaded]
+                    futures = [executor.submit(compute_features, part) for part in split(rounds, args.workers)] if rounds else []
+                    last_round_id = round_ids[-1]
+                if pending is not None:
+                    # チェックポイントは削除されたRoundも含めて選んだidまで進める
+                    selected_ids, pending_ids, pending_futures = pending
+                    features = []
+                    for future in pending_futures:
+                        part_features, part_timings = future.result()
+                        features.extend(part_features)
+                        for step, seconds in part_timings.items():
+                            timings[step] = timings.get(step, 0.0) + seconds
+                    write_features(session, pending_ids, features)
+                    processed += len(pending_ids)
+                    save_checkpoint(args.checkpoint, selected_ids[-1], processed, args.all)
+                    elapsed = time.perf_counter() - start
+                    print(f"{processed} rounds (up to id {selected_ids[-1]}), {processed / elapsed:.1f} rounds/s")
+                if not round_ids:
+                    break
+                pending = (round_ids, loaded_ids, futures)
+    finally:
+        loader.close()
+        session.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Done: {processed} rounds in {elapsed:.2f}s ({processed / elapsed if elapsed else 0:.1f} rounds/s)")
+    # ワーカーでの合計時間（並列に動くので経過時間より長くなりうる）
+    for step, seconds in timings.items():
+        print(f"  {step}: {seconds:.3f}s")
+    if os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+
+if __name__ == "__main__":
+    main()
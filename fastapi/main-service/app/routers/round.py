@@ -1,24 +1,43 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload, defer
+from sqlalchemy.orm import selectinload
 from sqlalchemy.future import select
-from db import get_db
+from sqlalchemy import func
+from db import get_db, async_session
 import time
 import asyncio
 from dotenv import load_dotenv
 load_dotenv()
-from typing import List, Optional, Dict
-from pydantic import BaseModel
+from typing import List, Optional, Dict, Literal
+from pydantic import BaseModel, Field
 import models.round as round_db_model
 from log_config import logger
 router = APIRouter()
-from cruds.gpt import segment2argument_units, speeches2rebuttals, digest2motion, group_consecutive
+from cruds.gpt import segment2argument_units, speeches2rebuttals, digest2motion, count_votes
+from llm_cache import llm_cache
+from llm_limiter import llm_limiter, set_llm_group
 import os, httpx
 from datetime import datetime
 import pytz
 from fastapi import Query
-import html, re
-from features.macro_structural import calculate_features
+import html, re, json
+from features.macro_structural import FEATURE_ALGORITHM_VERSION, calculate_feature_variants
+from cruds.round import (
+    build_round_summary, build_round_speeches, filter_rounds, paginate_rounds, next_cursor, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, UNPAGED_MAX_SIZE,
+    bump_round_version, get_round_version, get_rounds_version, select_round_rows, load_round_batches,
+    FieldSelection, round_load_options, round_batch_dict,
+)
+from http_cache import (
+    make_etag, etag_matches, not_modified, response_cache, cached_response, store_body, store_response, encode_json,
+    JSON_MEDIA_TYPE,
+)
+from binary_format import negotiate_media_type, encode_rounds, MSGPACK_MEDIA_TYPE
+from cruds.features import (
+    build_round_features, load_round_features, FEATURE_VARIANT_INPUTS,
+    feature_stats, similarity_index, track_round_features, get_feature_stats,
+)
+from cruds.search import search_rounds, search_argument_units, DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT
 
 # request schema
 
@@ -43,6 +62,7 @@ class RoundCreate(BaseModel):
 class RebuttalCreate(BaseModel):
     src: int
     tgt: int
+    votes: int = Field(1, ge=1)  # 0以下だと特徴量の計算で反論が無かったことになる
 
 class ArgumentUnitCreate(BaseModel):
     sequence_id: int
@@ -75,6 +95,7 @@ class RebuttalResponse(BaseModel):
     # id: int
     src: int
     tgt: int
+    votes: int = 1
 
     class Config:
         orm_mode = True
@@ -154,6 +175,21 @@ class RoundBatchWithFeaturesResponse(BaseModel):
     class Config:
         orm_mode = True
 
+class MacroStructuralFeatureVariants(BaseModel):
+    distance: float
+    rally: float
+    interval_v1: float
+    interval_v2: float
+    order_v1: float
+    order_v2: float
+    order_v3: float
+    order_v4: float
+
+class RoundFeatureVariantsResponse(BaseModel):
+    id: int
+    title: Optional[str]
+    features: MacroStructuralFeatureVariants
+
 class PoiResponse(BaseModel):
     argument_unit_id: int
     class Config:
@@ -187,293 +223,332 @@ class RoundResponse(BaseModel):
 #     class Config:
 #         orm_mode = True
 
+# 一覧系エンドポイント共通のクエリパラメータ
+class RoundListParams:
+    def __init__(
+        self,
+        cursor: Optional[int] = Query(None, description="前ページの最後のRound.id。X-Next-Cursorヘッダの値を渡す"),
+        limit: Optional[int] = Query(
+            None, ge=1, le=MAX_PAGE_SIZE,
+            description=f"省略時はcursorがあれば{DEFAULT_PAGE_SIZE}件、cursorも無ければ{UNPAGED_MAX_SIZE}件（*-streamは無制限）",
+        ),
+        tag: Optional[str] = Query(None, description="部分一致"),
+        channel_id: Optional[str] = None,
+        motion: Optional[str] = Query(None, description="部分一致"),
+        uploaded_since: Optional[str] = Query(None, description="date_uploaded >= uploaded_since (ISO 8601)"),
+        uploaded_before: Optional[str] = Query(None, description="date_uploaded < uploaded_before (ISO 8601)"),
+    ):
+        self.cursor = cursor
+        self.limit = limit
+        self.tag = tag
+        self.channel_id = channel_id
+        self.motion = motion
+        self.uploaded_since = uploaded_since
+        self.uploaded_before = uploaded_before
+
+    def apply(self, query, unpaged_max_size=UNPAGED_MAX_SIZE):
+        query = filter_rounds(
+            query,
+            tag=self.tag,
+            channel_id=self.channel_id,
+            motion=self.motion,
+            uploaded_since=self.uploaded_since,
+            uploaded_before=self.uploaded_before,
+        )
+        return paginate_rounds(query, cursor=self.cursor, limit=self.limit, unpaged_max_size=unpaged_max_size)
+
+    def set_next_cursor(self, response: Response, round_ids: List[int]):
+        cursor = next_cursor(round_ids, cursor=self.cursor, limit=self.limit)
+        if cursor is not None:
+            response.headers["X-Next-Cursor"] = str(cursor)
+
+# 条件付きGET。versionだけを読んでIf-None-Matchと比較し、一致すればリレーションを読まずに304を返す
+async def check_rounds_etag(request: Request, response: Response, db: AsyncSession, query,
+                            media_type: str = JSON_MEDIA_TYPE, extra_versions=()) -> Optional[Response]:
+    etag = make_etag(request, await get_rounds_version(db, query), *extra_versions, media_type=media_type)
+    if etag_matches(request, etag):
+        return not_modified(etag, response.headers)
+    response.headers["ETag"] = etag
+    return None
+
+async def check_round_etag(request: Request, response: Response, db: AsyncSession, round_id: int) -> Optional[Response]:
+    version = await get_round_version(db, round_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Round not found")
+    etag = make_etag(request, version)
+    if etag_matches(request, etag):
+        return not_modified(etag, response.headers)
+    response.headers["ETag"] = etag
+    return None
+
+# fields= / exclude= (カンマ区切り)によるsparse fieldset
+FIELDS_DESCRIPTION = "含める項目。例: rebuttals,speeches.sequence_id,speeches.start,speeches.end"
+EXCLUDE_DESCRIPTION = "除く項目。例: pois,speeches.text"
+
+def split_fields(value: Optional[str]) -> Optional[List[str]]:
+    if value is None:
+        return None
+    return [field.strip() for field in value.split(",") if field.strip()]
+
+def parse_field_selection(fields: Optional[str], exclude: Optional[str], extra_exclude=()) -> FieldSelection:
+    try:
+        return FieldSelection(split_fields(fields), (split_fields(exclude) or []) + list(extra_exclude))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def field_selection(
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    exclude: Optional[str] = Query(None, description=EXCLUDE_DESCRIPTION),
+) -> FieldSelection:
+    return parse_field_selection(fields, exclude)
+
+def field_selection_without_text(
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    exclude: Optional[str] = Query(None, description=EXCLUDE_DESCRIPTION),
+) -> FieldSelection:
+    return parse_field_selection(fields, exclude, extra_exclude=["speeches.text"])
+
 def remove_invalid_characters(text):
     # 無効な文字（絵文字や特殊文字）を削除する正規表現
     return re.sub(r'[^\x00-\x7F]+', '', text)
 
 
 @router.get("/rounds")
-async def get_rounds(db: AsyncSession = Depends(get_db)):
-    query = select(round_db_model.Round).options(
-        selectinload(round_db_model.Round.pois),
-        selectinload(round_db_model.Round.rebuttals),
-        selectinload(round_db_model.Round.speeches).selectinload(
-            round_db_model.Speech.argument_units
-        ),
-    )
+async def get_rounds(request: Request, response: Response, params: RoundListParams = Depends(),
+                     selection: FieldSelection = Depends(field_selection), db: AsyncSession = Depends(get_db)):
+    cached = cached_response(request)
+    if cached:
+        return cached
+    generation = response_cache.generation
+    not_modified_response = await check_rounds_etag(request, response, db, params.apply(select(round_db_model.Round.id, round_db_model.Round.version)))
+    if not_modified_response:
+        return not_modified_response
+    query = params.apply(select(round_db_model.Round).options(*round_load_options(selection)))
     result = await db.execute(query)
     rounds = result.scalars().unique().all()
-    return rounds
+    params.set_next_cursor(response, [round.id for round in rounds])
+    return store_response(request, response, rounds, generation)
 
 # textは省く
 @router.get("/rounds-without-text")
-async def get_rounds_without_text(db: AsyncSession = Depends(get_db)):
-    query = select(round_db_model.Round).options(
-        selectinload(round_db_model.Round.pois),
-        selectinload(round_db_model.Round.rebuttals),
-        selectinload(round_db_model.Round.speeches).selectinload(
-            round_db_model.Speech.argument_units
-        ).options(defer(round_db_model.ArgumentUnit.text)),
-    )
+async def get_rounds_without_text(request: Request, response: Response, params: RoundListParams = Depends(),
+                                  selection: FieldSelection = Depends(field_selection_without_text),
+                                  db: AsyncSession = Depends(get_db)):
+    cached = cached_response(request)
+    if cached:
+        return cached
+    generation = response_cache.generation
+    not_modified_response = await check_rounds_etag(request, response, db, params.apply(select(round_db_model.Round.id, round_db_model.Round.version)))
+    if not_modified_response:
+        return not_modified_response
+    query = params.apply(select(round_db_model.Round).options(*round_load_options(selection)))
     result = await db.execute(query)
     rounds = result.scalars().unique().all()
-    return rounds
+    params.set_next_cursor(response, [round.id for round in rounds])
+    return store_response(request, response, rounds, generation)
 
 @router.get("/batch-rounds", response_model=List[RoundBatchResponse])
-async def get_rounds_batch(db: AsyncSession = Depends(get_db)):
-    query = select(round_db_model.Round).options(
-        selectinload(round_db_model.Round.pois),
-        selectinload(round_db_model.Round.rebuttals),
-        selectinload(round_db_model.Round.speeches).selectinload(
-            round_db_model.Speech.argument_units
-        ),
-    )
-    result = await db.execute(query)
-    db_rounds = result.scalars().unique().all()
-
-    return [
-        RoundBatchResponse(
-            video_id=db_round.video_id,
-            title=db_round.title,
-            description=db_round.description,
-            motion=db_round.motion,
-            date_uploaded=db_round.date_uploaded,
-            channel_id=db_round.channel_id,
-            tag=db_round.tag,
-
-            pois=[poi.argument_unit_id for poi in db_round.pois],
-            rebuttals=[
-                RebuttalResponse(src=rebuttal.src, tgt=rebuttal.tgt)
-                for rebuttal in db_round.rebuttals
-            ],
-            speeches=[
-                SpeechResponse(
-                    argument_units=[
-                        ArgumentUnitResponse(
-                            sequence_id=au.sequence_id,
-                            start=au.start,
-                            end=au.end,
-                            text=au.text
-                        ) for au in speech.argument_units
-                    ]
-                ) for speech in db_round.speeches
-            ]
-        ) for db_round in db_rounds
-    ]
+async def get_rounds_batch(request: Request, response: Response, params: RoundListParams = Depends(),
+                           selection: FieldSelection = Depends(field_selection), db: AsyncSession = Depends(get_db)):
+    media_type = negotiate_media_type(request)
+    cached = cached_response(request, media_type)
+    if cached:
+        return cached
+    generation = response_cache.generation
+    response.headers["Vary"] = "Accept"
+    not_modified_response = await check_rounds_etag(request, response, db, params.apply(select(round_db_model.Round.id, round_db_model.Round.version)), media_type)
+    if not_modified_response:
+        return not_modified_response
+
+    round_batches = await load_round_batches(db, params.apply(select_round_rows(selection)), selection)
+    params.set_next_cursor(response, [round_id for round_id, _ in round_batches])
+    rounds = [round_data for _, round_data in round_batches]
+
+    if media_type == MSGPACK_MEDIA_TYPE:
+        return store_body(request, response, encode_rounds(rounds), generation, media_type=media_type)
+    return store_body(request, response, encode_json(rounds), generation)
 
 @router.get("/rounds-summary", response_model=List[RoundSummaryResponse])
-async def get_rounds_summary(db: AsyncSession = Depends(get_db)):
-    query = select(round_db_model.Round).options(
-        selectinload(round_db_model.Round.pois),
-        selectinload(round_db_model.Round.rebuttals),
-        selectinload(round_db_model.Round.speeches).selectinload(
-            round_db_model.Speech.argument_units
-        ),
-    )
+async def get_rounds_summary(request: Request, response: Response, db: AsyncSession = Depends(get_db)):
+    cached = cached_response(request)
+    if cached:
+        return cached
+    generation = response_cache.generation
+    not_modified_response = await check_rounds_etag(request, response, db, select(round_db_model.Round.id, round_db_model.Round.version))
+    if not_modified_response:
+        return not_modified_response
+
+    # 集計値はround_summariesに保持しているので、関連テーブルは読まない
+    query = select(
+        round_db_model.Round.id,
+        round_db_model.Round.video_id,
+        round_db_model.Round.title,
+        round_db_model.Round.description,
+        round_db_model.Round.motion,
+        round_db_model.Round.date_uploaded,
+        round_db_model.Round.channel_id,
+        round_db_model.Round.tag,
+        func.coalesce(round_db_model.RoundSummary.poi_count, 0).label("poi_count"),
+        func.coalesce(round_db_model.RoundSummary.rebuttal_count, 0).label("rebuttal_count"),
+        func.coalesce(round_db_model.RoundSummary.speech_count, 0).label("speech_count"),
+        func.coalesce(round_db_model.RoundSummary.total_argument_units, 0).label("total_argument_units"),
+    ).outerjoin(
+        round_db_model.RoundSummary,
+        round_db_model.RoundSummary.round_id == round_db_model.Round.id,
+    ).order_by(round_db_model.Round.id)
     result = await db.execute(query)
-    db_rounds = result.scalars().unique().all()
-
-    return [
-        RoundSummaryResponse(
-            id=db_round.id,
-            video_id=db_round.video_id,
-            title=db_round.title,
-            description=db_round.description,
-            motion=db_round.motion,
-            date_uploaded=db_round.date_uploaded,
-            channel_id=db_round.channel_id,
-            tag=db_round.tag,
-            poi_count=len(db_round.pois),
-            rebuttal_count=len(db_round.rebuttals),
-            speech_count=len(db_round.speeches),
-            total_argument_units=sum(len(speech.argument_units) for speech in db_round.speeches)
-        ) for db_round in db_rounds
-    ]
+
+    return store_response(request, response, [RoundSummaryResponse(**row._mapping) for row in result.all()], generation)
 
 @router.get("/batch-rounds-with-features", response_model=List[RoundBatchWithFeaturesResponse])
-async def get_rounds_batch_with_features(db: AsyncSession = Depends(get_db)):
-    query = select(round_db_model.Round).options(
-        selectinload(round_db_model.Round.pois),
-        selectinload(round_db_model.Round.rebuttals),
-        selectinload(round_db_model.Round.speeches).selectinload(
-            round_db_model.Speech.argument_units
-        ),
+async def get_rounds_batch_with_features(request: Request, response: Response, params: RoundListParams = Depends(),
+                                         selection: FieldSelection = Depends(field_selection),
+                                         db: AsyncSession = Depends(get_db)):
+    media_type = negotiate_media_type(request)
+    cached = cached_response(request, media_type)
+    if cached:
+        return cached
+    generation = response_cache.generation
+    response.headers["Vary"] = "Accept"
+    not_modified_response = await check_rounds_etag(
+        request, response, db, params.apply(select(round_db_model.Round.id, round_db_model.Round.version)), media_type,
+        extra_versions=(FEATURE_ALGORITHM_VERSION,),
     )
-    result = await db.execute(query)
-    db_rounds = result.scalars().unique().all()
-
-    response_list = []
-    for db_round in db_rounds:
-        # Convert to RoundBatchResponse format for feature calculation
-        round_data = {
-            "video_id": db_round.video_id,
-            "title": db_round.title,
-            "description": db_round.description,
-            "motion": db_round.motion,
-            "date_uploaded": db_round.date_uploaded,
-            "channel_id": db_round.channel_id,
-            "tag": db_round.tag,
-            "pois": [poi.argument_unit_id for poi in db_round.pois],
-            "rebuttals": [
-                {"src": rebuttal.src, "tgt": rebuttal.tgt}
-                for rebuttal in db_round.rebuttals
-            ],
-            "speeches": [
-                {
-                    "argument_units": [
-                        {
-                            "sequence_id": au.sequence_id,
-                            "start": au.start,
-                            "end": au.end,
-                            "text": au.text
-                        } for au in speech.argument_units
-                    ]
-                } for speech in db_round.speeches
-            ]
-        }
-        
-        # Calculate features
-        features = calculate_features(round_data)
-        
-        response_list.append(
-            RoundBatchWithFeaturesResponse(
-                id=db_round.id,
-                video_id=db_round.video_id,
-                title=db_round.title,
-                description=db_round.description,
-                motion=db_round.motion,
-                date_uploaded=db_round.date_uploaded,
-                channel_id=db_round.channel_id,
-                tag=db_round.tag,
-                pois=[poi.argument_unit_id for poi in db_round.pois],
-                rebuttals=[
-                    RebuttalResponse(src=rebuttal.src, tgt=rebuttal.tgt)
-                    for rebuttal in db_round.rebuttals
-                ],
-                speeches=[
-                    SpeechResponse(
-                        argument_units=[
-                            ArgumentUnitResponse(
-                                sequence_id=au.sequence_id,
-                                start=au.start,
-                                end=au.end,
-                                text=au.text
-                            ) for au in speech.argument_units
-                        ]
-                    ) for speech in db_round.speeches
-                ],
-                features=MacroStructuralFeatures(
-                    distance=features["distance"],
-                    interval=features["interval"],
-                    order=features["order"],
-                    rally=features["rally"]
-                )
-            )
-        )
-    
-    return response_list
+    if not_modified_response:
+        return not_modified_response
+
+    # 特徴量はround_featuresから読むので、反論・POIなどは指定された場合しか読まない
+    round_batches = await load_round_batches(db, params.apply(select_round_rows(selection)), selection)
+    round_ids = [round_id for round_id, _ in round_batches]
+    params.set_next_cursor(response, round_ids)
+    features = await load_round_features(db, round_ids)
+    rounds = [
+        {"id": round_id, **round_data, "features": features[round_id]}
+        for round_id, round_data in round_batches
+    ]
 
-@router.get("/batch-rounds/{round_id}", response_model=RoundBatchResponse)
-async def get_round_batch(round_id: int, db: AsyncSession = Depends(get_db)):
-    query = select(round_db_model.Round).options(
-        selectinload(round_db_model.Round.pois),
-        selectinload(round_db_model.Round.rebuttals),
-        selectinload(round_db_model.Round.speeches).selectinload(
-            round_db_model.Speech.argument_units
-        ),
-    ).filter_by(id=round_id)
+    if media_type == MSGPACK_MEDIA_TYPE:
+        return store_body(request, response, encode_rounds(rounds), generation, media_type=media_type)
+    return store_body(request, response, encode_json(rounds), generation)
+
+# 研究用。interval・orderの全versionを1回の計算で返す（保存はしない）
+@router.get("/batch-rounds-with-feature-variants", response_model=List[RoundFeatureVariantsResponse])
+async def get_rounds_batch_with_feature_variants(request: Request, response: Response, params: RoundListParams = Depends(),
+                                                 db: AsyncSession = Depends(get_db)):
+    cached = cached_response(request)
+    if cached:
+        return cached
+    generation = response_cache.generation
+    not_modified_response = await check_rounds_etag(
+        request, response, db, params.apply(select(round_db_model.Round.id, round_db_model.Round.version)),
+        extra_versions=(FEATURE_ALGORITHM_VERSION,),
+    )
+    if not_modified_response:
+        return not_modified_response
 
-    result = await db.execute(query)
-    db_round = result.scalars().first()
+    round_batches = await load_round_batches(
+        db, params.apply(select_round_rows(FEATURE_VARIANT_INPUTS)), FEATURE_VARIANT_INPUTS
+    )
+    params.set_next_cursor(response, [round_id for round_id, _ in round_batches])
+    rounds = [
+        {"id": round_id, "title": round_data["title"], "features": calculate_feature_variants(round_data)}
+        for round_id, round_data in round_batches
+    ]
+    return store_body(request, response, encode_json(rounds), generation)
+
+# 全件ダンプ用。サーバサイドカーソルで少しずつ読み、1ラウンド1行のNDJSONとして返す
+STREAM_CHUNK_SIZE = 50
+
+async def stream_rounds_ndjson(params: RoundListParams, selection: FieldSelection, with_features: bool):
+    # StreamingResponseの送信中も使うので、リクエストのDependsとは別にセッションを開く
+    # 特徴量の再計算はcommitするので、サーバサイドカーソルとは別のセッションで行う
+    async with async_session() as session, async_session() as features_session:
+        # 全件ダンプなので、cursorもlimitも無ければ上限をかけない
+        query = params.apply(select(round_db_model.Round).options(*round_load_options(selection)), unpaged_max_size=None)
+        result = await session.stream(query.execution_options(yield_per=STREAM_CHUNK_SIZE))
+        async for db_rounds in result.scalars().partitions(STREAM_CHUNK_SIZE):
+            if with_features:
+                features = await load_round_features(features_session, [db_round.id for db_round in db_rounds])
+            for db_round in db_rounds:
+                round_data = round_batch_dict(db_round, selection)
+                if with_features:
+                    round_data = {"id": db_round.id, **round_data, "features": features[db_round.id]}
+                yield json.dumps(round_data, ensure_ascii=False) + "\n"
+
+@router.get("/batch-rounds-stream")
+async def stream_rounds_batch(params: RoundListParams = Depends(), selection: FieldSelection = Depends(field_selection)):
+    return StreamingResponse(stream_rounds_ndjson(params, selection, with_features=False), media_type="application/x-ndjson")
+
+@router.get("/batch-rounds-with-features-stream")
+async def stream_rounds_batch_with_features(params: RoundListParams = Depends(), selection: FieldSelection = Depends(field_selection)):
+    return StreamingResponse(stream_rounds_ndjson(params, selection, with_features=True), media_type="application/x-ndjson")
 
-    if not db_round:
+@router.get("/batch-rounds/{round_id}", response_model=RoundBatchResponse)
+async def get_round_batch(round_id: int, request: Request, response: Response,
+                          selection: FieldSelection = Depends(field_selection), db: AsyncSession = Depends(get_db)):
+    cached = cached_response(request)
+    if cached:
+        return cached
+    generation = response_cache.generation
+    not_modified_response = await check_round_etag(request, response, db, round_id)
+    if not_modified_response:
+        return not_modified_response
+
+    round_batches = await load_round_batches(
+        db, select_round_rows(selection).where(round_db_model.Round.id == round_id), selection
+    )
+    if not round_batches:
         raise HTTPException(status_code=404, detail="Round not found")
 
-    logger.info(f"round.pois: {db_round.pois}")
-
-    return RoundBatchResponse(
-        video_id=db_round.video_id,
-        title=db_round.title,
-        description=db_round.description,
-        motion=db_round.motion,
-        date_uploaded=db_round.date_uploaded,
-        channel_id=db_round.channel_id,
-        tag=db_round.tag,
-
-        pois=[poi.argument_unit_id for poi in db_round.pois],
-        rebuttals=[
-            RebuttalResponse(src=rebuttal.src, tgt=rebuttal.tgt)
-            for rebuttal in db_round.rebuttals
-        ],
-        speeches=[
-            SpeechResponse(
-                argument_units=[
-                    ArgumentUnitResponse(
-                        sequence_id=au.sequence_id,
-                        start=au.start,
-                        end=au.end,
-                        text=au.text
-                    ) for au in speech.argument_units
-                ]
-            ) for speech in db_round.speeches
-        ]
-    )
+    _, round_data = round_batches[0]
+
+    return store_body(request, response, encode_json(round_data), generation, round_ids=[round_id])
 
 @router.get("/batch-rounds-list", response_model=List[RoundBatchResponse])
-async def get_rounds_batch(round_ids: List[int] = Query(...), db: AsyncSession = Depends(get_db)):
-    query = select(round_db_model.Round).options(
-        selectinload(round_db_model.Round.pois),
-        selectinload(round_db_model.Round.rebuttals),
-        selectinload(round_db_model.Round.speeches).selectinload(
-            round_db_model.Speech.argument_units
-        ),
-    ).filter(round_db_model.Round.id.in_(round_ids))
-    result = await db.execute(query)
-    db_rounds = result.scalars().unique().all()
-
-    return [
-        RoundBatchResponse(
-            video_id=db_round.video_id,
-            title=db_round.title,
-            description=db_round.description,
-            motion=db_round.motion,
-            date_uploaded=db_round.date_uploaded,
-            channel_id=db_round.channel_id,
-            tag=db_round.tag,
-            pois=[poi.argument_unit_id for poi in db_round.pois],
-            rebuttals=[
-                RebuttalResponse(src=rebuttal.src, tgt=rebuttal.tgt)
-                for rebuttal in db_round.rebuttals
-            ],
-            speeches=[
-                SpeechResponse(
-                    argument_units=[
-                        ArgumentUnitResponse(
-                            sequence_id=au.sequence_id,
-                            start=au.start,
-                            end=au.end,
-                            text=au.text
-                        ) for au in speech.argument_units
-                    ]
-                ) for speech in db_round.speeches
-            ]
-        ) for db_round in db_rounds
-    ]
+async def get_rounds_batch_list(request: Request, response: Response, round_ids: List[int] = Query(...),
+                                selection: FieldSelection = Depends(field_selection), db: AsyncSession = Depends(get_db)):
+    media_type = negotiate_media_type(request)
+    cached = cached_response(request, media_type)
+    if cached:
+        return cached
+    generation = response_cache.generation
+    response.headers["Vary"] = "Accept"
+    not_modified_response = await check_rounds_etag(
+        request, response, db,
+        select(round_db_model.Round.id, round_db_model.Round.version).where(round_db_model.Round.id.in_(round_ids)),
+        media_type,
+    )
+    if not_modified_response:
+        return not_modified_response
+
+    round_batches = await load_round_batches(
+        db,
+        select_round_rows(selection).where(round_db_model.Round.id.in_(round_ids)).order_by(round_db_model.Round.id),
+        selection,
+    )
+    rounds = [round_data for _, round_data in round_batches]
+
+    if media_type == MSGPACK_MEDIA_TYPE:
+        return store_body(request, response, encode_rounds(rounds), generation, round_ids=round_ids, media_type=media_type)
+    return store_body(request, response, encode_json(rounds), generation, round_ids=round_ids)
 
 @router.get("/rounds/{round_id}")
-async def get_round(round_id: int, db: AsyncSession = Depends(get_db)):
-    query = select(round_db_model.Round).options(
-        selectinload(round_db_model.Round.pois),
-        selectinload(round_db_model.Round.rebuttals),
-        selectinload(round_db_model.Round.speeches).selectinload(
-            round_db_model.Speech.argument_units
-        ),
-    ).filter_by(id=round_id)
+async def get_round(round_id: int, request: Request, response: Response,
+                    selection: FieldSelection = Depends(field_selection), db: AsyncSession = Depends(get_db)):
+    cached = cached_response(request)
+    if cached:
+        return cached
+    generation = response_cache.generation
+    not_modified_response = await check_round_etag(request, response, db, round_id)
+    if not_modified_response:
+        return not_modified_response
+
+    query = select(round_db_model.Round).options(*round_load_options(selection)).filter_by(id=round_id)
     result = await db.execute(query)
     round = result.scalars().first()
     if round is None:
         raise HTTPException(status_code=404, detail="Round not found")
-    return round
+    return store_response(request, response, round, generation, round_ids=[round_id])
 
 @router.delete("/rounds/{round_id}")
 async def delete_round(round_id: int, db: AsyncSession = Depends(get_db)):
@@ -484,6 +559,8 @@ async def delete_round(round_id: int, db: AsyncSession = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Round not found")
     await db.delete(round)
     await db.commit()
+    response_cache.invalidate_round(round_id)
+    feature_stats.remove_round(round_id)
     logger.info(f"Round {round_id}: {round.title} deleted")
     return {"message": f"Round {round_id}: {round.title} deleted"}
 
@@ -497,6 +574,23 @@ async def get_video_metadata(video_id: str):
         metadata = all_data["items"][0]["snippet"]
         return metadata
 
+def video_metadata_fields(metadata: dict, tag: str) -> dict:
+    """動画のmetaデータから、Roundのtitle・description・date_uploaded・channel_id・tagを作る"""
+    # メタデータからタグを取得し、エスケープ処理を行う
+    video_tag = ""
+    if "tags" in metadata and metadata["tags"]:
+        video_tag = html.escape(str(metadata["tags"][0])) + ","
+
+    secure_description = html.escape(remove_invalid_characters(metadata["description"]))
+
+    return {
+        "title": metadata["title"],
+        "description": secure_description,
+        "date_uploaded": metadata["publishedAt"],
+        "channel_id": metadata["channelId"],
+        "tag": video_tag + tag,
+    }
+
 @router.post("/rounds", response_model=RoundResponse)
 async def create_round(round_create: RoundCreate, db: AsyncSession = Depends(get_db)): # Roundレコードを作成
     if len(round_create.speeches) not in [6, 8]:
@@ -509,6 +603,7 @@ async def create_round(round_create: RoundCreate, db: AsyncSession = Depends(get
     
     # 動画のmetaデータの取得
     video_id = round_create.video_id
+    set_llm_group(video_id)  # このラウンドのGPT呼び出しを、他のラウンドと交互に通す
     url = f"https://www.googleapis.com/youtube/v3/videos?part=snippet,statistics&id={video_id}&key={os.getenv('YOUTUBE_API_KEY')}"
     async with httpx.AsyncClient() as client:
         response = await client.get(url)
@@ -516,116 +611,20 @@ async def create_round(round_create: RoundCreate, db: AsyncSession = Depends(get
         all_data = response.json()
         metadata = all_data["items"][0]["snippet"]
 
-    # メタデータからタグを取得し、エスケープ処理を行う
-    video_tag = ""
-    if "tags" in metadata and metadata["tags"]:
-        video_tag = html.escape(str(metadata["tags"][0])) + ","
-
-    secure_description = html.escape(remove_invalid_characters(metadata["description"]))
-
     round = round_db_model.Round(
         video_id = round_create.video_id,
         motion = round_create.motion,
-        title = metadata["title"],
-        description = secure_description,
-        date_uploaded = metadata["publishedAt"],
-        channel_id = metadata["channelId"],
-        tag = video_tag+round_create.tag
+        **video_metadata_fields(metadata, round_create.tag)
     )
     db.add(round)
     
-    speeches = []
-    fixed_pois = []
-
     start_time = time.time()  # 開始時間を記録
 
     # ここでsegment2argment_unitsの処理を並行実行
     segment_tasks = [segment2argument_units(speech_create) for speech_create in round_create.speeches]
     segment_results = await asyncio.gather(*segment_tasks)  # 並行実行して結果を待つ
 
-    logger.info(f"segment_results: {segment_results}")
-    logger.info(f"poi_segment_ids: {round_create.poi_segment_ids}")
-
-    tmp_segment_id = 0
-    poi_local_ids = [[] for _ in range(len(round_create.speeches))]
-    for speech_id, speech in enumerate(round_create.speeches):
-        for local_segment_id, segment in enumerate(speech):
-            if tmp_segment_id in round_create.poi_segment_ids:
-                logger.info(f"`POI->{tmp_segment_id}th segment: {segment.text}")
-                poi_local_ids[speech_id].append(local_segment_id)
-            tmp_segment_id += 1
-    
-    logger.info(f"poi_local_ids: {poi_local_ids}")
-
-    sequence_id = 0
-    for idx, first_seg_ids in enumerate(segment_results):
-        logger.info(f"{idx}th speech-----------------")
-        speech_create = round_create.speeches[idx]
-        argument_units = []
-
-        fixed_arg_heads = first_seg_ids
-
-        poi_arg_units = group_consecutive(poi_local_ids[idx])
-        
-        poi_based_head_pairs = []
-        for poi_arg_unit in poi_arg_units:
-            first_poi_based_head = poi_arg_unit[0]
-            last_poi_based_head = poi_arg_unit[-1]+1
-            poi_based_head_pairs.append((first_poi_based_head, last_poi_based_head))
-            for arg_head in first_seg_ids:
-                if first_poi_based_head < arg_head < last_poi_based_head:
-                    fixed_arg_heads.remove(arg_head)
-        
-        for poi_based_heads in poi_based_head_pairs:
-            if poi_based_heads[0] not in fixed_arg_heads:
-                fixed_arg_heads.append(poi_based_heads[0])
-            if poi_based_heads[1] not in fixed_arg_heads:
-                fixed_arg_heads.append(poi_based_heads[1])
-        
-        fixed_arg_heads.sort()
-
-        logger.info(f"before         : {segment_results[idx]}")
-        logger.info(f"fixed_arg_heads: {fixed_arg_heads}")
-        logger.info(f"poi_based_head_pairs: {poi_based_head_pairs}")
-        
-        for i in range(len(fixed_arg_heads)):
-            first_seg_id = fixed_arg_heads[i]
-
-            if i == len(fixed_arg_heads) - 1:
-                last_seg_id = len(speech_create) - 1
-            elif fixed_arg_heads[i] == fixed_arg_heads[i+1]:
-                last_seg_id = fixed_arg_heads[i]
-            else:
-                last_seg_id = fixed_arg_heads[i+1] - 1
-
-            logger.info(f"len_speech_create: {len(speech_create)} first_seg_id: {first_seg_id}, last_seg_id: {last_seg_id}")
-            
-            segment_texts = [speech_create[j].text.strip() for j in range(first_seg_id, last_seg_id + 1)]
-            plain_text = ' '.join(segment_texts)
-
-            if first_seg_id < 0 or first_seg_id >= len(speech_create) or last_seg_id < 0 or last_seg_id >= len(speech_create):
-                logger.error(f"Index out of range: first_seg_id={first_seg_id}, last_seg_id={last_seg_id}, len_speech_create={len(speech_create)}")
-                continue
-            argument_units.append(
-                round_db_model.ArgumentUnit(
-                    sequence_id=sequence_id,
-                    start=speech_create[first_seg_id].start,
-                    end=speech_create[last_seg_id].end,
-                    text=plain_text,
-                )
-            )
-
-            # fixed_poisへの追加
-            if first_seg_id in [pair[0] for pair in poi_based_head_pairs]: # POIの先頭のsegmentの場合
-                fixed_pois.append(round_db_model.Poi(argument_unit_id=sequence_id, round=round))
-                logger.info(f"This is POI: {sequence_id}, text: {plain_text}")
-
-            sequence_id += 1
-        
-        # スピーチとArgument Unitsをデータベースに保存するためのリストに追加
-        speeches.append(
-            round_db_model.Speech(argument_units=argument_units, round=round)
-        )
+    speeches, fixed_pois = build_round_speeches(round, round_create.speeches, round_create.poi_segment_ids, segment_results)
     
     db.add_all(speeches)  # スピーチをデータベースに追加
 
@@ -643,14 +642,21 @@ async def create_round(round_create: RoundCreate, db: AsyncSession = Depends(get
             round_db_model.Rebuttal(
                 src=rebuttal.src,
                 tgt=rebuttal.tgt,
+                votes=rebuttal.votes,
                 round=round
             )
         )
     db.add_all(db_rebuttals)
 
+    db.add(build_round_summary(round, speeches, fixed_pois, db_rebuttals))
+    round_features = build_round_features(round, speeches, fixed_pois, db_rebuttals)
+    db.add(round_features)
+
     # ここまでの変更全てをコミット
     await db.commit()
     await db.refresh(round)
+    response_cache.invalidate_round(round.id)
+    track_round_features(round, round_features)
 
     # roundデータを取得し、関連するリレーションをロード
     await db.execute(
@@ -722,11 +728,12 @@ async def create_batch_round(round_create: RoundBatchCreate, db: AsyncSession =
     db.add_all(db_speeches)
 
     db_rebuttals = []
-    for rebuttal in round_create.rebuttals:
+    for rebuttal in count_votes(round_create.rebuttals): # 重複した反論は票数にまとめる
         db_rebuttals.append(
             round_db_model.Rebuttal(
                 src=rebuttal.src,
                 tgt=rebuttal.tgt,
+                votes=rebuttal.votes,
                 round=round
             )
         )
@@ -742,9 +749,15 @@ async def create_batch_round(round_create: RoundBatchCreate, db: AsyncSession =
         )
     db.add_all(db_pois)
 
+    db.add(build_round_summary(round, db_speeches, db_pois, db_rebuttals))
+    round_features = build_round_features(round, db_speeches, db_pois, db_rebuttals)
+    db.add(round_features)
+
     # ここまでの変更全てをコミット
     await db.commit()
     await db.refresh(round)
+    response_cache.invalidate_round(round.id)
+    track_round_features(round, round_features)
 
     # roundデータを取得し、関連するリレーションをロード
     await db.execute(
@@ -775,7 +788,10 @@ async def edit_tag(round_id: int, tag: str, db: AsyncSession = Depends(get_db)):
     if db_round is None:
         raise HTTPException(status_code=404, detail="Round not found")
     db_round.tag = tag
+    bump_round_version(db_round)
     await db.commit()
+    response_cache.invalidate_round(round_id)
+    feature_stats.set_tag(round_id, tag)
     await db.refresh(db_round)
     return db_round
 
@@ -787,10 +803,122 @@ async def edit_video_id(round_id: int, video_id: str, db: AsyncSession = Depends
     if db_round is None:
         raise HTTPException(status_code=404, detail="Round not found")
     db_round.video_id = video_id
+    bump_round_version(db_round)
     await db.commit()
+    response_cache.invalidate_round(round_id)
     await db.refresh(db_round)
     return db_round
 
+class RoundSearchHit(BaseModel):
+    round_id: int
+    video_id: Optional[str]
+    title: Optional[str]
+    motion: Optional[str]
+    score: float
+
+class ArgumentUnitSearchHit(BaseModel):
+    round_id: int
+    video_id: Optional[str]
+    title: Optional[str]
+    sequence_id: int
+    start: Optional[float]
+    end: Optional[float]
+    snippet: str
+    score: float
+
+class SearchResponse(BaseModel):
+    rounds: List[RoundSearchHit]
+    argument_units: List[ArgumentUnitSearchHit]
+
+@router.get("/search", response_model=SearchResponse)
+async def search(request: Request, response: Response,
+                 q: str = Query(..., min_length=1, description="検索語。タイトル・モーション・ADUの本文から探す"),
+                 limit: int = Query(DEFAULT_SEARCH_LIMIT, ge=1, le=MAX_SEARCH_LIMIT),
+                 db: AsyncSession = Depends(get_db)):
+    cached = cached_response(request)
+    if cached:
+        return cached
+    generation = response_cache.generation
+    # 結果はどのRoundの変更でも変わりうるので、全Roundを対象にETagを作る
+    not_modified_response = await check_rounds_etag(request, response, db, select(round_db_model.Round.id, round_db_model.Round.version))
+    if not_modified_response:
+        return not_modified_response
+
+    # MySQLのFULLTEXTインデックスで検索するので、本文はヒットしたADUの分しか読まない
+    result = {
+        "rounds": await search_rounds(db, q, limit),
+        "argument_units": await search_argument_units(db, q, limit),
+    }
+    return store_response(request, response, result, generation)
+
+# 特徴量の分布。全Roundを読まず、書き込みのたびに更新している要約を返す
+@router.get("/features/stats")
+async def get_features_stats(request: Request, response: Response,
+                             group_by: Optional[Literal["tag", "channel_id"]] = None,
+                             db: AsyncSession = Depends(get_db)):
+    cached = cached_response(request)
+    if cached:
+        return cached
+    generation = response_cache.generation
+    stats = await get_feature_stats(db)
+    return store_response(request, response, stats.summary(group_by), generation)
+
+class SimilarRoundResponse(BaseModel):
+    id: int
+    video_id: Optional[str]
+    title: Optional[str]
+    tag: Optional[str]
+    channel_id: Optional[str]
+    similarity_distance: float
+    features: MacroStructuralFeatures
+
+MAX_SIMILAR_ROUNDS = 100
+
+# 反論構造（正規化した特徴量）が近いRound。近い順に返す
+@router.get("/rounds/{round_id}/similar", response_model=List[SimilarRoundResponse])
+async def get_similar_rounds(round_id: int, request: Request, response: Response,
+                             k: int = Query(10, ge=1, le=MAX_SIMILAR_ROUNDS),
+                             db: AsyncSession = Depends(get_db)):
+    cached = cached_response(request)
+    if cached:
+        return cached
+    generation = response_cache.generation
+    stats = await get_feature_stats(db)
+    neighbours = similarity_index.similar(round_id, k)
+    if neighbours is None:
+        raise HTTPException(status_code=404, detail="Round not found")
+
+    round_features = stats.round_features()
+    result = await db.execute(
+        select(
+            round_db_model.Round.id,
+            round_db_model.Round.video_id,
+            round_db_model.Round.title,
+            round_db_model.Round.tag,
+            round_db_model.Round.channel_id,
+        ).where(round_db_model.Round.id.in_([other for other, _ in neighbours]))
+    )
+    rounds = {row.id: row._mapping for row in result.all()}
+    similar_rounds = [
+        {**rounds[other], "similarity_distance": distance, "features": round_features[other]}
+        for other, distance in neighbours if other in rounds
+    ]
+    return store_response(request, response, similar_rounds, generation)
+
+@router.get("/cache/stats")
+async def get_cache_stats():
+    return response_cache.stats()
+
+@router.get("/cache/llm/stats")
+async def get_llm_cache_stats():
+    if llm_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **await asyncio.to_thread(llm_cache.stats)}
+
+@router.get("/llm/limiter/stats")
+async def get_llm_limiter_stats():
+    return llm_limiter.stats()
+
 # 操作ログ用エンドポイント
 class OperationLogRequest(BaseModel):
     operation: str
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Tests for batch_ingest
+
+The YouTube metadata request is replaced with a fixed result, and the OpenAI API either with fixed
+results or with openai_batch_stub served in-process, so the tests run offline. Run from the app directory:
+    python -m pytest test_batch_ingest.py
+"""
+
+import argparse
+import asyncio
+import json
+import os
+
+import httpx
+from openai import AsyncOpenAI
+
+os.environ.setdefault("OPENAI_API_KEY", "test")  # cruds.gptがimport時にclientを作る
+
+import batch_ingest
+import cruds.gpt
+import openai_batch_stub
+from cruds.gpt import RebuttalVote
+from llm_cache import LLMCache
+from routers.round import RoundBatchCreate, RoundCreate, SegmentCreate
+
+METADATA = {
+    "title": "Round title",
+    "description": "Round <description>",
+    "publishedAt": "2024-01-01T00:00:00Z",
+    "channelId": "channel",
+    "tags": ["debate"],
+}
+
+
+def round_create(num_speeches=6, segments_per_speech=4):
+    speeches = [
+        [SegmentCreate(start=float(i), end=float(i + 1), text=f"segment {speech}-{i}") for i in range(segments_per_speech)]
+        for speech in range(num_speeches)
+    ]
+    return RoundCreate(video_id="video", motion="motion", tag="tag", speeches=speeches, poi_segment_ids=[5])
+
+
+def test_assembled_round_is_a_batch_round_body(monkeypatch):
+    async def segment2argument_units(speech):
+        return [0, 2]
+
+    async def speeches2rebuttals(pois, speeches):
+        return [RebuttalVote(src=2, tgt=0, votes=3), RebuttalVote(src=4, tgt=1)]
+
+    async def get_video_metadata(video_id):
+        return METADATA
+
+    monkeypatch.setattr(batch_ingest, "segment2argument_units", segment2argument_units)
+    monkeypatch.setattr(batch_ingest, "speeches2rebuttals", speeches2rebuttals)
+    monkeypatch.setattr(batch_ingest, "get_video_metadata", get_video_metadata)
+
+    assembled = asyncio.run(batch_ingest.assemble_round(round_create()))
+    body = RoundBatchCreate.model_validate(assembled)
+
+    assert body.title == "Round title"
+    assert body.description == "Round &lt;description&gt;"
+    assert body.date_uploaded == "2024-01-01T00:00:00Z"
+    assert body.channel_id == "channel"
+    assert body.tag == "debate,tag"
+    assert len(body.speeches) == 6
+    assert [(rebuttal.src, rebuttal.tgt, rebuttal.votes) for rebuttal in body.rebuttals] == [(2, 0, 3), (4, 1, 1)]
+
+
+def test_full_ingest_against_batch_stub(monkeypatch, tmp_path):
+    stub_client = AsyncOpenAI(
+        api_key="stub", base_url="http://stub/v1", max_retries=0,
+        http_client=httpx.AsyncClient(transport=httpx.ASGITransport(app=openai_batch_stub.app)),
+    )
+    cache = LLMCache(str(tmp_path / "responses.sqlite3"), 64 * 1024 * 1024)
+
+    async def get_video_metadata(video_id):
+        return METADATA
+
+    async def call_with_policy(*args, **kwargs):
+        raise AssertionError("every response should come from the batch results")
+
+    for name in ("files", "file_contents", "batches", "batch_polls"):
+        monkeypatch.setattr(openai_batch_stub, name, {})
+    monkeypatch.setattr(batch_ingest, "client", stub_client)
+    monkeypatch.setattr(batch_ingest, "llm_cache", cache)
+    monkeypatch.setattr(cruds.gpt, "llm_cache", cache)
+    monkeypatch.setattr(cruds.gpt, "call_with_policy", call_with_policy)
+    monkeypatch.setattr(batch_ingest, "get_video_metadata", get_video_metadata)
+
+    rounds_path = tmp_path / "rounds.json"
+    rounds = [round_create(num_speeches) for num_speeches in (6, 8)]
+    rounds_path.write_text(json.dumps([round.model_dump() for round in rounds]))
+    args = argparse.Namespace(
+        rounds=str(rounds_path), output=str(tmp_path / "assembled.json"), skip_ingest=True, api_url="http://api",
+        poll_interval=0.0, work_dir=str(tmp_path / "work"), state=str(tmp_path / "state.json"), restart=False,
+    )
+    asyncio.run(batch_ingest.run(args))
+
+    # 分割と反論判定で1つずつバッチを投げ、完了まで待って結果をキャッシュに入れている
+    submitted = list(openai_batch_stub.batches.values())
+    assert [batch["metadata"]["phase"] for batch in submitted] == ["segments", "rebuttals"]
+    assert all(batch["status"] == "completed" for batch in submitted)
+    assert (tmp_path / "work" / "segments.jsonl").exists() and (tmp_path / "work" / "rebuttals.jsonl").exists()
+    assert not (tmp_path / "state.json").exists()
+
+    assembled = json.loads((tmp_path / "assembled.json").read_text())
+    bodies = [RoundBatchCreate.model_validate(round_data) for round_data in assembled]
+    assert [len(body.speeches) for body in bodies] == [6, 8]
+    assert all(body.rebuttals for body in bodies)
+    assert all(rebuttal.votes >= 1 for body in bodies for rebuttal in body.rebuttals)
+
+    # 全てキャッシュにあるので、もう一度実行してもバッチは投げない
+    num_batches = len(openai_batch_stub.batches)
+    asyncio.run(batch_ingest.run(args))
+    assert len(openai_batch_stub.batches) == num_batches
@@ -0,0 +1,49 @@
+import math
+from array import array
+from types import SimpleNamespace
+
+import msgpack
+
+from binary_format import MSGPACK_MEDIA_TYPE, encode_rounds, negotiate_media_type
+from http_cache import JSON_MEDIA_TYPE
+
+
+def request(accept=None):
+    return SimpleNamespace(headers={} if accept is None else {"accept": accept})
+
+
+def test_msgpack_is_chosen_only_when_accepted():
+    assert negotiate_media_type(request()) == JSON_MEDIA_TYPE
+    assert negotiate_media_type(request("*/*")) == JSON_MEDIA_TYPE
+    assert negotiate_media_type(request("application/x-msgpack")) == MSGPACK_MEDIA_TYPE
+    assert negotiate_media_type(request("application/vnd.msgpack, application/json")) == MSGPACK_MEDIA_TYPE
+    assert negotiate_media_type(request("application/x-msgpack;q=0, application/json")) == JSON_MEDIA_TYPE
+    assert negotiate_media_type(request("application/x-msgpack;q=0.5, application/json")) == JSON_MEDIA_TYPE
+    assert negotiate_media_type(request("application/x-msgpack, */*;q=0.1")) == MSGPACK_MEDIA_TYPE
+    assert negotiate_media_type(request("application/x-msgpack;q=oops")) == JSON_MEDIA_TYPE
+    # 部分一致では判定しない
+    assert negotiate_media_type(request("application/x-msgpack-stream")) == JSON_MEDIA_TYPE
+
+
+def test_null_argument_unit_values_are_packed_as_missing():
+    round_data = {
+        "id": 1,
+        "speeches": [{"argument_units": [
+            {"sequence_id": 0, "start": 0.0, "end": 1.5},
+            {"sequence_id": None, "start": None, "end": None},
+        ]}],
+        "pois": [],
+        "rebuttals": [],
+    }
+    [packed] = msgpack.unpackb(encode_rounds([round_data]), raw=False)
+
+    def unpacked(typecode, key):
+        values = array(typecode, packed[key])
+        if array("i", [1]).tobytes()[0] == 0:
+            values.byteswap()
+        return list(values)
+
+    assert unpacked("i", "sequence_ids") == [0, -1]
+    starts, ends = unpacked("f", "starts"), unpacked("f", "ends")
+    assert starts[0] == 0.0 and math.isnan(starts[1])
+    assert ends[0] == 1.5 and math.isnan(ends[1])
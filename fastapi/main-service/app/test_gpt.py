@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Tests for rebuttal votes: the aggregation in cruds.gpt and the votes accepted by POST /batch-round
+
+Run from the app directory:
+    python -m pytest test_gpt.py
+"""
+
+import asyncio
+import os
+
+import pytest
+from pydantic import ValidationError
+
+os.environ.setdefault("OPENAI_API_KEY", "test")  # cruds.gptがimport時にclientを作る
+
+import cruds.gpt
+from cruds.gpt import Rebuttal, RebuttalVote, count_votes
+from routers.round import RebuttalCreate
+
+
+def test_count_votes_keeps_first_appearance_order():
+    # migrate_db.compact_rebuttals（最小のidの行を残す）と同じ順
+    rebuttals = [Rebuttal(src=8, tgt=1), Rebuttal(src=5, tgt=1), Rebuttal(src=8, tgt=1), Rebuttal(src=2, tgt=0)]
+    assert count_votes(rebuttals) == [
+        RebuttalVote(src=8, tgt=1, votes=2), RebuttalVote(src=5, tgt=1, votes=1), RebuttalVote(src=2, tgt=0, votes=1),
+    ]
+
+
+def test_count_votes_sums_votes_and_applies_threshold():
+    rebuttals = [RebuttalVote(src=3, tgt=0, votes=2), Rebuttal(src=4, tgt=1), RebuttalVote(src=3, tgt=0, votes=1)]
+    assert count_votes(rebuttals, threshold=2) == [RebuttalVote(src=3, tgt=0, votes=3)]
+
+
+def test_batch_round_rejects_non_positive_votes():
+    with pytest.raises(ValidationError):
+        RebuttalCreate(src=1, tgt=0, votes=0)
+    assert RebuttalCreate(src=1, tgt=0).votes == 1
+
+
+def test_speeches2rebuttals_redoes_only_failed_pairs(monkeypatch):
+    calls = []
+    failures = {(3, 0): 1}
+
+    async def argument_units2rebuttals(pois, src_speech, tgt_speech):
+        pair = (src_speech, tgt_speech)
+        calls.append(pair)
+        if failures.get(pair):
+            failures[pair] -= 1
+            raise RuntimeError(f"failed {pair}")
+        return [Rebuttal(src=src_speech, tgt=tgt_speech)]
+
+    monkeypatch.setattr(cruds.gpt, "argument_units2rebuttals_repeated_combined", argument_units2rebuttals)
+    monkeypatch.setattr(cruds.gpt, "relocate_pois", lambda pois, speeches: list(range(len(speeches))))
+    monkeypatch.setattr(cruds.gpt, "REBUTTAL_PAIR_ATTEMPTS", 2)
+
+    rebuttals = asyncio.run(cruds.gpt.speeches2rebuttals([], [None] * 6))
+    pairs = cruds.gpt.rebuttal_speech_pairs(6)
+    assert [(rebuttal.src, rebuttal.tgt) for rebuttal in rebuttals] == pairs
+    assert calls == pairs + [(3, 0)]
+
+    failures[(3, 0)] = 2
+    with pytest.raises(RuntimeError):
+        asyncio.run(cruds.gpt.speeches2rebuttals([], [None] * 6))
@@ -0,0 +1,98 @@
+from types import SimpleNamespace
+
+import pytest
+
+import http_cache
+from http_cache import CacheEntry, ResponseCache, etag_matches, negotiate_encoding
+
+
+def request(**headers):
+    return SimpleNamespace(headers={name.replace("_", "-"): value for name, value in headers.items()})
+
+
+def entry(size, round_ids=None):
+    return CacheEntry(b"x" * size, {}, frozenset(round_ids) if round_ids is not None else None)
+
+
+def test_least_recently_used_entries_are_evicted_by_bytes():
+    cache = ResponseCache(max_bytes=250)
+    cache.put("a", entry(100), cache.generation)
+    cache.put("b", entry(100), cache.generation)
+    cache.get("a")
+    cache.put("c", entry(100), cache.generation)
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.total_bytes == 200
+    assert cache.evictions == 1
+
+
+def test_entries_larger_than_the_cache_are_not_stored():
+    cache = ResponseCache(max_bytes=50)
+    cache.put("a", entry(100), cache.generation)
+    assert cache.get("a") is None
+    assert cache.total_bytes == 0
+
+
+def test_compressed_variants_count_towards_the_size():
+    cache = ResponseCache(max_bytes=10_000)
+    cached = entry(2000)
+    cache.put("a", cached, cache.generation)
+    body = cache.encoded_body("a", cached, "gzip")
+
+    assert cache.encoded_body("a", cached, "gzip") is body
+    assert cache.compression_hits == 1
+    assert cache.total_bytes == 2000 + len(body)
+
+
+def test_invalidation_during_a_read_blocks_the_put():
+    cache = ResponseCache(max_bytes=1000)
+    generation = cache.generation  # DBを読み始める前に取る
+    cache.invalidate_round(1)
+    cache.put("a", entry(10, [2]), generation)
+    assert cache.get("a") is None
+
+
+def test_invalidate_round_drops_the_round_and_every_list():
+    cache = ResponseCache(max_bytes=1000)
+    cache.put("round1", entry(10, [1]), cache.generation)
+    cache.put("round2", entry(10, [2]), cache.generation)
+    cache.put("list", entry(10), cache.generation)
+    cache.invalidate_round(1)
+
+    assert cache.get("round1") is None and cache.get("list") is None
+    assert cache.get("round2") is not None
+    assert cache.invalidations == 2
+    assert cache.total_bytes == 10
+
+
+def test_if_none_match_uses_weak_comparison():
+    etag = '"abc"'
+    assert etag_matches(request(if_none_match='"abc"'), etag)
+    assert etag_matches(request(if_none_match='W/"abc"'), etag)
+    assert etag_matches(request(if_none_match='"other", W/"abc"'), etag)
+    assert etag_matches(request(if_none_match="*"), etag)
+    assert not etag_matches(request(if_none_match='"other"'), etag)
+    assert not etag_matches(request(), etag)
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("gzip", "gzip"),
+    ("identity", None),
+    ("gzip;q=0", None),
+    ("*", "br"),
+    ("*, br;q=0", "gzip"),
+    ("gzip;q=1.0, br;q=0.5", "gzip"),
+    ("gzip;q=0.5, br;q=0.5", "br"),
+    ("GZIP; Q=0.8", "gzip"),
+    ("gzip;q=oops", None),
+])
+def test_accept_encoding_weights(monkeypatch, header, expected):
+    monkeypatch.setattr(http_cache, "brotli", object())  # brotliの有無に依存しないようにする
+    headers = {} if header is None else {"accept_encoding": header}
+    assert negotiate_encoding(request(**headers), http_cache.COMPRESSION_MIN_BYTES) == expected
+
+
+def test_small_bodies_are_not_compressed():
+    assert negotiate_encoding(request(accept_encoding="gzip"), http_cache.COMPRESSION_MIN_BYTES - 1) is None
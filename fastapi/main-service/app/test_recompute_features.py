@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Tests for recompute_features
+
+The loader reads from an in-memory SQLite database instead of MySQL. Run from the app directory:
+    python -m pytest test_recompute_features.py
+"""
+
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test")  # cruds.gptがimport時にclientを作る
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+import recompute_features
+from db import Base
+from models.round import Round
+
+
+def test_loader_skips_rounds_deleted_after_selection(monkeypatch):
+    engine = create_async_engine("sqlite+aiosqlite://")
+    loader = recompute_features.FeatureInputLoader()
+
+    async def setup():
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+            await connection.execute(insert(Round), [{"id": round_id, "title": "round"} for round_id in (1, 2, 4)])
+
+    loader.loop.run_until_complete(setup())
+    monkeypatch.setattr(
+        recompute_features, "async_session", sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    )
+    try:
+        # 3はselect_round_idsの後に削除された
+        loaded = loader.load([1, 2, 3, 4])
+        assert [round_id for round_id, _ in loaded] == [1, 2, 4]
+        assert all(round_data["speeches"] == [] for _, round_data in loaded)
+        assert loader.load([3]) == []
+    finally:
+        loader.loop.run_until_complete(engine.dispose())
+        loader.loop.close()
+
+
+def test_write_features_skips_empty_chunks():
+    class Session:
+        def execute(self, *args):
+            raise AssertionError("nothing to write")
+
+    recompute_features.write_features(Session(), [], [])
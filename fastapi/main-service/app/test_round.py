@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Tests for the query helpers in cruds.round
+
+Run from the app directory:
+    python -m pytest test_round.py
+"""
+
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test")  # cruds.gptがimport時にclientを作る
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine, insert, select
+
+from cruds.round import (
+    ARGUMENT_UNIT_FIELDS, DEFAULT_PAGE_SIZE, RELATIONSHIP_FIELDS, ROUND_FIELDS, UNPAGED_MAX_SIZE,
+    FieldSelection, next_cursor, paginate_rounds, rounds_version_hash,
+)
+from models.round import Round
+from routers.round import parse_field_selection
+
+
+def test_rounds_version_hash_changes_when_rounds_swap_in_a_filter():
+    # Round 1 (version 2) が絞り込みから外れ、Round 2 (version 1) が入る。件数・最大id・versionの総和は同じ
+    before = [(1, 2), (3, 1)]
+    after = [(2, 1), (3, 2)]
+    assert rounds_version_hash(before) != rounds_version_hash(after)
+
+
+def test_rounds_version_hash_changes_on_edit_and_delete():
+    rows = [(1, 1), (2, 1), (3, 1)]
+    assert rounds_version_hash(rows) == rounds_version_hash(list(rows))
+    assert rounds_version_hash(rows) != rounds_version_hash([(1, 1), (2, 2), (3, 1)])
+    assert rounds_version_hash(rows) != rounds_version_hash([(1, 1), (3, 1)])
+
+
+def test_field_selection_defaults_to_everything():
+    selection = FieldSelection()
+    assert selection.round_fields == list(ROUND_FIELDS)
+    assert selection.relationships == list(RELATIONSHIP_FIELDS)
+    assert selection.argument_unit_fields == list(ARGUMENT_UNIT_FIELDS)
+
+
+def test_field_selection_nested_argument_unit_fields():
+    selection = FieldSelection(["speeches.end", "title", "speeches.start"])
+    assert selection.round_fields == ["title"]
+    assert selection.relationships == ["speeches"]
+    # 指定順ではなく定義順に並ぶ
+    assert selection.argument_unit_fields == ["start", "end"]
+
+    selection = FieldSelection(["speeches"])
+    assert selection.argument_unit_fields == list(ARGUMENT_UNIT_FIELDS)
+
+
+@pytest.mark.parametrize("fields, exclude", [
+    (["unknown"], None),
+    (["speeches.unknown"], None),
+    (["pois.src"], None),
+    (None, ["unknown"]),
+    (None, ["speeches.unknown"]),
+])
+def test_field_selection_rejects_unknown_fields(fields, exclude):
+    with pytest.raises(ValueError):
+        FieldSelection(fields, exclude)
+    with pytest.raises(HTTPException) as error:
+        parse_field_selection(",".join(fields or []) or None, ",".join(exclude or []) or None)
+    assert error.value.status_code == 400
+
+
+def test_field_selection_exclude_wins_over_fields():
+    selection = FieldSelection(["title", "pois", "speeches.text", "speeches.start"], ["title", "pois", "speeches.text"])
+    assert selection.round_fields == []
+    assert selection.relationships == ["speeches"]
+    assert selection.argument_unit_fields == ["start"]
+
+
+def test_field_selection_drops_speeches_without_argument_unit_fields():
+    selection = FieldSelection(["speeches.text", "rebuttals"], ["speeches.text"])
+    assert selection.relationships == ["rebuttals"]
+    assert selection.argument_unit_fields == []
+
+    selection = FieldSelection(["speeches.text"], ["speeches"])
+    assert not selection.includes("speeches")
+    assert selection.argument_unit_fields == []
+
+
+def test_parse_field_selection_splits_and_trims():
+    selection = parse_field_selection(" title , speeches.start,,", None, extra_exclude=["speeches.text"])
+    assert selection.round_fields == ["title"]
+    assert selection.argument_unit_fields == ["start"]
+
+    selection = parse_field_selection(None, None, extra_exclude=["speeches.text"])
+    assert "text" not in selection.argument_unit_fields
+
+
+def rounds_engine(num_rounds):
+    engine = create_engine("sqlite://")
+    Round.__table__.create(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Round), [{"title": f"round {i}"} for i in range(num_rounds)])
+    return engine
+
+
+def read_pages(engine, limit=None, unpaged_max_size=UNPAGED_MAX_SIZE):
+    """X-Next-Cursorを辿って全ページを読む"""
+    pages, cursor = [], None
+    with engine.connect() as connection:
+        while True:
+            query = paginate_rounds(select(Round.id), cursor, limit, unpaged_max_size)
+            round_ids = list(connection.execute(query).scalars())
+            pages.append(round_ids)
+            cursor = next_cursor(round_ids, cursor, limit, unpaged_max_size)
+            if cursor is None:
+                return pages
+
+
+def test_next_cursor_walks_every_page_once():
+    pages = read_pages(rounds_engine(5), limit=2)
+    assert pages == [[1, 2], [3, 4], [5]]
+
+
+def test_full_last_page_is_followed_by_an_empty_page():
+    # 最後のページがちょうど埋まると続きがあるか分からないので、空のページで終わる
+    pages = read_pages(rounds_engine(4), limit=2)
+    assert pages == [[1, 2], [3, 4], []]
+
+
+def test_cursor_without_limit_uses_the_default_page_size():
+    assert next_cursor(list(range(1, DEFAULT_PAGE_SIZE + 1)), cursor=0) == DEFAULT_PAGE_SIZE
+    assert next_cursor(list(range(1, DEFAULT_PAGE_SIZE)), cursor=0) is None
+
+
+def test_requests_without_cursor_or_limit_are_capped():
+    pages = read_pages(rounds_engine(UNPAGED_MAX_SIZE + 1))
+    assert len(pages[0]) == UNPAGED_MAX_SIZE
+    assert pages[0][-1] == UNPAGED_MAX_SIZE
+    # 2ページ目からはcursorが付くのでDEFAULT_PAGE_SIZE件ずつ
+    assert pages[1:] == [[UNPAGED_MAX_SIZE + 1]]
+
+
+def test_streams_are_not_capped():
+    pages = read_pages(rounds_engine(UNPAGED_MAX_SIZE + 1), unpaged_max_size=None)
+    assert len(pages) == 1 and len(pages[0]) == UNPAGED_MAX_SIZE + 1